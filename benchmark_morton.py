@@ -0,0 +1,141 @@
+#
+#
+#      0=================================0
+#      |    Kernel Point Convolutions    |
+#      0=================================0
+#
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Callable script to measure the effect of the Morton ordering of the points on the neighbor searches and on the
+#      KPConv forward pass
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import time
+import numpy as np
+import torch
+
+# My libs
+from datasets.common import grid_subsampling, batch_neighbors
+from models.blocks import KPConv
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def synthetic_scene(n_points, seed=42):
+    """
+    Random indoor-like scene: a floor, four walls and a few boxes, with some noise
+    """
+
+    rng = np.random.RandomState(seed)
+    n = n_points // 8
+    u = rng.rand(n, 2) * 10
+    surfaces = [np.hstack((u, np.zeros((n, 1)))),
+                np.hstack((u[:, :1], np.zeros((n, 1)), u[:, 1:] * 0.3)),
+                np.hstack((u[:, :1], np.full((n, 1), 10), u[:, 1:] * 0.3)),
+                np.hstack((np.zeros((n, 1)), u[:, :1], u[:, 1:] * 0.3)),
+                np.hstack((np.full((n, 1), 10), u[:, :1], u[:, 1:] * 0.3))]
+    for c in rng.rand(3, 3) * [8, 8, 0]:
+        surfaces.append(c + rng.rand(n, 3) * 1.5)
+    points = np.vstack(surfaces) + rng.normal(scale=0.005, size=(len(surfaces) * n, 3))
+    return points.astype(np.float32)
+
+
+def timed(fn, n_runs):
+    """
+    Median time of a function over several runs (after a warm up run)
+    """
+
+    fn()
+    times = []
+    for _ in range(n_runs):
+        t0 = time.time()
+        fn()
+        times.append(time.time() - t0)
+    return np.median(times)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+if __name__ == '__main__':
+
+    ############
+    # Parameters
+    ############
+
+    # Size of the scene and of the subsampling grid
+    n_points = 1000000
+    dl = 0.04
+
+    # Convolution parameters (as in the default configs)
+    conv_radius = 2.5
+    kernel_size = 15
+    in_channels = 64
+    out_channels = 64
+    n_runs = 5
+
+    # Number of query points convolved at once (bounds the memory of the forward pass)
+    block_size = 10000
+
+    torch.set_num_threads(1)
+
+    #############
+    # Benchmarks
+    #############
+
+    points = synthetic_scene(n_points)
+    print('\nScene of {:d} points, subsampled at {:.3f}m'.format(points.shape[0], dl))
+
+    results = {}
+    for order in ['hash', 'morton']:
+
+        # Subsampled cloud, in the iteration order of the voxels or along a Morton curve
+        sub_points = grid_subsampling(points, sampleDl=dl, morton_order=order == 'morton')
+        lengths = np.array([sub_points.shape[0]], dtype=np.int32)
+
+        # Radius neighbors search
+        r = dl * conv_radius
+        t_neighbors = timed(lambda: batch_neighbors(sub_points, sub_points, lengths, lengths, r), n_runs)
+        neighbors = batch_neighbors(sub_points, sub_points, lengths, lengths, r)
+
+        # KPConv forward pass, gathering the neighbors of each block of queries in the whole cloud
+        conv = KPConv(kernel_size, 3, in_channels, out_channels, 1.2 * dl, r)
+        s_pts = torch.from_numpy(sub_points)
+        inds = torch.from_numpy(neighbors.astype(np.int64))
+        x = torch.randn(sub_points.shape[0], in_channels)
+        def conv_forward():
+            with torch.no_grad():
+                for i0 in range(0, s_pts.shape[0], block_size):
+                    conv(s_pts[i0:i0 + block_size], s_pts, inds[i0:i0 + block_size], x)
+
+        t_conv = timed(conv_forward, n_runs)
+
+        # Mean distance in memory between a point and its neighbors
+        valid = neighbors < sub_points.shape[0]
+        rows = np.repeat(np.arange(neighbors.shape[0]), neighbors.shape[1]).reshape(neighbors.shape)
+        spread = np.mean(np.abs(neighbors[valid] - rows[valid]))
+
+        results[order] = (t_neighbors, t_conv)
+        print('{:>7s} order: {:d} points, neighbors {:7.3f}s, KPConv forward {:7.3f}s, '
+              'mean index distance to neighbors {:.0f}'.format(order, sub_points.shape[0], t_neighbors, t_conv, spread))
+
+    print('\nSpeedup of the Morton order: neighbors x{:.2f}, KPConv forward x{:.2f}'
+          .format(results['hash'][0] / results['morton'][0], results['hash'][1] / results['morton'][1]))
@@ -0,0 +1,103 @@
+#
+#
+#      0=================================0
+#      |    Kernel Point Convolutions    |
+#      0=================================0
+#
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Callable script to measure the speed of the compiled point operations (pointops extension) against their NumPy
+#      version, which is used when the extension is not built
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Build the extension with other compilation flags (in cpp_wrappers/cpp_pointops/setup.py) and run this script
+#      again to compare the builds.
+#
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import numpy as np
+
+# My libs
+from cpp_wrappers.cpp_pointops import pointops
+import cpp_wrappers.cpp_pointops.numpy_pointops as numpy_pointops
+from benchmark_morton import synthetic_scene, timed
+from datasets.common import batch_random_rotations
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+if __name__ == '__main__':
+
+    ############
+    # Parameters
+    ############
+
+    # Size of the scene and of the subsampling grid
+    n_points = 1000000
+    dl = 0.04
+
+    # Batch of input spheres, and layers of a KPFCNN (as in the default configs)
+    batch_num = 6
+    in_radius = 1.5
+    conv_radius = 2.5
+    layers = np.array([[1, 0, 1, 0], [1, 0, 1, 0], [1, 0, 1, 0], [1, 1, 1, 1], [1, 1, 0, 0]], dtype=np.int32)
+    neighbor_limits = [25, 30, 35, 40, 45]
+    n_threads = 4
+    n_runs = 3
+
+    #############
+    # Benchmarks
+    #############
+
+    points = synthetic_scene(n_points)
+    sub_points = pointops.subsampling.subsample(points, sampleDl=dl)
+    lengths = np.array([sub_points.shape[0]], dtype=np.int32)
+    r = dl * conv_radius
+
+    # Batch of spheres in the subsampled cloud
+    rng = np.random.RandomState(42)
+    centers = sub_points[rng.choice(sub_points.shape[0], batch_num)]
+    spheres = [sub_points[np.sum((sub_points - c) ** 2, axis=1) < in_radius ** 2] for c in centers]
+    batch_points = np.vstack(spheres)
+    batch_lengths = np.array([s.shape[0] for s in spheres], dtype=np.int32)
+    rotations = np.stack([batch_random_rotations(batch_num) for _ in range(layers.shape[0])])
+
+    print('\nScene of {:d} points, subsampled at {:.3f}m to {:d} points'.format(points.shape[0], dl,
+                                                                            sub_points.shape[0]))
+    print('Batch of {:d} spheres, {:d} points\n'.format(batch_num, batch_points.shape[0]))
+
+    operations = {'subsample': lambda m: m.subsample(points, sampleDl=dl),
+                  'subsample_batch': lambda m: m.subsample_batch(batch_points, batch_lengths, sampleDl=2 * dl,
+                                                                 rotations=rotations[0], n_threads=n_threads),
+                  'batch_query': lambda m: m.batch_query(sub_points, sub_points, lengths, lengths, radius=r,
+                                                         n_threads=n_threads),
+                  'batch_knn': lambda m: m.batch_knn(sub_points, sub_points, lengths, lengths, k=16,
+                                                     n_threads=n_threads),
+                  'build_pyramid': lambda m: m.build_pyramid(batch_points, batch_lengths, layers,
+                                                             first_subsampling_dl=dl, conv_radius=conv_radius,
+                                                             neighbor_limits=neighbor_limits, rotations=rotations,
+                                                             n_threads=n_threads)}
+    compiled_modules = {'subsample': pointops.subsampling,
+                        'subsample_batch': pointops.subsampling,
+                        'batch_query': pointops.neighbors,
+                        'batch_knn': pointops.neighbors,
+                        'build_pyramid': pointops.pyramid}
+
+    for name, fn in operations.items():
+        t_compiled = timed(lambda: fn(compiled_modules[name]), n_runs)
+        t_numpy = timed(lambda: fn(numpy_pointops), n_runs)
+        print('{:>16s}: compiled {:7.3f}s, NumPy {:7.3f}s, speedup x{:.1f}'.format(name, t_compiled, t_numpy,
+                                                                                  t_numpy / t_compiled))
@@ -1,11 +1,6 @@
 #!/bin/bash
 
-# Compile cpp subsampling
-cd cpp_subsampling
+# Compile the cpp point operations (subsampling, neighbors and input pyramid) in a single extension
+cd cpp_pointops
 python3 setup.py build_ext --inplace
 cd ..
-
-# Compile cpp neighbors
-cd cpp_neighbors
-python3 setup.py build_ext --inplace
-cd ..
\ No newline at end of file
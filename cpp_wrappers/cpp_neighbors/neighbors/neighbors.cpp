@@ -208,126 +208,323 @@ void batch_ordered_neighbors(vector<PointXYZ>& queries,
 }
 
 
-void batch_nanoflann_neighbors(vector<PointXYZ>& queries,
-                                vector<PointXYZ>& supports,
-                                vector<int>& q_batches,
-                                vector<int>& s_batches,
-                                vector<int>& neighbors_indices,
-                                float radius)
+BatchKDTrees::BatchKDTrees(const PointXYZ* supports, vector<int>& s_batches, int n_threads)
 {
 
 	// Initialize variables
 	// ******************
 
-	// indices
-	int i0 = 0;
+	// Number of batch elements
+	int Nb = (int)s_batches.size();
 
-	// Square radius
-	float r2 = radius * radius;
+	// First support index of each batch element
+	s_starts = vector<size_t>(Nb + 1, 0);
+	for (int b = 0; b < Nb; b++)
+		s_starts[b + 1] = s_starts[b] + s_batches[b];
+	n_supports = s_starts[Nb];
 
-	// Counting vector
-	int max_count = 0;
-	float d2;
-	vector<vector<pair<size_t, float>>> all_inds_dists(queries.size());
+	// Containers are sized first, because each tree keeps a reference to its cloud
+	clouds = vector<PointCloudView>(Nb);
+	trees = vector<unique_ptr<view_kd_tree_t>>(Nb);
 
-	// batch index
-	int b = 0;
-	int sum_qb = 0;
-	int sum_sb = 0;
+	// Tree parameters
+	nanoflann::KDTreeSingleIndexAdaptorParams tree_params(10 /* max leaf */);
 
-	// Nanoflann related variables
-	// ***************************
 
-	// CLoud variable
-	PointCloud current_cloud;
+	// Build the trees
+	// ***************
 
-	// Tree parameters
-	nanoflann::KDTreeSingleIndexAdaptorParams tree_params(10 /* max leaf */);
+	parallel_for(Nb, n_threads, [&](int b)
+	{
+	    if (s_batches[b] < 1)
+	        return;
 
-	// KDTree type definition
-    typedef nanoflann::KDTreeSingleIndexAdaptor< nanoflann::L2_Simple_Adaptor<float, PointCloud > ,
-                                                        PointCloud,
-                                                        3 > my_kd_tree_t;
+	    // Points of the current element of the batch
+        clouds[b] = PointCloudView(supports + s_starts[b], s_batches[b]);
 
-    // Pointer to trees
-    my_kd_tree_t* index;
+	    // Build KDTree of the current element of the batch
+        trees[b] = unique_ptr<view_kd_tree_t>(new view_kd_tree_t(3, clouds[b], tree_params));
+        trees[b]->buildIndex();
+	});
 
-    // Build KDTree for the first batch element
-    current_cloud.pts = vector<PointXYZ>(supports.begin() + sum_sb, supports.begin() + sum_sb + s_batches[b]);
-    index = new my_kd_tree_t(3, current_cloud, tree_params);
-    index->buildIndex();
+	return;
+}
 
 
-	// Search neigbors indices
-	// ***********************
+void BatchKDTrees::search_radius(const PointXYZ* queries,
+                                 vector<size_t>& q_starts,
+                                 vector<vector<pair<size_t, float>>>& all_inds_dists,
+                                 float radius,
+                                 int max_neighbors,
+                                 int n_threads)
+{
+
+	// Initialize variables
+	// ******************
+
+	// Square radius
+	float r2 = radius * radius;
+
+	// Number of batch elements
+	int Nb = (int)batch_size();
+
+	// Neighbors of each query, every batch element only writes in its own range of queries
+	all_inds_dists = vector<vector<pair<size_t, float>>>(q_starts[Nb]);
 
     // Search params
     nanoflann::SearchParams search_params;
     search_params.sorted = true;
 
-	for (auto& p0 : queries)
+
+	// Search neigbors indices
+	// ***********************
+
+	parallel_for(Nb, n_threads, [&](int b)
 	{
+	    if (!trees[b])
+	        return;
 
-	    // Check if we changed batch
-	    if (i0 == sum_qb + q_batches[b])
-	    {
-	        sum_qb += q_batches[b];
-	        sum_sb += s_batches[b];
-	        b++;
+        // Find neighbors (only the max_neighbors closest ones if a limit is given)
+        for (size_t i0 = q_starts[b]; i0 < q_starts[b + 1]; i0++)
+        {
+            float query_pt[3] = { queries[i0].x, queries[i0].y, queries[i0].z};
+            if (max_neighbors > 0)
+            {
+                KNNRadiusResultSet<float> result_set(r2, (size_t)max_neighbors, all_inds_dists[i0]);
+                trees[b]->findNeighbors(result_set, query_pt, search_params);
+            }
+            else
+                trees[b]->radiusSearch(query_pt, r2, all_inds_dists[i0], search_params);
+        }
+	});
 
-	        // Change the points
-	        current_cloud.pts.clear();
-            current_cloud.pts = vector<PointXYZ>(supports.begin() + sum_sb, supports.begin() + sum_sb + s_batches[b]);
+	return;
+}
 
-	        // Build KDTree of the current element of the batch
-            delete index;
-            index = new my_kd_tree_t(3, current_cloud, tree_params);
-            index->buildIndex();
-	    }
 
-	    // Initial guess of neighbors size
-        all_inds_dists[i0].reserve(max_count);
+template <typename IndexT>
+void BatchKDTrees::radius_neighbors(const PointXYZ* queries,
+                                    vector<int>& q_batches,
+                                    vector<IndexT>& neighbors_indices,
+                                    float radius,
+                                    int max_neighbors,
+                                    int n_threads)
+{
 
-	    // Find neighbors
-	    float query_pt[3] = { p0.x, p0.y, p0.z};
-		size_t nMatches = index->radiusSearch(query_pt, r2, all_inds_dists[i0], search_params);
+	// Initialize variables
+	// ******************
 
-        // Update max count
-        if (nMatches > max_count)
-            max_count = nMatches;
+	// Number of batch elements
+	int Nb = (int)batch_size();
 
-        // Increment query idx
-		i0++;
+	// First query index of each batch element
+	vector<size_t> q_starts(Nb + 1, 0);
+	for (int b = 0; b < Nb; b++)
+		q_starts[b + 1] = q_starts[b] + q_batches[b];
+
+	// Search neigbors indices
+	vector<vector<pair<size_t, float>>> all_inds_dists;
+	search_radius(queries, q_starts, all_inds_dists, radius, max_neighbors, n_threads);
+
+	// Maximal number of neighbors
+	size_t max_count = 0;
+	for (auto& inds_dists : all_inds_dists)
+	{
+		if (inds_dists.size() > max_count)
+			max_count = inds_dists.size();
 	}
 
+
+	// Fill the output
+	// ***************
+
 	// Reserve the memory
-	neighbors_indices.resize(queries.size() * max_count);
-	i0 = 0;
-	sum_sb = 0;
-	sum_qb = 0;
-	b = 0;
-	for (auto& inds_dists : all_inds_dists)
+	neighbors_indices.resize(q_starts[Nb] * max_count);
+
+	// Rows are filled with the global indices of the neighbors, and the shadow index n_supports after them
+	parallel_for(Nb, n_threads, [&](int b)
 	{
-	    // Check if we changed batch
-	    if (i0 == sum_qb + q_batches[b])
-	    {
-	        sum_qb += q_batches[b];
-	        sum_sb += s_batches[b];
-	        b++;
-	    }
+        for (size_t i0 = q_starts[b]; i0 < q_starts[b + 1]; i0++)
+        {
+            auto& inds_dists = all_inds_dists[i0];
+            for (size_t j = 0; j < max_count; j++)
+            {
+                if (j < inds_dists.size())
+                    neighbors_indices[i0 * max_count + j] = inds_dists[j].first + s_starts[b];
+                else
+                    neighbors_indices[i0 * max_count + j] = n_supports;
+            }
+        }
+	});
+
+	return;
+}
+
+
+template <typename IndexT>
+void BatchKDTrees::radius_neighbors_csr(const PointXYZ* queries,
+                                        vector<int>& q_batches,
+                                        vector<IndexT>& neighbors_offsets,
+                                        vector<IndexT>& neighbors_indices,
+                                        float radius,
+                                        int max_neighbors,
+                                        int n_threads)
+{
+
+	// Initialize variables
+	// ******************
+
+	// Number of batch elements
+	int Nb = (int)batch_size();
+
+	// First query index of each batch element
+	vector<size_t> q_starts(Nb + 1, 0);
+	for (int b = 0; b < Nb; b++)
+		q_starts[b + 1] = q_starts[b] + q_batches[b];
+
+	// Search neigbors indices
+	vector<vector<pair<size_t, float>>> all_inds_dists;
+	search_radius(queries, q_starts, all_inds_dists, radius, max_neighbors, n_threads);
+
+	// Offsets of the neighbors of each query in the flat indices
+	neighbors_offsets.resize(q_starts[Nb] + 1);
+	neighbors_offsets[0] = 0;
+	for (size_t i0 = 0; i0 < q_starts[Nb]; i0++)
+		neighbors_offsets[i0 + 1] = neighbors_offsets[i0] + all_inds_dists[i0].size();
 
-		for (int j = 0; j < max_count; j++)
-		{
-			if (j < inds_dists.size())
-				neighbors_indices[i0 * max_count + j] = inds_dists[j].first + sum_sb;
-			else
-				neighbors_indices[i0 * max_count + j] = supports.size();
-		}
-		i0++;
-	}
 
-	delete index;
+	// Fill the output
+	// ***************
+
+	// Reserve the memory
+	neighbors_indices.resize(neighbors_offsets.back());
+
+	// Only the real neighbors are stored, with their global indices
+	parallel_for(Nb, n_threads, [&](int b)
+	{
+        for (size_t i0 = q_starts[b]; i0 < q_starts[b + 1]; i0++)
+        {
+            IndexT* row = neighbors_indices.data() + neighbors_offsets[i0];
+            for (auto& ind_dist : all_inds_dists[i0])
+                *(row++) = ind_dist.first + s_starts[b];
+        }
+	});
 
 	return;
 }
 
+
+template <typename IndexT>
+void BatchKDTrees::knn_neighbors(const PointXYZ* queries,
+                                 vector<int>& q_batches,
+                                 IndexT* neighbors_indices,
+                                 int k,
+                                 int n_threads)
+{
+
+	// Initialize variables
+	// ******************
+
+	// Number of batch elements
+	int Nb = (int)batch_size();
+
+	// First query index of each batch element
+	vector<size_t> q_starts(Nb + 1, 0);
+	for (int b = 0; b < Nb; b++)
+		q_starts[b + 1] = q_starts[b] + q_batches[b];
+
+	// Rows of k neighbors, elements with less than k points are completed with the shadow index n_supports
+	fill(neighbors_indices, neighbors_indices + q_starts[Nb] * k, (IndexT)n_supports);
+
+
+	// Search neigbors indices
+	// ***********************
+
+	parallel_for(Nb, n_threads, [&](int b)
+	{
+	    if (!trees[b])
+	        return;
+
+        vector<size_t> inds(k);
+        vector<float> dists(k);
+        for (size_t i0 = q_starts[b]; i0 < q_starts[b + 1]; i0++)
+        {
+            float query_pt[3] = { queries[i0].x, queries[i0].y, queries[i0].z};
+            size_t n_found = trees[b]->knnSearch(query_pt, k, inds.data(), dists.data());
+            for (size_t j = 0; j < n_found; j++)
+                neighbors_indices[i0 * k + j] = (IndexT)(inds[j] + s_starts[b]);
+        }
+	});
+
+	return;
+}
+
+
+template <typename IndexT>
+void BatchKDTrees::nearest_neighbors(const PointXYZ* queries,
+                                     vector<int>& q_batches,
+                                     IndexT* neighbors_indices,
+                                     int n_threads)
+{
+	knn_neighbors(queries, q_batches, neighbors_indices, 1, n_threads);
+	return;
+}
+
+
+// Index types of the outputs
+// **************************
+
+template void BatchKDTrees::radius_neighbors(const PointXYZ*, vector<int>&, vector<int>&, float, int, int);
+template void BatchKDTrees::radius_neighbors(const PointXYZ*, vector<int>&, vector<int64_t>&, float, int, int);
+template void BatchKDTrees::radius_neighbors_csr(const PointXYZ*, vector<int>&, vector<int>&, vector<int>&, float, int, int);
+template void BatchKDTrees::radius_neighbors_csr(const PointXYZ*, vector<int>&, vector<int64_t>&, vector<int64_t>&, float,
+                                                 int, int);
+template void BatchKDTrees::knn_neighbors(const PointXYZ*, vector<int>&, int*, int, int);
+template void BatchKDTrees::knn_neighbors(const PointXYZ*, vector<int>&, int64_t*, int, int);
+template void BatchKDTrees::nearest_neighbors(const PointXYZ*, vector<int>&, int*, int);
+template void BatchKDTrees::nearest_neighbors(const PointXYZ*, vector<int>&, int64_t*, int);
+
+
+void batch_nanoflann_neighbors(const PointXYZ* queries,
+                                const PointXYZ* supports,
+                                vector<int>& q_batches,
+                                vector<int>& s_batches,
+                                vector<int>& neighbors_indices,
+                                float radius,
+                                int max_neighbors,
+                                int n_threads)
+{
+	BatchKDTrees batch_trees(supports, s_batches, n_threads);
+	batch_trees.radius_neighbors(queries, q_batches, neighbors_indices, radius, max_neighbors, n_threads);
+	return;
+}
+
+
+void batch_nanoflann_neighbors_csr(const PointXYZ* queries,
+                                    const PointXYZ* supports,
+                                    vector<int>& q_batches,
+                                    vector<int>& s_batches,
+                                    vector<int>& neighbors_offsets,
+                                    vector<int>& neighbors_indices,
+                                    float radius,
+                                    int max_neighbors,
+                                    int n_threads)
+{
+	BatchKDTrees batch_trees(supports, s_batches, n_threads);
+	batch_trees.radius_neighbors_csr(queries, q_batches, neighbors_offsets, neighbors_indices, radius, max_neighbors,
+	                                 n_threads);
+	return;
+}
+
+
+void batch_nanoflann_nearest(const PointXYZ* queries,
+                              const PointXYZ* supports,
+                              vector<int>& q_batches,
+                              vector<int>& s_batches,
+                              int* neighbors_indices,
+                              int n_threads)
+{
+	BatchKDTrees batch_trees(supports, s_batches, n_threads);
+	batch_trees.nearest_neighbors(queries, q_batches, neighbors_indices, n_threads);
+	return;
+}
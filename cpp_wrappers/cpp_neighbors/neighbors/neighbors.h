@@ -2,13 +2,60 @@
 
 #include "../../cpp_utils/cloud/cloud.h"
 #include "../../cpp_utils/nanoflann/nanoflann.hpp"
+#include "../../cpp_utils/parallel/parallel.h"
 
 #include <set>
 #include <cstdint>
+#include <memory>
 
 using namespace std;
 
 
+// Result set keeping only the max_count closest points found in the radius, ordered by distance
+template <typename DistanceType, typename IndexType = size_t>
+class KNNRadiusResultSet
+{
+public:
+
+	const DistanceType radius;
+	const size_t capacity;
+	vector<pair<IndexType, DistanceType>>& m_indices_dists;
+
+	inline KNNRadiusResultSet(DistanceType radius_, size_t capacity_, vector<pair<IndexType, DistanceType>>& indices_dists)
+		: radius(radius_), capacity(capacity_), m_indices_dists(indices_dists)
+	{
+		init();
+	}
+
+	inline void init() { m_indices_dists.clear(); m_indices_dists.reserve(capacity + 1); }
+
+	inline size_t size() const { return m_indices_dists.size(); }
+
+	inline bool full() const { return m_indices_dists.size() == capacity; }
+
+	inline bool addPoint(DistanceType dist, IndexType index)
+	{
+		if (dist < worstDist())
+		{
+			// Insert after the points at the same distance, then drop the furthest if we have too many
+			auto it = upper_bound(m_indices_dists.begin(), m_indices_dists.end(), dist,
+			                      [](DistanceType d, const pair<IndexType, DistanceType>& p) { return d < p.second; });
+			m_indices_dists.insert(it, make_pair(index, dist));
+			if (m_indices_dists.size() > capacity)
+				m_indices_dists.pop_back();
+		}
+		return true;
+	}
+
+	inline DistanceType worstDist() const
+	{
+		if (full())
+			return m_indices_dists.back().second;
+		return radius;
+	}
+};
+
+
 void ordered_neighbors(vector<PointXYZ>& queries,
                         vector<PointXYZ>& supports,
                         vector<int>& neighbors_indices,
@@ -21,9 +68,109 @@ void batch_ordered_neighbors(vector<PointXYZ>& queries,
                                 vector<int>& neighbors_indices,
                                 float radius);
 
-void batch_nanoflann_neighbors(vector<PointXYZ>& queries,
-                                vector<PointXYZ>& supports,
+// KDTree type definition
+typedef nanoflann::KDTreeSingleIndexAdaptor< nanoflann::L2_Simple_Adaptor<float, PointCloud > ,
+                                            PointCloud,
+                                            3 > my_kd_tree_t;
+
+
+// KDTree type definition for points read where they are (see PointCloudView)
+typedef nanoflann::KDTreeSingleIndexAdaptor< nanoflann::L2_Simple_Adaptor<float, PointCloudView > ,
+                                            PointCloudView,
+                                            3 > view_kd_tree_t;
+
+
+// KDTrees of every element of a batch of stacked pointclouds. They are built once and can answer several queries.
+// The support points are not copied, they must stay valid as long as the trees are used. Neighbors indices are
+// written as int or int64_t (IndexT).
+class BatchKDTrees
+{
+public:
+
+	// Elements
+	// ********
+
+	// Total number of support points (also used as shadow index)
+	size_t n_supports;
+
+	// First support index of each batch element
+	vector<size_t> s_starts;
+
+	// Points and tree of each batch element (NULL tree for empty elements)
+	vector<PointCloudView> clouds;
+	vector<unique_ptr<view_kd_tree_t>> trees;
+
+
+	// Methods
+	// *******
+
+	BatchKDTrees(const PointXYZ* supports, vector<int>& s_batches, int n_threads = 1);
+
+	size_t batch_size() const { return trees.size(); }
+
+	void search_radius(const PointXYZ* queries,
+	                   vector<size_t>& q_starts,
+	                   vector<vector<pair<size_t, float>>>& all_inds_dists,
+	                   float radius,
+	                   int max_neighbors = 0,
+	                   int n_threads = 1);
+
+	template <typename IndexT>
+	void radius_neighbors(const PointXYZ* queries,
+	                      vector<int>& q_batches,
+	                      vector<IndexT>& neighbors_indices,
+	                      float radius,
+	                      int max_neighbors = 0,
+	                      int n_threads = 1);
+
+	// Same neighbors without padding: the neighbors of query i are neighbors_indices[offsets[i]:offsets[i + 1]]
+	template <typename IndexT>
+	void radius_neighbors_csr(const PointXYZ* queries,
+	                          vector<int>& q_batches,
+	                          vector<IndexT>& neighbors_offsets,
+	                          vector<IndexT>& neighbors_indices,
+	                          float radius,
+	                          int max_neighbors = 0,
+	                          int n_threads = 1);
+
+	// The number of neighbors is known in advance, so they are written in a buffer of (n_queries * k) indices
+	template <typename IndexT>
+	void knn_neighbors(const PointXYZ* queries,
+	                   vector<int>& q_batches,
+	                   IndexT* neighbors_indices,
+	                   int k,
+	                   int n_threads = 1);
+
+	template <typename IndexT>
+	void nearest_neighbors(const PointXYZ* queries,
+	                       vector<int>& q_batches,
+	                       IndexT* neighbors_indices,
+	                       int n_threads = 1);
+};
+
+
+void batch_nanoflann_neighbors(const PointXYZ* queries,
+                                const PointXYZ* supports,
                                 vector<int>& q_batches,
                                 vector<int>& s_batches,
                                 vector<int>& neighbors_indices,
-                                float radius);
+                                float radius,
+                                int max_neighbors = 0,
+                                int n_threads = 1);
+
+void batch_nanoflann_neighbors_csr(const PointXYZ* queries,
+                                    const PointXYZ* supports,
+                                    vector<int>& q_batches,
+                                    vector<int>& s_batches,
+                                    vector<int>& neighbors_offsets,
+                                    vector<int>& neighbors_indices,
+                                    float radius,
+                                    int max_neighbors = 0,
+                                    int n_threads = 1);
+
+void batch_nanoflann_nearest(const PointXYZ* queries,
+                              const PointXYZ* supports,
+                              vector<int>& q_batches,
+                              vector<int>& s_batches,
+                              int* neighbors_indices,
+                              int n_threads = 1);
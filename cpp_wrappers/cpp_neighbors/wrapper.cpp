@@ -1,6 +1,7 @@
 #include <Python.h>
 #include <numpy/arrayobject.h>
 #include "neighbors/neighbors.h"
+#include "../cpp_utils/arrays/arrays.h"
 #include <string>
 
 
@@ -8,15 +9,29 @@
 // docstrings for our module
 // *************************
 
-static char module_docstring[] = "This module provides two methods to compute radius neighbors from pointclouds or batch of pointclouds";
+static char module_docstring[] = "This module provides methods to compute radius or nearest neighbors in batches of pointclouds";
 
-static char batch_query_docstring[] = "Method to get radius neighbors in a batch of stacked pointclouds";
+static char batch_query_docstring[] = "Method to get radius neighbors in a batch of stacked pointclouds. Only the max_neighbors closest neighbors are kept (max_neighbors < 1 keeps them all). Batch elements are processed concurrently on n_threads threads (n_threads < 1 uses all cores). With csr=True, returns the ragged neighbors (offsets, indices) instead of a matrix padded with the shadow index. The indices are int32, or int64 with dtype=np.int64";
+
+static char batch_nearest_docstring[] = "Method to get the nearest neighbor of each query in a batch of stacked pointclouds, as a (N, 1) matrix of int32 (or int64 with dtype=np.int64)";
+
+static char batch_knn_docstring[] = "Method to get the k nearest neighbors of each query in a batch of stacked pointclouds, as a (N, k) matrix of int32 (or int64 with dtype=np.int64), completed with the shadow index when a batch element has less than k points";
+
+static char batch_tree_docstring[] = "BatchTree(supports, s_batches, n_threads=1): KDTrees of a batch of stacked pointclouds, built once and reused for several radius, knn or nearest neighbor queries";
+
+static char tree_radius_query_docstring[] = "radius_query(queries, q_batches, radius=0.1, max_neighbors=0, n_threads=1, csr=False, dtype=np.int32): same as batch_query, against the trees of the supports";
+
+static char tree_knn_query_docstring[] = "knn_query(queries, q_batches, k=1, n_threads=1, dtype=np.int32): (N, k) matrix of the k nearest neighbors, completed with the shadow index when a batch element has less than k points";
+
+static char tree_nearest_docstring[] = "nearest(queries, q_batches, n_threads=1, dtype=np.int32): same as batch_nearest, against the trees of the supports";
 
 
 // Declare the functions
 // *********************
 
 static PyObject *batch_neighbors(PyObject *self, PyObject *args, PyObject *keywds);
+static PyObject *batch_nearest(PyObject *self, PyObject *args, PyObject *keywds);
+static PyObject *batch_knn(PyObject *self, PyObject *args, PyObject *keywds);
 
 
 // Specify the members of the module
@@ -25,6 +40,8 @@ static PyObject *batch_neighbors(PyObject *self, PyObject *args, PyObject *keywd
 static PyMethodDef module_methods[] = 
 {
 	{ "batch_query", (PyCFunction)batch_neighbors, METH_VARARGS | METH_KEYWORDS, batch_query_docstring },
+	{ "batch_nearest", (PyCFunction)batch_nearest, METH_VARARGS | METH_KEYWORDS, batch_nearest_docstring },
+	{ "batch_knn", (PyCFunction)batch_knn, METH_VARARGS | METH_KEYWORDS, batch_knn_docstring },
 	{NULL, NULL, 0, NULL}
 };
 
@@ -45,134 +62,388 @@ static struct PyModuleDef moduledef =
     NULL,                   // m_free
 };
 
-PyMODINIT_FUNC PyInit_radius_neighbors(void)
+// Python type holding the trees of a batch
+// ****************************************
+
+// The trees read the support points in their numpy array, which is kept alive with them
+typedef struct
 {
-    import_array();
-	return PyModule_Create(&moduledef);
-}
+	PyObject_HEAD
+	BatchKDTrees* batch_trees;
+	PyObject* supports_array;
+} BatchTreeObject;
+
+static int BatchTree_init(BatchTreeObject* self, PyObject* args, PyObject* keywds);
+static void BatchTree_dealloc(BatchTreeObject* self);
+static PyObject* BatchTree_radius_query(BatchTreeObject* self, PyObject* args, PyObject* keywds);
+static PyObject* BatchTree_knn_query(BatchTreeObject* self, PyObject* args, PyObject* keywds);
+static PyObject* BatchTree_nearest(BatchTreeObject* self, PyObject* args, PyObject* keywds);
+
+static PyMethodDef BatchTree_methods[] =
+{
+	{ "radius_query", (PyCFunction)BatchTree_radius_query, METH_VARARGS | METH_KEYWORDS, tree_radius_query_docstring },
+	{ "knn_query", (PyCFunction)BatchTree_knn_query, METH_VARARGS | METH_KEYWORDS, tree_knn_query_docstring },
+	{ "nearest", (PyCFunction)BatchTree_nearest, METH_VARARGS | METH_KEYWORDS, tree_nearest_docstring },
+	{NULL, NULL, 0, NULL}
+};
 
+static PyType_Slot BatchTree_slots[] =
+{
+	{ Py_tp_doc, (void*)batch_tree_docstring },
+	{ Py_tp_new, (void*)PyType_GenericNew },
+	{ Py_tp_init, (void*)BatchTree_init },
+	{ Py_tp_dealloc, (void*)BatchTree_dealloc },
+	{ Py_tp_methods, (void*)BatchTree_methods },
+	{ 0, NULL }
+};
 
-// Definition of the batch_subsample method
-// **********************************
+static PyType_Spec BatchTree_spec =
+{
+	"radius_neighbors.BatchTree",   // name
+	sizeof(BatchTreeObject),        // basicsize
+	0,                              // itemsize
+	Py_TPFLAGS_DEFAULT,             // flags
+	BatchTree_slots                 // slots
+};
 
-static PyObject* batch_neighbors(PyObject* self, PyObject* args, PyObject* keywds)
+PyMODINIT_FUNC PyInit_radius_neighbors(void)
 {
+    import_array();
 
-	// Manage inputs
-	// *************
+	PyObject* m = PyModule_Create(&moduledef);
+	if (m == NULL)
+		return NULL;
 
-	// Args containers
-	PyObject* queries_obj = NULL;
-	PyObject* supports_obj = NULL;
-	PyObject* q_batches_obj = NULL;
-	PyObject* s_batches_obj = NULL;
+	// Add the BatchTree type to the module
+	PyObject* batch_tree_type = PyType_FromSpec(&BatchTree_spec);
+	if (batch_tree_type == NULL || PyModule_AddObject(m, "BatchTree", batch_tree_type) < 0)
+	{
+		Py_XDECREF(batch_tree_type);
+		Py_DECREF(m);
+		return NULL;
+	}
 
-	// Keywords containers
-	static char* kwlist[] = { "queries", "supports", "q_batches", "s_batches", "radius", NULL };
-	float radius = 0.1;
+	return m;
+}
 
-	// Parse the input  
-	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OOOO|$f", kwlist, &queries_obj, &supports_obj, &q_batches_obj, &s_batches_obj, &radius))
+
+// Conversion and checks of the inputs shared by all batch methods
+// ***************************************************************
+
+static PyObject* load_points_array(PyObject* points_obj, const char* name)
+{
+	// Interpret the input object as a numpy array
+	PyObject* points_array = PyArray_FROM_OTF(points_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	if (points_array == NULL)
 	{
-		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		PyErr_Format(PyExc_RuntimeError, "Error converting %s points to numpy arrays of type float32", name);
 		return NULL;
 	}
 
+	// Check that the input array respect the dims
+	if ((int)PyArray_NDIM(points_array) != 2 || (int)PyArray_DIM(points_array, 1) != 3)
+	{
+		Py_XDECREF(points_array);
+		PyErr_Format(PyExc_RuntimeError, "Wrong dimensions : %s.shape is not (N, 3)", name);
+		return NULL;
+	}
 
-	// Interpret the input objects as numpy arrays.
-	PyObject* queries_array = PyArray_FROM_OTF(queries_obj, NPY_FLOAT, NPY_IN_ARRAY);
-	PyObject* supports_array = PyArray_FROM_OTF(supports_obj, NPY_FLOAT, NPY_IN_ARRAY);
-	PyObject* q_batches_array = PyArray_FROM_OTF(q_batches_obj, NPY_INT, NPY_IN_ARRAY);
-	PyObject* s_batches_array = PyArray_FROM_OTF(s_batches_obj, NPY_INT, NPY_IN_ARRAY);
+	return points_array;
+}
 
-	// Verify data was load correctly.
-	if (queries_array == NULL)
+static PyObject* load_batches_array(PyObject* batches_obj, const char* name)
+{
+	// Interpret the input object as a numpy array
+	PyObject* batches_array = PyArray_FROM_OTF(batches_obj, NPY_INT, NPY_IN_ARRAY);
+	if (batches_array == NULL)
 	{
-		Py_XDECREF(queries_array);
-		Py_XDECREF(supports_array);
-		Py_XDECREF(q_batches_array);
-		Py_XDECREF(s_batches_array);
-		PyErr_SetString(PyExc_RuntimeError, "Error converting query points to numpy arrays of type float32");
+		PyErr_Format(PyExc_RuntimeError, "Error converting %s batches to numpy arrays of type int32", name);
 		return NULL;
 	}
-	if (supports_array == NULL)
+
+	// Check that the input array respect the dims
+	if ((int)PyArray_NDIM(batches_array) > 1)
 	{
-		Py_XDECREF(queries_array);
-		Py_XDECREF(supports_array);
-		Py_XDECREF(q_batches_array);
-		Py_XDECREF(s_batches_array);
-		PyErr_SetString(PyExc_RuntimeError, "Error converting support points to numpy arrays of type float32");
+		Py_XDECREF(batches_array);
+		PyErr_Format(PyExc_RuntimeError, "Wrong dimensions : %s_batches.shape is not (B,) ", name);
 		return NULL;
 	}
-	if (q_batches_array == NULL)
+
+	return batches_array;
+}
+
+static bool check_batch_lengths(PyObject* batches_array, PyObject* points_array, const char* name)
+{
+	int* batches = (int*)PyArray_DATA(batches_array);
+	if (accumulate(batches, batches + PyArray_SIZE(batches_array), (long long)0) != PyArray_DIM(points_array, 0))
 	{
-		Py_XDECREF(queries_array);
-		Py_XDECREF(supports_array);
-		Py_XDECREF(q_batches_array);
-		Py_XDECREF(s_batches_array);
-		PyErr_SetString(PyExc_RuntimeError, "Error converting query batches to numpy arrays of type int32");
-		return NULL;
+		PyErr_Format(PyExc_RuntimeError, "Wrong batch lengths : the sum of %s batches is not the number of points", name);
+		return false;
 	}
+	return true;
+}
+
+static bool load_batch_arrays(PyObject* queries_obj,
+                              PyObject* supports_obj,
+                              PyObject* q_batches_obj,
+                              PyObject* s_batches_obj,
+                              PyObject*& queries_array,
+                              PyObject*& supports_array,
+                              PyObject*& q_batches_array,
+                              PyObject*& s_batches_array)
+{
+	// Interpret the input objects as numpy arrays.
+	queries_array = load_points_array(queries_obj, "query");
+	supports_array = queries_array ? load_points_array(supports_obj, "support") : NULL;
+	q_batches_array = supports_array ? load_batches_array(q_batches_obj, "queries") : NULL;
+	s_batches_array = q_batches_array ? load_batches_array(s_batches_obj, "supports") : NULL;
+
+	// Verify data was load correctly.
 	if (s_batches_array == NULL)
 	{
 		Py_XDECREF(queries_array);
 		Py_XDECREF(supports_array);
 		Py_XDECREF(q_batches_array);
-		Py_XDECREF(s_batches_array);
-		PyErr_SetString(PyExc_RuntimeError, "Error converting support batches to numpy arrays of type int32");
-		return NULL;
+		return false;
 	}
 
-	// Check that the input array respect the dims
-	if ((int)PyArray_NDIM(queries_array) != 2 || (int)PyArray_DIM(queries_array, 1) != 3)
+	// Check that the batches match
+	if ((int)PyArray_DIM(q_batches_array, 0) != (int)PyArray_DIM(s_batches_array, 0))
 	{
 		Py_XDECREF(queries_array);
 		Py_XDECREF(supports_array);
 		Py_XDECREF(q_batches_array);
 		Py_XDECREF(s_batches_array);
-		PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : query.shape is not (N, 3)");
-		return NULL;
+		PyErr_SetString(PyExc_RuntimeError, "Wrong number of batch elements: different for queries and supports ");
+		return false;
 	}
-	if ((int)PyArray_NDIM(supports_array) != 2 || (int)PyArray_DIM(supports_array, 1) != 3)
+
+	// Check the batch lengths, the points are read in place
+	if (!check_batch_lengths(q_batches_array, queries_array, "queries") ||
+	    !check_batch_lengths(s_batches_array, supports_array, "supports"))
 	{
 		Py_XDECREF(queries_array);
 		Py_XDECREF(supports_array);
 		Py_XDECREF(q_batches_array);
 		Py_XDECREF(s_batches_array);
-		PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : support.shape is not (N, 3)");
-		return NULL;
+		return false;
 	}
-	if ((int)PyArray_NDIM(q_batches_array) > 1)
+
+	return true;
+}
+
+
+// Conversion of the outputs
+// *************************
+
+// The radius neighbors are only counted during the search, so the arrays take over the buffers of the results
+template <typename IndexT>
+static PyObject* neighbors_to_array(vector<IndexT>& neighbors_indices, npy_intp Nq, npy_intp n_cols)
+{
+	npy_intp neighbors_dims[2] = { Nq, n_cols };
+	return vector_to_array(neighbors_indices, 2, neighbors_dims, index_typenum<IndexT>());
+}
+
+template <typename IndexT>
+static PyObject* csr_to_arrays(vector<IndexT>& neighbors_offsets, vector<IndexT>& neighbors_indices)
+{
+	npy_intp offsets_dims[1] = { (npy_intp)neighbors_offsets.size() };
+	npy_intp indices_dims[1] = { (npy_intp)neighbors_indices.size() };
+	PyObject* offsets_obj = vector_to_array(neighbors_offsets, 1, offsets_dims, index_typenum<IndexT>());
+	PyObject* indices_obj = vector_to_array(neighbors_indices, 1, indices_dims, index_typenum<IndexT>());
+	if (offsets_obj == NULL || indices_obj == NULL)
 	{
-		Py_XDECREF(queries_array);
-		Py_XDECREF(supports_array);
-		Py_XDECREF(q_batches_array);
-		Py_XDECREF(s_batches_array);
-		PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : queries_batches.shape is not (B,) ");
+		Py_XDECREF(offsets_obj);
+		Py_XDECREF(indices_obj);
 		return NULL;
 	}
-	if ((int)PyArray_NDIM(s_batches_array) > 1)
+
+	// Merge results
+	return Py_BuildValue("NN", offsets_obj, indices_obj);
+}
+
+
+// Queries shared by the module functions and the BatchTree methods
+// ****************************************************************
+
+// Radius neighbors, as a padded matrix or as ragged (offsets, indices) arrays
+template <typename IndexT>
+static PyObject* radius_query(BatchKDTrees& batch_trees,
+                              const PointXYZ* queries,
+                              vector<int>& q_batches,
+                              npy_intp Nq,
+                              float radius,
+                              int max_neighbors,
+                              int n_threads,
+                              bool csr)
+{
+	vector<IndexT> neighbors_indices;
+
+	// Ragged output: offsets and indices of the real neighbors only
+	if (csr)
 	{
-		Py_XDECREF(queries_array);
-		Py_XDECREF(supports_array);
-		Py_XDECREF(q_batches_array);
-		Py_XDECREF(s_batches_array);
-		PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : supports_batches.shape is not (B,) ");
+		vector<IndexT> neighbors_offsets;
+		Py_BEGIN_ALLOW_THREADS
+		batch_trees.radius_neighbors_csr(queries, q_batches, neighbors_offsets, neighbors_indices, radius,
+		                                 max_neighbors, n_threads);
+		Py_END_ALLOW_THREADS
+		return csr_to_arrays(neighbors_offsets, neighbors_indices);
+	}
+
+	// Compute results (without the GIL, so that other python threads can run meanwhile)
+	Py_BEGIN_ALLOW_THREADS
+	batch_trees.radius_neighbors(queries, q_batches, neighbors_indices, radius, max_neighbors, n_threads);
+	Py_END_ALLOW_THREADS
+
+	// Maximal number of neighbors
+	npy_intp max_count = Nq > 0 ? neighbors_indices.size() / Nq : 0;
+
+	return neighbors_to_array(neighbors_indices, Nq, max_count);
+}
+
+// The k nearest neighbors are written directly in a (Nq, k) output array
+template <typename IndexT>
+static PyObject* knn_query(BatchKDTrees& batch_trees,
+                           const PointXYZ* queries,
+                           vector<int>& q_batches,
+                           npy_intp Nq,
+                           int k,
+                           int n_threads)
+{
+	npy_intp neighbors_dims[2] = { Nq, k };
+	PyObject* res_obj = PyArray_SimpleNew(2, neighbors_dims, index_typenum<IndexT>());
+	if (res_obj == NULL)
+		return NULL;
+	IndexT* neighbors_indices = (IndexT*)PyArray_DATA(res_obj);
+
+	// Compute results (without the GIL, so that other python threads can run meanwhile)
+	Py_BEGIN_ALLOW_THREADS
+	batch_trees.knn_neighbors(queries, q_batches, neighbors_indices, k, n_threads);
+	Py_END_ALLOW_THREADS
+
+	return res_obj;
+}
+
+
+// Definition of the batch_query method
+// **********************************
+
+static PyObject* batch_neighbors(PyObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	// Args containers
+	PyObject* queries_obj = NULL;
+	PyObject* supports_obj = NULL;
+	PyObject* q_batches_obj = NULL;
+	PyObject* s_batches_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "queries", "supports", "q_batches", "s_batches", "radius", "max_neighbors", "n_threads", "csr", "dtype", NULL };
+	float radius = 0.1;
+	int max_neighbors = 0;
+	int n_threads = 1;
+	int csr = 0;
+	int typenum = NPY_INT32;
+
+	// Parse the input  
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OOOO|$fiipO&", kwlist, &queries_obj, &supports_obj, &q_batches_obj, &s_batches_obj, &radius, &max_neighbors, &n_threads, &csr, index_dtype_converter, &typenum))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
 		return NULL;
 	}
-	if ((int)PyArray_DIM(q_batches_array, 0) != (int)PyArray_DIM(s_batches_array, 0))
+
+
+	// Interpret the input objects as numpy arrays and check their dimensions
+	PyObject* queries_array = NULL;
+	PyObject* supports_array = NULL;
+	PyObject* q_batches_array = NULL;
+	PyObject* s_batches_array = NULL;
+	if (!load_batch_arrays(queries_obj, supports_obj, q_batches_obj, s_batches_obj,
+	                       queries_array, supports_array, q_batches_array, s_batches_array))
+		return NULL;
+
+	// Number of points
+	int Nq = (int)PyArray_DIM(queries_array, 0);
+
+	// Number of batches
+	int Nb = (int)PyArray_DIM(q_batches_array, 0);
+
+	// Call the C++ function
+	// *********************
+
+	// The points are read in place, only the batch lengths are copied
+	const PointXYZ* queries = (PointXYZ*)PyArray_DATA(queries_array);
+	const PointXYZ* supports = (PointXYZ*)PyArray_DATA(supports_array);
+	vector<int> q_batches((int*)PyArray_DATA(q_batches_array), (int*)PyArray_DATA(q_batches_array) + Nb);
+	vector<int> s_batches((int*)PyArray_DATA(s_batches_array), (int*)PyArray_DATA(s_batches_array) + Nb);
+
+	// Build the trees (without the GIL, so that other python threads can run meanwhile)
+	BatchKDTrees* batch_trees;
+	Py_BEGIN_ALLOW_THREADS
+	batch_trees = new BatchKDTrees(supports, s_batches, n_threads);
+	Py_END_ALLOW_THREADS
+
+	// Search the neighbors, with indices of the required type
+	PyObject* ret = NULL;
+	if (typenum == NPY_INT64)
+		ret = radius_query<int64_t>(*batch_trees, queries, q_batches, Nq, radius, max_neighbors, n_threads, csr);
+	else
+		ret = radius_query<int>(*batch_trees, queries, q_batches, Nq, radius, max_neighbors, n_threads, csr);
+
+	// Clean up
+	// ********
+
+	delete batch_trees;
+	Py_XDECREF(queries_array);
+	Py_XDECREF(supports_array);
+	Py_XDECREF(q_batches_array);
+	Py_XDECREF(s_batches_array);
+
+	return ret;
+}
+
+
+// Definition of the batch_nearest method
+// **************************************
+
+static PyObject* batch_nearest(PyObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	// Args containers
+	PyObject* queries_obj = NULL;
+	PyObject* supports_obj = NULL;
+	PyObject* q_batches_obj = NULL;
+	PyObject* s_batches_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "queries", "supports", "q_batches", "s_batches", "n_threads", "dtype", NULL };
+	int n_threads = 1;
+	int typenum = NPY_INT32;
+
+	// Parse the input  
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OOOO|$iO&", kwlist, &queries_obj, &supports_obj, &q_batches_obj, &s_batches_obj, &n_threads, index_dtype_converter, &typenum))
 	{
-		Py_XDECREF(queries_array);
-		Py_XDECREF(supports_array);
-		Py_XDECREF(q_batches_array);
-		Py_XDECREF(s_batches_array);
-		PyErr_SetString(PyExc_RuntimeError, "Wrong number of batch elements: different for queries and supports ");
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
 		return NULL;
 	}
 
+	// Interpret the input objects as numpy arrays and check their dimensions
+	PyObject* queries_array = NULL;
+	PyObject* supports_array = NULL;
+	PyObject* q_batches_array = NULL;
+	PyObject* s_batches_array = NULL;
+	if (!load_batch_arrays(queries_obj, supports_obj, q_batches_obj, s_batches_obj,
+	                       queries_array, supports_array, q_batches_array, s_batches_array))
+		return NULL;
+
 	// Number of points
 	int Nq = (int)PyArray_DIM(queries_array, 0);
-	int Ns= (int)PyArray_DIM(supports_array, 0);
 
 	// Number of batches
 	int Nb = (int)PyArray_DIM(q_batches_array, 0);
@@ -180,59 +451,353 @@ static PyObject* batch_neighbors(PyObject* self, PyObject* args, PyObject* keywd
 	// Call the C++ function
 	// *********************
 
-	// Convert PyArray to Cloud C++ class
-	vector<PointXYZ> queries;
-	vector<PointXYZ> supports;
-	vector<int> q_batches;
-	vector<int> s_batches;
-	queries = vector<PointXYZ>((PointXYZ*)PyArray_DATA(queries_array), (PointXYZ*)PyArray_DATA(queries_array) + Nq);
-	supports = vector<PointXYZ>((PointXYZ*)PyArray_DATA(supports_array), (PointXYZ*)PyArray_DATA(supports_array) + Ns);
-	q_batches = vector<int>((int*)PyArray_DATA(q_batches_array), (int*)PyArray_DATA(q_batches_array) + Nb);
-	s_batches = vector<int>((int*)PyArray_DATA(s_batches_array), (int*)PyArray_DATA(s_batches_array) + Nb);
+	// The points are read in place, only the batch lengths are copied
+	const PointXYZ* queries = (PointXYZ*)PyArray_DATA(queries_array);
+	const PointXYZ* supports = (PointXYZ*)PyArray_DATA(supports_array);
+	vector<int> q_batches((int*)PyArray_DATA(q_batches_array), (int*)PyArray_DATA(q_batches_array) + Nb);
+	vector<int> s_batches((int*)PyArray_DATA(s_batches_array), (int*)PyArray_DATA(s_batches_array) + Nb);
+
+	// Build the trees (without the GIL, so that other python threads can run meanwhile)
+	BatchKDTrees* batch_trees;
+	Py_BEGIN_ALLOW_THREADS
+	batch_trees = new BatchKDTrees(supports, s_batches, n_threads);
+	Py_END_ALLOW_THREADS
+
+	// Nearest neighbor of each query, with indices of the required type
+	PyObject* res_obj = NULL;
+	if (typenum == NPY_INT64)
+		res_obj = knn_query<int64_t>(*batch_trees, queries, q_batches, Nq, 1, n_threads);
+	else
+		res_obj = knn_query<int>(*batch_trees, queries, q_batches, Nq, 1, n_threads);
+
+	// Clean up
+	// ********
+
+	delete batch_trees;
+	Py_XDECREF(queries_array);
+	Py_XDECREF(supports_array);
+	Py_XDECREF(q_batches_array);
+	Py_XDECREF(s_batches_array);
+
+	return res_obj;
+}
+
+
+// Definition of the batch_knn method
+// **********************************
 
-	// Create result containers
-	vector<int> neighbors_indices;
+static PyObject* batch_knn(PyObject* self, PyObject* args, PyObject* keywds)
+{
 
-	// Compute results
-	//batch_ordered_neighbors(queries, supports, q_batches, s_batches, neighbors_indices, radius);
-	batch_nanoflann_neighbors(queries, supports, q_batches, s_batches, neighbors_indices, radius);
+	// Manage inputs
+	// *************
 
-	// Check result
-	if (neighbors_indices.size() < 1)
+	// Args containers
+	PyObject* queries_obj = NULL;
+	PyObject* supports_obj = NULL;
+	PyObject* q_batches_obj = NULL;
+	PyObject* s_batches_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "queries", "supports", "q_batches", "s_batches", "k", "n_threads", "dtype", NULL };
+	int k = 1;
+	int n_threads = 1;
+	int typenum = NPY_INT32;
+
+	// Parse the input  
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OOOO|$iiO&", kwlist, &queries_obj, &supports_obj, &q_batches_obj, &s_batches_obj, &k, &n_threads, index_dtype_converter, &typenum))
 	{
-		PyErr_SetString(PyExc_RuntimeError, "Error");
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
 		return NULL;
 	}
 
-	// Manage outputs
-	// **************
+	if (k < 1)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Wrong number of neighbors : k should be at least 1");
+		return NULL;
+	}
 
-	// Maximal number of neighbors
-	int max_neighbors = neighbors_indices.size() / Nq;
+	// Interpret the input objects as numpy arrays and check their dimensions
+	PyObject* queries_array = NULL;
+	PyObject* supports_array = NULL;
+	PyObject* q_batches_array = NULL;
+	PyObject* s_batches_array = NULL;
+	if (!load_batch_arrays(queries_obj, supports_obj, q_batches_obj, s_batches_obj,
+	                       queries_array, supports_array, q_batches_array, s_batches_array))
+		return NULL;
 
-	// Dimension of output containers
-	npy_intp* neighbors_dims = new npy_intp[2];
-	neighbors_dims[0] = Nq;
-	neighbors_dims[1] = max_neighbors;
+	// Number of points
+	int Nq = (int)PyArray_DIM(queries_array, 0);
 
-	// Create output array
-	PyObject* res_obj = PyArray_SimpleNew(2, neighbors_dims, NPY_INT);
-	PyObject* ret = NULL;
+	// Number of batches
+	int Nb = (int)PyArray_DIM(q_batches_array, 0);
 
-	// Fill output array with values
-	size_t size_in_bytes = Nq * max_neighbors * sizeof(int);
-	memcpy(PyArray_DATA(res_obj), neighbors_indices.data(), size_in_bytes);
+	// Call the C++ function
+	// *********************
 
-	// Merge results
-	ret = Py_BuildValue("N", res_obj);
+	// The points are read in place, only the batch lengths are copied
+	const PointXYZ* queries = (PointXYZ*)PyArray_DATA(queries_array);
+	const PointXYZ* supports = (PointXYZ*)PyArray_DATA(supports_array);
+	vector<int> q_batches((int*)PyArray_DATA(q_batches_array), (int*)PyArray_DATA(q_batches_array) + Nb);
+	vector<int> s_batches((int*)PyArray_DATA(s_batches_array), (int*)PyArray_DATA(s_batches_array) + Nb);
+
+	// Build the trees (without the GIL, so that other python threads can run meanwhile)
+	BatchKDTrees* batch_trees;
+	Py_BEGIN_ALLOW_THREADS
+	batch_trees = new BatchKDTrees(supports, s_batches, n_threads);
+	Py_END_ALLOW_THREADS
+
+	// k nearest neighbors of each query, with indices of the required type
+	PyObject* res_obj = NULL;
+	if (typenum == NPY_INT64)
+		res_obj = knn_query<int64_t>(*batch_trees, queries, q_batches, Nq, k, n_threads);
+	else
+		res_obj = knn_query<int>(*batch_trees, queries, q_batches, Nq, k, n_threads);
 
 	// Clean up
 	// ********
 
+	delete batch_trees;
 	Py_XDECREF(queries_array);
 	Py_XDECREF(supports_array);
 	Py_XDECREF(q_batches_array);
 	Py_XDECREF(s_batches_array);
 
-	return ret;
+	return res_obj;
+}
+
+
+// Definition of the BatchTree methods
+// ***********************************
+
+static int BatchTree_init(BatchTreeObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	// Args containers
+	PyObject* supports_obj = NULL;
+	PyObject* s_batches_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "supports", "s_batches", "n_threads", NULL };
+	int n_threads = 1;
+
+	// Parse the input  
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$i", kwlist, &supports_obj, &s_batches_obj, &n_threads))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return -1;
+	}
+
+	// Interpret the input objects as numpy arrays and check their dimensions
+	PyObject* supports_array = load_points_array(supports_obj, "support");
+	if (supports_array == NULL)
+		return -1;
+	PyObject* s_batches_array = load_batches_array(s_batches_obj, "supports");
+	if (s_batches_array == NULL)
+	{
+		Py_XDECREF(supports_array);
+		return -1;
+	}
+
+	// Check the batch lengths
+	if (!check_batch_lengths(s_batches_array, supports_array, "supports"))
+	{
+		Py_XDECREF(supports_array);
+		Py_XDECREF(s_batches_array);
+		return -1;
+	}
+
+	// Number of batches
+	int Nb = (int)PyArray_DIM(s_batches_array, 0);
+
+	// The trees are built over the support array (kept by the object), only the batch lengths are copied
+	const PointXYZ* supports = (PointXYZ*)PyArray_DATA(supports_array);
+	vector<int> s_batches((int*)PyArray_DATA(s_batches_array), (int*)PyArray_DATA(s_batches_array) + Nb);
+	Py_XDECREF(s_batches_array);
+
+	// Build the trees (without the GIL, so that other python threads can run meanwhile)
+	BatchKDTrees* batch_trees;
+	Py_BEGIN_ALLOW_THREADS
+	batch_trees = new BatchKDTrees(supports, s_batches, n_threads);
+	Py_END_ALLOW_THREADS
+
+	delete self->batch_trees;
+	Py_XDECREF(self->supports_array);
+	self->batch_trees = batch_trees;
+	self->supports_array = supports_array;
+
+	return 0;
+}
+
+static void BatchTree_dealloc(BatchTreeObject* self)
+{
+	PyTypeObject* tp = Py_TYPE(self);
+	delete self->batch_trees;
+	Py_XDECREF(self->supports_array);
+	tp->tp_free((PyObject*)self);
+	Py_DECREF(tp);
+}
+
+// On success, the queries array must be released by the caller once the queries are done
+static bool load_tree_queries(BatchTreeObject* self,
+                              PyObject* queries_obj,
+                              PyObject* q_batches_obj,
+                              PyObject*& queries_array,
+                              vector<int>& q_batches)
+{
+	if (self->batch_trees == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "BatchTree was not initialized");
+		return false;
+	}
+
+	// Interpret the input objects as numpy arrays and check their dimensions
+	queries_array = load_points_array(queries_obj, "query");
+	if (queries_array == NULL)
+		return false;
+	PyObject* q_batches_array = load_batches_array(q_batches_obj, "queries");
+	if (q_batches_array == NULL)
+	{
+		Py_XDECREF(queries_array);
+		return false;
+	}
+
+	// Check the batches against the trees
+	if ((size_t)PyArray_DIM(q_batches_array, 0) != self->batch_trees->batch_size())
+	{
+		Py_XDECREF(queries_array);
+		Py_XDECREF(q_batches_array);
+		PyErr_SetString(PyExc_RuntimeError, "Wrong number of batch elements: different for queries and supports ");
+		return false;
+	}
+	if (!check_batch_lengths(q_batches_array, queries_array, "queries"))
+	{
+		Py_XDECREF(queries_array);
+		Py_XDECREF(q_batches_array);
+		return false;
+	}
+
+	// Only the batch lengths are copied, the query points are read in place
+	int Nb = (int)PyArray_DIM(q_batches_array, 0);
+	q_batches = vector<int>((int*)PyArray_DATA(q_batches_array), (int*)PyArray_DATA(q_batches_array) + Nb);
+	Py_XDECREF(q_batches_array);
+
+	return true;
+}
+
+static PyObject* BatchTree_radius_query(BatchTreeObject* self, PyObject* args, PyObject* keywds)
+{
+	// Args containers
+	PyObject* queries_obj = NULL;
+	PyObject* q_batches_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "queries", "q_batches", "radius", "max_neighbors", "n_threads", "csr", "dtype", NULL };
+	float radius = 0.1;
+	int max_neighbors = 0;
+	int n_threads = 1;
+	int csr = 0;
+	int typenum = NPY_INT32;
+
+	// Parse the input  
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$fiipO&", kwlist, &queries_obj, &q_batches_obj, &radius, &max_neighbors, &n_threads, &csr, index_dtype_converter, &typenum))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+
+	PyObject* queries_array = NULL;
+	vector<int> q_batches;
+	if (!load_tree_queries(self, queries_obj, q_batches_obj, queries_array, q_batches))
+		return NULL;
+	const PointXYZ* queries = (PointXYZ*)PyArray_DATA(queries_array);
+	npy_intp Nq = PyArray_DIM(queries_array, 0);
+
+	PyObject* res_obj = NULL;
+	if (typenum == NPY_INT64)
+		res_obj = radius_query<int64_t>(*self->batch_trees, queries, q_batches, Nq, radius, max_neighbors, n_threads, csr);
+	else
+		res_obj = radius_query<int>(*self->batch_trees, queries, q_batches, Nq, radius, max_neighbors, n_threads, csr);
+
+	Py_XDECREF(queries_array);
+	return res_obj;
+}
+
+static PyObject* BatchTree_knn_query(BatchTreeObject* self, PyObject* args, PyObject* keywds)
+{
+	// Args containers
+	PyObject* queries_obj = NULL;
+	PyObject* q_batches_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "queries", "q_batches", "k", "n_threads", "dtype", NULL };
+	int k = 1;
+	int n_threads = 1;
+	int typenum = NPY_INT32;
+
+	// Parse the input  
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$iiO&", kwlist, &queries_obj, &q_batches_obj, &k, &n_threads, index_dtype_converter, &typenum))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+	if (k < 1)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Wrong number of neighbors : k should be at least 1");
+		return NULL;
+	}
+
+	PyObject* queries_array = NULL;
+	vector<int> q_batches;
+	if (!load_tree_queries(self, queries_obj, q_batches_obj, queries_array, q_batches))
+		return NULL;
+	const PointXYZ* queries = (PointXYZ*)PyArray_DATA(queries_array);
+	npy_intp Nq = PyArray_DIM(queries_array, 0);
+
+	PyObject* res_obj = NULL;
+	if (typenum == NPY_INT64)
+		res_obj = knn_query<int64_t>(*self->batch_trees, queries, q_batches, Nq, k, n_threads);
+	else
+		res_obj = knn_query<int>(*self->batch_trees, queries, q_batches, Nq, k, n_threads);
+
+	Py_XDECREF(queries_array);
+	return res_obj;
+}
+
+static PyObject* BatchTree_nearest(BatchTreeObject* self, PyObject* args, PyObject* keywds)
+{
+	// Args containers
+	PyObject* queries_obj = NULL;
+	PyObject* q_batches_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "queries", "q_batches", "n_threads", "dtype", NULL };
+	int n_threads = 1;
+	int typenum = NPY_INT32;
+
+	// Parse the input  
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$iO&", kwlist, &queries_obj, &q_batches_obj, &n_threads, index_dtype_converter, &typenum))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+
+	PyObject* queries_array = NULL;
+	vector<int> q_batches;
+	if (!load_tree_queries(self, queries_obj, q_batches_obj, queries_array, q_batches))
+		return NULL;
+	const PointXYZ* queries = (PointXYZ*)PyArray_DATA(queries_array);
+	npy_intp Nq = PyArray_DIM(queries_array, 0);
+
+	PyObject* res_obj = NULL;
+	if (typenum == NPY_INT64)
+		res_obj = knn_query<int64_t>(*self->batch_trees, queries, q_batches, Nq, 1, n_threads);
+	else
+		res_obj = knn_query<int>(*self->batch_trees, queries, q_batches, Nq, 1, n_threads);
+
+	Py_XDECREF(queries_array);
+	return res_obj;
 }
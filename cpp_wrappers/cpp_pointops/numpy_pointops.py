@@ -0,0 +1,473 @@
+#
+#
+#      0=================================0
+#      |    Kernel Point Convolutions    |
+#      0=================================0
+#
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      NumPy implementation of the point operations of the pointops extension, used when it is not built
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      The functions have the same arguments and outputs as the ones of the pointops.subsampling, pointops.neighbors
+#      and pointops.pyramid modules, so this module can replace any of them. Results are the same up to the order of
+#      the subsampled points (sorted by voxel key here) and to the floating point rounding. The searches use the
+#      KDTrees of scikit-learn, and the n_threads arguments are ignored.
+#
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+import numpy as np
+from sklearn.neighbors import KDTree
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Grid subsampling
+#       \**********************/
+#
+
+def voxel_sums(voxels, values, n_voxels):
+    """
+    Sums of the values (N, d) of the points in each voxel, as a (n_voxels, d) float64 matrix
+    """
+
+    return np.stack([np.bincount(voxels, values[:, j], n_voxels) for j in range(values.shape[1])], 1)
+
+
+def voxel_majority(voxels, labels, n_voxels, weights=None):
+    """
+    Most frequent label of each voxel (the smallest label wins ties)
+    :param voxels: (N,) voxel of each vote
+    :param labels: (N,) integer label of each vote
+    :param n_voxels: number of voxels
+    :param weights: optional (N,) number of votes of each (voxel, label)
+    :return: (n_voxels,) int32 labels
+    """
+
+    majority = np.zeros((n_voxels,), dtype=np.int32)
+    if labels.shape[0] == 0:
+        return majority
+
+    labels = labels.astype(np.int64)
+    label_min = labels.min()
+    span = labels.max() - label_min + 1
+    pairs, inverse = np.unique(voxels.astype(np.int64) * span + labels - label_min, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights, pairs.shape[0])
+    pair_voxels = pairs // span
+    pair_labels = pairs % span + label_min
+    order = np.lexsort((pair_labels, -counts, pair_voxels))
+    first = np.r_[True, pair_voxels[order][1:] != pair_voxels[order][:-1]]
+    majority[pair_voxels[order][first]] = pair_labels[order][first]
+    return majority
+
+
+class GridSubsampler:
+    """
+    GridSubsampler(min_corner, max_corner, sampleDl=0.1, fdim=0, ldim=0): grid subsampling of a pointcloud added chunk
+    by chunk. The voxels are kept sorted by key, with their counts, sums of points and features, and label votes.
+    """
+
+    def __init__(self, min_corner, max_corner, sampleDl=0.1, fdim=0, ldim=0):
+        self.sampleDl = np.float32(sampleDl)
+        self.fdim = fdim
+        self.ldim = ldim
+        min_corner = np.asarray(min_corner, dtype=np.float32)
+        max_corner = np.asarray(max_corner, dtype=np.float32)
+        self.origin = np.floor(min_corner * (np.float32(1) / self.sampleDl)) * self.sampleDl
+        self.grid_n = np.floor((max_corner - self.origin) / self.sampleDl).astype(np.int64) + 1
+        self.keys = np.zeros((0,), dtype=np.int64)
+        self.counts = np.zeros((0,), dtype=np.int64)
+        self.sums = np.zeros((0, 3 + fdim), dtype=np.float64)
+
+        # Votes of each label dimension, as (voxel key, label, count) arrays
+        self.votes = [(np.zeros((0,), dtype=np.int64),) * 3 for _ in range(ldim)]
+        self.result_keys = np.zeros((0,), dtype=np.int64)
+
+    def voxel_keys(self, points):
+        cells = np.floor((points - self.origin) / self.sampleDl).astype(np.int64)
+        return cells[:, 0] + self.grid_n[0] * cells[:, 1] + self.grid_n[0] * self.grid_n[1] * cells[:, 2]
+
+    def add(self, points, features=None, classes=None):
+        """
+        Accumulates a chunk of points into the voxels
+        """
+
+        points = np.asarray(points, dtype=np.float32).reshape((-1, 3))
+        point_keys = self.voxel_keys(points)
+        values = points.astype(np.float64)
+        if self.fdim > 0:
+            values = np.hstack((values, np.asarray(features, dtype=np.float64).reshape((-1, self.fdim))))
+
+        # Merge the new points with the current voxels
+        keys, inverse = np.unique(np.r_[self.keys, point_keys], return_inverse=True)
+        inverse = inverse.ravel()
+        self.counts = np.bincount(inverse, np.r_[self.counts, np.ones(points.shape[0])], keys.shape[0]).astype(np.int64)
+        self.sums = voxel_sums(inverse, np.vstack((self.sums, values)), keys.shape[0])
+        self.keys = keys
+
+        # Merge the label votes
+        if self.ldim > 0:
+            classes = np.asarray(classes, dtype=np.int64).reshape((-1, self.ldim))
+            for i in range(self.ldim):
+                vote_keys, vote_labels, vote_counts = self.votes[i]
+                pairs = np.stack((np.r_[vote_keys, point_keys], np.r_[vote_labels, classes[:, i]]), 1)
+                weights = np.r_[vote_counts, np.ones((points.shape[0],), dtype=np.int64)]
+                pairs, pair_inds = np.unique(pairs, axis=0, return_inverse=True)
+                counts = np.bincount(pair_inds.ravel(), weights, pairs.shape[0]).astype(np.int64)
+                self.votes[i] = (pairs[:, 0], pairs[:, 1], counts)
+
+    def result(self):
+        """
+        Subsampled points, with features and/or classes like subsample
+        """
+
+        self.result_keys = self.keys
+        means = self.sums / self.counts[:, None]
+        results = (means[:, :3].astype(np.float32),)
+        if self.fdim > 0:
+            results += (means[:, 3:].astype(np.float32),)
+        if self.ldim > 0:
+            classes = np.zeros((self.keys.shape[0], self.ldim), dtype=np.int32)
+            for i in range(self.ldim):
+                vote_keys, vote_labels, vote_counts = self.votes[i]
+                voxels = np.searchsorted(self.keys, vote_keys)
+                classes[:, i] = voxel_majority(voxels, vote_labels, self.keys.shape[0], vote_counts)
+            results += (classes,)
+        return results[0] if len(results) == 1 else results
+
+    def voxel_indices(self, points):
+        """
+        Index of the subsampled point of each point (-1 for points outside the voxels)
+        """
+
+        keys = self.voxel_keys(np.asarray(points, dtype=np.float32).reshape((-1, 3)))
+        if self.result_keys.shape[0] == 0:
+            return np.full(keys.shape, -1, dtype=np.int32)
+        inds = np.minimum(np.searchsorted(self.result_keys, keys), self.result_keys.shape[0] - 1)
+        return np.where(self.result_keys[inds] == keys, inds, -1).astype(np.int32)
+
+    def voxel_counts(self):
+        """
+        Number of points added in each voxel
+        """
+
+        return self.counts.astype(np.int32)
+
+
+def subsample(points, features=None, classes=None, sampleDl=0.1, method='barycenters', verbose=0, engine='hash',
+              return_inverse=False):
+    """
+    Grid subsampling of a pointcloud (barycenters of the points and features, majority classes)
+    """
+
+    points = np.asarray(points, dtype=np.float32).reshape((-1, 3))
+    if points.shape[0] == 0:
+        raise RuntimeError('Error')
+    fdim = 0 if features is None else np.asarray(features).reshape((points.shape[0], -1)).shape[1]
+    ldim = 0 if classes is None else np.asarray(classes).reshape((points.shape[0], -1)).shape[1]
+    grid = GridSubsampler(points.min(axis=0), points.max(axis=0), sampleDl=sampleDl, fdim=fdim, ldim=ldim)
+    grid.add(points, features=features, classes=classes)
+    results = grid.result()
+    if not return_inverse:
+        return results
+    if not isinstance(results, tuple):
+        results = (results,)
+    return results + (grid.voxel_indices(points), grid.voxel_counts())
+
+
+def rotate(points, R, transpose=False):
+    """
+    Points rotated by p * R (or p * R^T to go back)
+    """
+
+    return (points @ (R.T if transpose else R)).astype(np.float32)
+
+
+def subsample_batch(points, batches, features=None, classes=None, sampleDl=0.1, method='barycenters', max_p=0,
+                    verbose=0, rotations=None, n_threads=1):
+    """
+    Grid subsampling of each element of a batch of stacked pointclouds, keeping at most max_p points per element
+    """
+
+    points = np.asarray(points, dtype=np.float32).reshape((-1, 3))
+    batches = np.asarray(batches, dtype=np.int32)
+    starts = np.r_[0, np.cumsum(batches)]
+    outputs = []
+    for b in range(batches.shape[0]):
+        i0, i1 = starts[b], starts[b + 1]
+        b_points = points[i0:i1] if rotations is None else rotate(points[i0:i1], rotations[b])
+        if i1 == i0:
+            b_results = [b_points]
+        else:
+            b_results = subsample(b_points,
+                                  features=None if features is None else features[i0:i1],
+                                  classes=None if classes is None else classes[i0:i1],
+                                  sampleDl=sampleDl)
+            b_results = list(b_results) if isinstance(b_results, tuple) else [b_results]
+        if max_p > 0:
+            b_results = [r[:max_p] for r in b_results]
+        if rotations is not None:
+            b_results[0] = rotate(b_results[0], rotations[b], transpose=True)
+        outputs.append(b_results)
+
+    # Stack the batch elements
+    s_points = np.vstack([o[0] for o in outputs]).astype(np.float32)
+    s_batches = np.array([o[0].shape[0] for o in outputs], dtype=np.int32)
+    results = (s_points, s_batches)
+    k = 1
+    if features is not None:
+        fdim = np.asarray(features).reshape((points.shape[0], -1)).shape[1]
+        results += (np.vstack([o[k] if len(o) > k else np.zeros((0, fdim)) for o in outputs]).astype(np.float32),)
+        k += 1
+    if classes is not None:
+        ldim = np.asarray(classes).reshape((points.shape[0], -1)).shape[1]
+        results += (np.vstack([o[k] if len(o) > k else np.zeros((0, ldim)) for o in outputs]).astype(np.int32),)
+    return results
+
+
+def subsample_pyramid(points, lengths, dl0=0.1, n_levels=1, rotations=None, n_threads=1):
+    """
+    Nested grid subsampling of a batch of stacked pointclouds at dl0 * 2^l for each level l < n_levels
+    """
+
+    if n_levels < 1:
+        raise RuntimeError('Wrong number of levels : n_levels should be at least 1')
+    points = np.asarray(points, dtype=np.float32).reshape((-1, 3))
+    lengths = np.asarray(lengths, dtype=np.int32)
+    starts = np.r_[0, np.cumsum(lengths)]
+    dl0 = np.float32(dl0)
+    level_points = [[] for _ in range(n_levels)]
+    level_lengths = [np.zeros(lengths.shape, dtype=np.int32) for _ in range(n_levels)]
+    for b in range(lengths.shape[0]):
+        b_points = points[starts[b]:starts[b + 1]]
+        if b_points.shape[0] == 0:
+            continue
+        if rotations is not None:
+            b_points = rotate(b_points, rotations[b])
+
+        # Integer coordinates of the first level, shifted by one bit per level
+        origin = np.floor(b_points.min(axis=0) * (np.float32(1) / dl0)) * dl0
+        cells = np.floor((b_points - origin) / dl0).astype(np.int64)
+        for l in range(n_levels):
+            _, inverse = np.unique(cells >> l, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            n_voxels = inverse.max() + 1
+            s_points = (voxel_sums(inverse, b_points.astype(np.float64), n_voxels) /
+                        np.bincount(inverse, minlength=n_voxels)[:, None]).astype(np.float32)
+            if rotations is not None:
+                s_points = rotate(s_points, rotations[b], transpose=True)
+            level_points[l].append(s_points)
+            level_lengths[l][b] = n_voxels
+
+    level_points = [np.vstack(p).astype(np.float32) if p else np.zeros((0, 3), dtype=np.float32)
+                    for p in level_points]
+    return level_points, level_lengths
+
+
+def spread_bits(a):
+    """
+    Spreads the 21 lower bits of a, with two zero bits between each of them
+    """
+
+    a = a.astype(np.uint64) & np.uint64(0x1FFFFF)
+    for shift, mask in [(32, 0x1F00000000FFFF), (16, 0x1F0000FF0000FF), (8, 0x100F00F00F00F00F),
+                        (4, 0x10C30C30C30C30C3), (2, 0x1249249249249249)]:
+        a = (a | (a << np.uint64(shift))) & np.uint64(mask)
+    return a
+
+
+def morton_order(points, sampleDl=0.1):
+    """
+    Order of the points along a Morton (Z-order) curve through cells of size sampleDl
+    """
+
+    points = np.asarray(points, dtype=np.float32).reshape((-1, 3))
+    if points.shape[0] == 0:
+        return np.zeros((0,), dtype=np.int32)
+    cells = np.floor((points - points.min(axis=0)) / np.float32(sampleDl)).astype(np.int64)
+    cells = np.minimum(cells, 0x1FFFFF)
+    keys = spread_bits(cells[:, 0]) | (spread_bits(cells[:, 1]) << np.uint64(1)) | \
+           (spread_bits(cells[:, 2]) << np.uint64(2))
+    return np.argsort(keys, kind='stable').astype(np.int32)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Neighbors
+#       \***************/
+#
+
+class BatchTree:
+    """
+    BatchTree(supports, s_batches, n_threads=1): KDTrees of a batch of stacked pointclouds, built once and reused for
+    several radius, knn or nearest neighbor queries
+    """
+
+    def __init__(self, supports, s_batches, n_threads=1):
+        self.supports = np.asarray(supports, dtype=np.float32).reshape((-1, 3))
+        self.s_starts = np.r_[0, np.cumsum(np.asarray(s_batches, dtype=np.int64))]
+        self.trees = [KDTree(self.supports[i0:i1]) if i1 > i0 else None
+                      for i0, i1 in zip(self.s_starts[:-1], self.s_starts[1:])]
+
+    def batch_queries(self, queries, q_batches):
+        queries = np.asarray(queries, dtype=np.float32).reshape((-1, 3))
+        q_starts = np.r_[0, np.cumsum(np.asarray(q_batches, dtype=np.int64))]
+        for b, tree in enumerate(self.trees):
+            yield b, tree, q_starts[b], queries[q_starts[b]:q_starts[b + 1]]
+
+    def radius_query(self, queries, q_batches, radius=0.1, max_neighbors=0, n_threads=1, csr=False, dtype=np.int32):
+        """
+        Radius neighbors sorted by distance (only the max_neighbors closest ones if max_neighbors > 0), as a matrix
+        padded with the shadow index or as ragged (offsets, indices)
+        """
+
+        rows = []
+        for b, tree, i0, b_queries in self.batch_queries(queries, q_batches):
+            if tree is None or b_queries.shape[0] == 0:
+                rows += [np.zeros((0,), dtype=np.int64)] * b_queries.shape[0]
+                continue
+            inds, _ = tree.query_radius(b_queries, r=radius, return_distance=True, sort_results=True)
+            rows += [r[:max_neighbors] + self.s_starts[b] if max_neighbors > 0 else r + self.s_starts[b] for r in inds]
+
+        counts = np.array([r.shape[0] for r in rows], dtype=np.int64)
+        if csr:
+            offsets = np.r_[0, np.cumsum(counts)].astype(dtype)
+            indices = np.concatenate(rows).astype(dtype) if rows else np.zeros((0,), dtype=dtype)
+            return offsets, indices
+
+        neighbors = np.full((len(rows), counts.max() if rows else 0), self.supports.shape[0], dtype=dtype)
+        for i, r in enumerate(rows):
+            neighbors[i, :r.shape[0]] = r
+        return neighbors
+
+    def knn_query(self, queries, q_batches, k=1, n_threads=1, dtype=np.int32):
+        """
+        (N, k) matrix of the k nearest neighbors, completed with the shadow index when a batch element has less than k
+        points
+        """
+
+        if k < 1:
+            raise RuntimeError('Wrong number of neighbors : k should be at least 1')
+        queries = np.asarray(queries, dtype=np.float32).reshape((-1, 3))
+        neighbors = np.full((queries.shape[0], k), self.supports.shape[0], dtype=dtype)
+        for b, tree, i0, b_queries in self.batch_queries(queries, q_batches):
+            if tree is None or b_queries.shape[0] == 0:
+                continue
+            b_k = min(k, self.s_starts[b + 1] - self.s_starts[b])
+            inds = tree.query(b_queries, k=b_k, return_distance=False)
+            neighbors[i0:i0 + b_queries.shape[0], :b_k] = inds + self.s_starts[b]
+        return neighbors
+
+    def nearest(self, queries, q_batches, n_threads=1, dtype=np.int32):
+        """
+        (N, 1) matrix of the nearest neighbor of each query
+        """
+
+        return self.knn_query(queries, q_batches, k=1, dtype=dtype)
+
+
+def batch_query(queries, supports, q_batches, s_batches, radius=0.1, max_neighbors=0, n_threads=1, csr=False,
+                dtype=np.int32):
+    return BatchTree(supports, s_batches).radius_query(queries, q_batches, radius=radius, max_neighbors=max_neighbors,
+                                                       csr=csr, dtype=dtype)
+
+
+def batch_nearest(queries, supports, q_batches, s_batches, n_threads=1, dtype=np.int32):
+    return BatchTree(supports, s_batches).nearest(queries, q_batches, dtype=dtype)
+
+
+def batch_knn(queries, supports, q_batches, s_batches, k=1, n_threads=1, dtype=np.int32):
+    return BatchTree(supports, s_batches).knn_query(queries, q_batches, k=k, dtype=dtype)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Input pyramid
+#       \*******************/
+#
+
+def build_pyramid(points, lengths, layers, first_subsampling_dl=0.1, conv_radius=2.5, deform_radius=5.0,
+                  neighbor_limits=None, neighbor_k=None, rotations=None, upsamples=True, csr=False, nested=False,
+                  morton=False, n_threads=1, dtype=np.int32):
+    """
+    Points, neighbors, pools, upsamples and lengths of every layer, like pointops.pyramid.build_pyramid
+    """
+
+    layer_points = np.ascontiguousarray(points, dtype=np.float32)
+    layer_lengths = np.asarray(lengths, dtype=np.int32)
+    layers = np.asarray(layers).reshape((-1, 4)) != 0
+    n_layers = layers.shape[0]
+    r_normal = first_subsampling_dl * conv_radius
+    empty = np.zeros((0, 1), dtype=dtype)
+
+    # Pooled points of every layer on nested grids
+    nested_points, nested_lengths = None, None
+    if nested and np.any(layers[:, 2]):
+        pool_layers = np.where(layers[:, 2])[0]
+        R = None if rotations is None else rotations[pool_layers[0]]
+        nested_points, nested_lengths = subsample_pyramid(layer_points, layer_lengths, 2 * first_subsampling_dl,
+                                                          pool_layers[-1] + 1, rotations=R)
+
+    outputs = ([], [], [], [], [])
+    tree = None
+    for l in range(n_layers):
+        conv, conv_deform, pool, pool_deform = layers[l]
+        max_neighbors = neighbor_limits[l] if neighbor_limits is not None and l < len(neighbor_limits) else 0
+        k = neighbor_k[l] if neighbor_k is not None and l < len(neighbor_k) else 0
+        ragged = csr and k < 1
+        if tree is None and (conv or pool):
+            tree = BatchTree(layer_points, layer_lengths)
+
+        # Convolution neighbors indices
+        neighbors = (np.zeros((1,), dtype=dtype), np.zeros((0,), dtype=dtype)) if ragged else empty
+        if conv:
+            r = r_normal * deform_radius / conv_radius if conv_deform else r_normal
+            if k > 0:
+                neighbors = tree.knn_query(layer_points, layer_lengths, k=k, dtype=dtype)
+            else:
+                neighbors = tree.radius_query(layer_points, layer_lengths, radius=r, max_neighbors=max_neighbors,
+                                              csr=csr, dtype=dtype)
+
+        # Pooling and upsampling indices
+        pools = (np.zeros((1,), dtype=dtype), np.zeros((0,), dtype=dtype)) if ragged else empty
+        layer_upsamples = empty
+        pool_points, pool_lengths = np.zeros((0, 3), dtype=np.float32), np.zeros((0,), dtype=np.int32)
+        pool_tree = None
+        if pool:
+            dl = 2 * r_normal / conv_radius
+            if nested:
+                pool_points, pool_lengths = nested_points[l], nested_lengths[l]
+            else:
+                R = None if rotations is None else rotations[l]
+                pool_points, pool_lengths = subsample_batch(layer_points, layer_lengths, sampleDl=dl, rotations=R)
+            if morton:
+                starts = np.r_[0, np.cumsum(pool_lengths)]
+                pool_points = np.vstack([pool_points[i0:i1][morton_order(pool_points[i0:i1], dl)]
+                                         for i0, i1 in zip(starts[:-1], starts[1:])] + [pool_points[:0]])
+
+            r = r_normal * deform_radius / conv_radius if pool_deform else r_normal
+            if k > 0:
+                pools = tree.knn_query(pool_points, pool_lengths, k=k, dtype=dtype)
+            else:
+                pools = tree.radius_query(pool_points, pool_lengths, radius=r, max_neighbors=max_neighbors, csr=csr,
+                                          dtype=dtype)
+            if upsamples:
+                pool_tree = BatchTree(pool_points, pool_lengths)
+                layer_upsamples = pool_tree.nearest(layer_points, layer_lengths, dtype=dtype)
+
+        for output, value in zip(outputs, [layer_points, neighbors, pools, layer_upsamples, layer_lengths]):
+            output.append(value)
+
+        layer_points, layer_lengths = pool_points, pool_lengths
+        tree = pool_tree
+        r_normal *= 2
+
+    return outputs
@@ -0,0 +1,60 @@
+#include <Python.h>
+
+
+// Single extension gathering the point operations: the modules of the subsampling, neighbors and input pyramid wrappers
+// are compiled together and exposed as its attributes subsampling, neighbors and pyramid
+// ********************************************************************************************************************
+
+PyMODINIT_FUNC PyInit_grid_subsampling(void);
+PyMODINIT_FUNC PyInit_radius_neighbors(void);
+PyMODINIT_FUNC PyInit_input_pyramid(void);
+
+
+// docstrings for our module
+// *************************
+
+static char module_docstring[] = "This module gathers the point operations in a single extension: grid subsampling (subsampling), radius, knn and nearest neighbors (neighbors) and network inputs (pyramid)";
+
+
+// Initialize the module
+// *********************
+
+static struct PyModuleDef moduledef = 
+{
+    PyModuleDef_HEAD_INIT,
+    "pointops",             // m_name
+    module_docstring,       // m_doc
+    -1,                     // m_size
+    NULL,                   // m_methods
+    NULL,                   // m_reload
+    NULL,                   // m_traverse
+    NULL,                   // m_clear
+    NULL,                   // m_free
+};
+
+static int add_submodule(PyObject* m, const char* name, PyObject* submodule)
+{
+	if (submodule == NULL || PyModule_AddObject(m, name, submodule) < 0)
+	{
+		Py_XDECREF(submodule);
+		return -1;
+	}
+	return 0;
+}
+
+PyMODINIT_FUNC PyInit_pointops(void)
+{
+	PyObject* m = PyModule_Create(&moduledef);
+	if (m == NULL)
+		return NULL;
+
+	if (add_submodule(m, "subsampling", PyInit_grid_subsampling()) < 0 ||
+		add_submodule(m, "neighbors", PyInit_radius_neighbors()) < 0 ||
+		add_submodule(m, "pyramid", PyInit_input_pyramid()) < 0)
+	{
+		Py_DECREF(m);
+		return NULL;
+	}
+
+	return m;
+}
@@ -0,0 +1,35 @@
+from distutils.core import setup, Extension
+import numpy.distutils.misc_util
+import sys
+
+# Optimization flags
+# ******************
+
+# The extension is optimized for the CPU of the machine where it is built, and parallelized with OpenMP
+if sys.platform == 'win32':
+    COMPILE_ARGS = ['/O2', '/openmp']
+    LINK_ARGS = []
+else:
+    COMPILE_ARGS = ['-std=c++11', '-D_GLIBCXX_USE_CXX11_ABI=0', '-O3', '-march=native', '-fopenmp']
+    LINK_ARGS = ['-fopenmp']
+
+# Adding sources of the project
+# *****************************
+
+# The wrappers of the subsampling, neighbors and input pyramid are compiled in a single module
+SOURCES = ["../cpp_utils/cloud/cloud.cpp",
+           "../cpp_subsampling/grid_subsampling/grid_subsampling.cpp",
+           "../cpp_neighbors/neighbors/neighbors.cpp",
+           "../cpp_pyramid/pyramid/pyramid.cpp",
+           "../cpp_subsampling/wrapper.cpp",
+           "../cpp_neighbors/wrapper.cpp",
+           "../cpp_pyramid/wrapper.cpp",
+           "pointops.cpp"]
+
+module = Extension(name="pointops",
+                   sources=SOURCES,
+                   extra_compile_args=COMPILE_ARGS,
+                   extra_link_args=LINK_ARGS)
+
+
+setup(ext_modules=[module], include_dirs=numpy.distutils.misc_util.get_numpy_include_dirs())
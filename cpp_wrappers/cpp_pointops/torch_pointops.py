@@ -0,0 +1,387 @@
+#
+#
+#      0=================================0
+#      |    Kernel Point Convolutions    |
+#      0=================================0
+#
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Torch implementation of the input pyramid (grid subsampling, radius and knn neighbors), on any device
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      build_pyramid has the same arguments and outputs as pointops.pyramid.build_pyramid, but computes them with torch
+#      tensor ops on the device of the inputs (or the given device), and returns tensors on this device. The voxels are
+#      found by sorting their keys, and the neighbors by gathering the supports of the 27 cells around each query in a
+#      grid of cells sorted by key (cell list). All the batch elements are processed at once. Results are the same as
+#      the ones of the extension up to the order of the subsampled points (sorted by voxel key here) and to the floating
+#      point rounding.
+#
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+import numpy as np
+import torch
+
+# Max number of (query, support) candidate pairs gathered at once by the neighbor searches (bounds their memory)
+MAX_CANDIDATES = 1 << 24
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def index_dtype(dtype):
+    """
+    Torch index type corresponding to np.int32 or np.int64
+    """
+
+    return torch.int64 if np.dtype(dtype) == np.int64 else torch.int32
+
+
+def batch_indices(lengths):
+    """
+    (N,) int64 batch element of each stacked point
+    """
+
+    return torch.repeat_interleave(torch.arange(lengths.shape[0], device=lengths.device), lengths.long())
+
+
+def batch_min(points, batch, B):
+    """
+    (B, 3) min corner of the points of each batch element (inf for empty elements)
+    """
+
+    mins = torch.full((B, points.shape[1]), float('inf'), dtype=points.dtype, device=points.device)
+    return mins.scatter_reduce(0, batch[:, None].expand_as(points), points, reduce='amin')
+
+
+def rotate(points, batch, rotations):
+    """
+    Points rotated by p * R with the rotation R of their batch element
+    """
+
+    return torch.einsum('ni,nij->nj', points, rotations[batch])
+
+
+def grid_cells(points, batch, B, sampleDl):
+    """
+    (N, 3) int64 integer coordinates of the points in the grid of their batch element, with the same origin as the
+    grids of the extension
+    """
+
+    origin = torch.floor(batch_min(points, batch, B) * (1 / sampleDl)) * sampleDl
+    return torch.floor((points - origin[batch]) / sampleDl).long()
+
+
+def cell_keys(cells, batch, dims):
+    """
+    Keys of the cells of a grid of size dims, unique across the batch elements and sorted by batch element
+    """
+
+    return ((batch * dims[2] + cells[:, 2]) * dims[1] + cells[:, 1]) * dims[0] + cells[:, 0]
+
+
+def voxel_barycenters(points, batch, B, cells):
+    """
+    Barycenters of the points in each voxel (cells of the same key), and number of voxels of each batch element
+    """
+
+    if points.shape[0] == 0:
+        return points, torch.zeros((B,), dtype=torch.int32, device=points.device)
+
+    dims = cells.max(dim=0).values + 1
+    keys, inverse, counts = torch.unique(cell_keys(cells, batch, dims), return_inverse=True, return_counts=True)
+    sums = torch.zeros((keys.shape[0], 3), dtype=torch.float64, device=points.device)
+    sums.index_add_(0, inverse, points.double())
+    voxel_batch = keys // (dims[0] * dims[1] * dims[2])
+    lengths = torch.bincount(voxel_batch, minlength=B).int()
+    return (sums / counts[:, None]).to(points.dtype), lengths
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Grid subsampling
+#       \**********************/
+#
+
+def grid_subsample(points, lengths, sampleDl, rotations=None):
+    """
+    Grid subsampling of each element of a batch of stacked points (barycenters of the points of each voxel)
+    :param points: (N, 3) tensor of points
+    :param lengths: (B,) tensor of lengths of batch elements
+    :param sampleDl: size of the voxels
+    :param rotations: optional (B, 3, 3) tensor orienting the grid of each batch element
+    :return: (M, 3) subsampled points and their (B,) int32 lengths
+    """
+
+    B = lengths.shape[0]
+    batch = batch_indices(lengths)
+    grid_points = points if rotations is None else rotate(points, batch, rotations)
+    return voxel_barycenters(points, batch, B, grid_cells(grid_points, batch, B, sampleDl))
+
+
+def nested_grid_subsample(points, lengths, dl0, n_levels, rotations=None):
+    """
+    Nested grid subsampling at dl0 * 2^l for each level l < n_levels (the voxels of a level are the unions of 8 voxels
+    of the previous one)
+    :return: lists of subsampled points and lengths of each level
+    """
+
+    B = lengths.shape[0]
+    batch = batch_indices(lengths)
+    grid_points = points if rotations is None else rotate(points, batch, rotations)
+    cells = grid_cells(grid_points, batch, B, dl0)
+    levels = [voxel_barycenters(points, batch, B, cells >> l) for l in range(n_levels)]
+    return [p for p, _ in levels], [n for _, n in levels]
+
+
+def spread_bits(a):
+    """
+    Spreads the 21 lower bits of a, with two zero bits between each of them
+    """
+
+    a = a & 0x1FFFFF
+    for shift, mask in [(32, 0x1F00000000FFFF), (16, 0x1F0000FF0000FF), (8, 0x100F00F00F00F00F),
+                        (4, 0x10C30C30C30C30C3), (2, 0x1249249249249249)]:
+        a = (a | (a << shift)) & mask
+    return a
+
+
+def morton_sort(points, lengths, cellDl):
+    """
+    Points of each batch element sorted along a Morton (Z-order) curve through cells of size cellDl
+    """
+
+    B = lengths.shape[0]
+    batch = batch_indices(lengths)
+    cells = torch.floor((points - batch_min(points, batch, B)[batch]) / cellDl).long().clamp(0, 0x1FFFFF)
+    keys = spread_bits(cells[:, 0]) | (spread_bits(cells[:, 1]) << 1) | (spread_bits(cells[:, 2]) << 2)
+    order = torch.sort(keys, stable=True).indices
+    order = order[torch.sort(batch[order], stable=True).indices]
+    return points[order]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Neighbors
+#       \***************/
+#
+
+def radius_candidates(queries, q_batch, supports, s_batch, B, radius):
+    """
+    Supports closer than radius to each query, found in the 27 cells around the query in a grid of cells of size radius
+    :return: (query, support, squared distance) int64 and float tensors, sorted by query then by distance
+    """
+
+    device = supports.device
+    empty = torch.zeros((0,), dtype=torch.int64, device=device)
+    if queries.shape[0] == 0 or supports.shape[0] == 0:
+        return empty, empty, torch.zeros((0,), dtype=supports.dtype, device=device)
+
+    # Grid of each batch element, with a margin of one cell around its queries and supports
+    mins = batch_min(torch.cat((queries, supports)), torch.cat((q_batch, s_batch)), B) - radius
+    q_cells = torch.floor((queries - mins[q_batch]) / radius).long()
+    s_cells = torch.floor((supports - mins[s_batch]) / radius).long()
+    dims = torch.maximum(q_cells.max(dim=0).values, s_cells.max(dim=0).values) + 2
+
+    # Supports sorted by cell, and range of the sorted supports in the 27 cells around each query (the 3 cells along x
+    # of each of the 9 rows of cells have consecutive keys)
+    sorted_keys, s_order = torch.sort(cell_keys(s_cells, s_batch, dims))
+    offsets = torch.stack(torch.meshgrid(torch.zeros(1, dtype=torch.int64, device=device),
+                                         torch.arange(-1, 2, device=device),
+                                         torch.arange(-1, 2, device=device), indexing='ij'), -1).reshape(-1, 3)
+    row_keys = cell_keys((q_cells[:, None, :] + offsets).reshape(-1, 3), q_batch.repeat_interleave(9), dims)
+    starts = torch.searchsorted(sorted_keys, row_keys - 1).view(-1, 9)
+    counts = torch.searchsorted(sorted_keys, row_keys + 1, right=True).view(-1, 9) - starts
+
+    # Gather the candidates of blocks of queries
+    q_blocks = torch.unique_consecutive(torch.cumsum(counts.sum(dim=1), 0) // MAX_CANDIDATES, return_counts=True)[1]
+    results = []
+    i0 = 0
+    for n in q_blocks.tolist():
+        b_counts = counts[i0:i0 + n].reshape(-1)
+        b_starts = starts[i0:i0 + n].reshape(-1)
+        row_inds = torch.repeat_interleave(torch.arange(b_counts.shape[0], device=device), b_counts)
+        first = torch.cumsum(b_counts, 0) - b_counts
+        pos = torch.arange(row_inds.shape[0], device=device) - first[row_inds] + b_starts[row_inds]
+        q_inds = i0 + row_inds // 9
+        s_inds = s_order[pos]
+        d2 = torch.sum((queries[q_inds] - supports[s_inds]) ** 2, dim=1)
+        mask = d2 < radius ** 2
+        q_inds, s_inds, d2 = q_inds[mask], s_inds[mask], d2[mask]
+
+        # Sort by query then by distance (the candidates are already grouped by query, and d2 / radius^2 < 1)
+        order = torch.sort(q_inds.double() + d2.double() * ((1 - 1e-7) / radius ** 2)).indices
+        results.append((q_inds[order], s_inds[order], d2[order]))
+        i0 += n
+
+    return tuple(torch.cat(r) for r in zip(*results))
+
+
+def row_ranks(q_inds, n_queries):
+    """
+    Number of neighbors of each query, and rank of each neighbor in the row of its query
+    """
+
+    counts = torch.bincount(q_inds, minlength=n_queries)
+    first = torch.cumsum(counts, 0) - counts
+    return counts, torch.arange(q_inds.shape[0], device=q_inds.device) - first[q_inds]
+
+
+def radius_neighbors(queries, supports, q_lengths, s_lengths, radius, max_neighbors=0, csr=False, dtype=torch.int32):
+    """
+    Radius neighbors sorted by distance (only the max_neighbors closest ones if max_neighbors > 0), as a matrix padded
+    with the shadow index or as ragged (offsets, indices)
+    """
+
+    B = q_lengths.shape[0]
+    q_inds, s_inds, _ = radius_candidates(queries, batch_indices(q_lengths), supports, batch_indices(s_lengths), B,
+                                          radius)
+    counts, ranks = row_ranks(q_inds, queries.shape[0])
+    if max_neighbors > 0:
+        mask = ranks < max_neighbors
+        q_inds, s_inds, ranks = q_inds[mask], s_inds[mask], ranks[mask]
+        counts = torch.clamp(counts, max=max_neighbors)
+
+    if csr:
+        offsets = torch.zeros((queries.shape[0] + 1,), dtype=dtype, device=queries.device)
+        offsets[1:] = torch.cumsum(counts, 0)
+        return offsets, s_inds.to(dtype)
+
+    n_cols = int(counts.max()) if queries.shape[0] > 0 else 0
+    neighbors = torch.full((queries.shape[0], n_cols), supports.shape[0], dtype=dtype, device=queries.device)
+    neighbors[q_inds, ranks] = s_inds.to(dtype)
+    return neighbors
+
+
+def knn_neighbors(queries, supports, q_lengths, s_lengths, k, dtype=torch.int32):
+    """
+    (N, k) matrix of the k nearest neighbors, completed with the shadow index when a batch element has less than k
+    points. The radius of the search grows for the queries which have less than k neighbors, until it covers their
+    batch element.
+    """
+
+    if k < 1:
+        raise RuntimeError('Wrong number of neighbors : k should be at least 1')
+
+    B = q_lengths.shape[0]
+    q_batch = batch_indices(q_lengths)
+    s_batch = batch_indices(s_lengths)
+    neighbors = torch.full((queries.shape[0], k), supports.shape[0], dtype=dtype, device=queries.device)
+    if queries.shape[0] == 0 or supports.shape[0] == 0:
+        return neighbors
+
+    # Starting radius, a bit larger than the one of a ball of k points at the mean density of the bounding boxes of the
+    # supports (and at least a 2^-16 of their extent, which bounds the size of the grids)
+    valid = s_lengths > 0
+    extents = (-batch_min(-supports, s_batch, B) - batch_min(supports, s_batch, B))[valid]
+    volumes = torch.prod(torch.clamp(extents, min=1e-6), dim=1)
+    radius = 1.5 * float(torch.median((k * volumes / (s_lengths[valid] * 4.19)) ** (1 / 3)))
+    radius = max(radius, float(extents.max()) / (1 << 16), 1e-6)
+
+    needed = torch.clamp(s_lengths.long(), max=k)[q_batch]
+    todo = torch.arange(queries.shape[0], device=queries.device)
+    while todo.shape[0] > 0:
+        q_inds, s_inds, _ = radius_candidates(queries[todo], q_batch[todo], supports, s_batch, B, radius)
+        counts, ranks = row_ranks(q_inds, todo.shape[0])
+        done = counts >= needed[todo]
+        mask = (ranks < k) & done[q_inds]
+        neighbors[todo[q_inds[mask]], ranks[mask]] = s_inds[mask].to(dtype)
+        todo = todo[~done]
+        radius *= 1.5
+
+    return neighbors
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Input pyramid
+#       \*******************/
+#
+
+def build_pyramid(points, lengths, layers, first_subsampling_dl=0.1, conv_radius=2.5, deform_radius=5.0,
+                  neighbor_limits=None, neighbor_k=None, rotations=None, upsamples=True, csr=False, nested=False,
+                  morton=False, n_threads=1, dtype=np.int32, device=None):
+    """
+    Points, neighbors, pools, upsamples and lengths of every layer, like pointops.pyramid.build_pyramid, as tensors on
+    the given device (by default the device of the points). n_threads is ignored (see torch.set_num_threads).
+    """
+
+    if device is None:
+        device = points.device if torch.is_tensor(points) else 'cpu'
+    layer_points = torch.as_tensor(points, dtype=torch.float32, device=device)
+    layer_lengths = torch.as_tensor(lengths, dtype=torch.int32, device=device)
+    if rotations is not None:
+        rotations = torch.as_tensor(rotations, dtype=torch.float32, device=device)
+    layers = np.asarray(layers).reshape((-1, 4)) != 0
+    n_layers = layers.shape[0]
+    r_normal = first_subsampling_dl * conv_radius
+    dtype = index_dtype(dtype)
+    empty = torch.zeros((0, 1), dtype=dtype, device=device)
+    empty_csr = (torch.zeros((1,), dtype=dtype, device=device), torch.zeros((0,), dtype=dtype, device=device))
+
+    # Pooled points of every layer on nested grids
+    nested_points, nested_lengths = None, None
+    if nested and np.any(layers[:, 2]):
+        pool_layers = np.where(layers[:, 2])[0]
+        R = None if rotations is None else rotations[pool_layers[0]]
+        nested_points, nested_lengths = nested_grid_subsample(layer_points, layer_lengths, 2 * first_subsampling_dl,
+                                                              pool_layers[-1] + 1, rotations=R)
+
+    outputs = ([], [], [], [], [])
+    for l in range(n_layers):
+        conv, conv_deform, pool, pool_deform = layers[l]
+        max_neighbors = int(neighbor_limits[l]) if neighbor_limits is not None and l < len(neighbor_limits) else 0
+        k = int(neighbor_k[l]) if neighbor_k is not None and l < len(neighbor_k) else 0
+        ragged = csr and k < 1
+
+        # Convolution neighbors indices
+        neighbors = empty_csr if ragged else empty
+        if conv:
+            r = r_normal * deform_radius / conv_radius if conv_deform else r_normal
+            if k > 0:
+                neighbors = knn_neighbors(layer_points, layer_points, layer_lengths, layer_lengths, k, dtype=dtype)
+            else:
+                neighbors = radius_neighbors(layer_points, layer_points, layer_lengths, layer_lengths, r,
+                                             max_neighbors=max_neighbors, csr=csr, dtype=dtype)
+
+        # Pooling and upsampling indices
+        pools = empty_csr if ragged else empty
+        layer_upsamples = empty
+        pool_points = torch.zeros((0, 3), dtype=torch.float32, device=device)
+        pool_lengths = torch.zeros((0,), dtype=torch.int32, device=device)
+        if pool:
+            dl = 2 * r_normal / conv_radius
+            if nested:
+                pool_points, pool_lengths = nested_points[l], nested_lengths[l]
+            else:
+                R = None if rotations is None else rotations[l]
+                pool_points, pool_lengths = grid_subsample(layer_points, layer_lengths, dl, rotations=R)
+            if morton:
+                pool_points = morton_sort(pool_points, pool_lengths, dl)
+
+            r = r_normal * deform_radius / conv_radius if pool_deform else r_normal
+            if k > 0:
+                pools = knn_neighbors(pool_points, layer_points, pool_lengths, layer_lengths, k, dtype=dtype)
+            else:
+                pools = radius_neighbors(pool_points, layer_points, pool_lengths, layer_lengths, r,
+                                         max_neighbors=max_neighbors, csr=csr, dtype=dtype)
+            if upsamples:
+                layer_upsamples = knn_neighbors(layer_points, pool_points, layer_lengths, pool_lengths, 1, dtype=dtype)
+
+        for output, value in zip(outputs, [layer_points, neighbors, pools, layer_upsamples, layer_lengths]):
+            output.append(value)
+
+        layer_points, layer_lengths = pool_points, pool_lengths
+        r_normal *= 2
+
+    return outputs
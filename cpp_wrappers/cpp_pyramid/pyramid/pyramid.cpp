@@ -0,0 +1,178 @@
+
+#include "pyramid.h"
+
+
+template <typename IndexT>
+void build_pyramid(const PointXYZ* points,
+                   vector<int>& lengths,
+                   vector<LayerSpec>& layers,
+                   vector<int>& neighbor_limits,
+                   vector<int>& neighbor_k,
+                   vector<float>& rotations,
+                   double first_subsampling_dl,
+                   double conv_radius,
+                   double deform_radius,
+                   bool use_upsamples,
+                   bool csr,
+                   bool nested,
+                   bool morton,
+                   int n_threads,
+                   vector<PyramidLayer<IndexT>>& pyramid)
+{
+
+	// Initialize variables
+	// ******************
+
+	// Number of layers and batch elements
+	size_t n_layers = layers.size();
+	size_t Nb = lengths.size();
+
+	// Starting radius of convolutions
+	double r_normal = first_subsampling_dl * conv_radius;
+
+	// Points of the current layer (read in place, from the inputs or from the pyramid), and their trees (shared by the
+	// convolution and pooling queries)
+	const PointXYZ* layer_points = points;
+	size_t n_points = accumulate(lengths.begin(), lengths.end(), (size_t)0);
+	vector<int> layer_lengths(lengths);
+	unique_ptr<BatchKDTrees> tree;
+
+	pyramid = vector<PyramidLayer<IndexT>>(n_layers);
+
+	// With nested grids, the pooled points of every layer are subsampled at once from the input points (in the
+	// orientation of the first pooling layer, the same for all the levels)
+	vector<vector<PointXYZ>> nested_points;
+	vector<vector<int>> nested_lengths;
+	if (nested)
+	{
+		int n_levels = 0;
+		int first_pool = -1;
+		for (size_t l = 0; l < n_layers; l++)
+		{
+			if (layers[l].pool)
+			{
+				n_levels = (int)l + 1;
+				if (first_pool < 0)
+					first_pool = (int)l;
+			}
+		}
+		if (n_levels > 0)
+		{
+			const float* R = rotations.size() > 0 ? rotations.data() + 9 * Nb * first_pool : NULL;
+			batch_pyramid_grid_subsampling(points, lengths, nested_points, nested_lengths, R,
+			                               (float)(2 * first_subsampling_dl), n_levels, n_threads);
+		}
+	}
+
+
+	// Loop over the layers
+	// ********************
+
+	for (size_t l = 0; l < n_layers; l++)
+	{
+		LayerSpec& spec = layers[l];
+		PyramidLayer<IndexT>& layer = pyramid[l];
+		int max_neighbors = l < neighbor_limits.size() ? neighbor_limits[l] : 0;
+
+		// Layers with a number of neighbors k use the k nearest neighbors instead of the radius neighbors
+		int k = l < neighbor_k.size() ? neighbor_k[l] : 0;
+		layer.ragged = csr && k < 1;
+
+		if (!tree && (spec.conv || spec.pool))
+			tree.reset(new BatchKDTrees(layer_points, layer_lengths, n_threads));
+
+		// Convolution neighbors indices
+		if (spec.conv)
+		{
+			double r = spec.conv_deform ? r_normal * deform_radius / conv_radius : r_normal;
+			if (k > 0)
+			{
+				layer.neighbors.resize(n_points * k);
+				tree->knn_neighbors(layer_points, layer_lengths, layer.neighbors.data(), k, n_threads);
+			}
+			else if (csr)
+				tree->radius_neighbors_csr(layer_points, layer_lengths, layer.neighbors_offsets, layer.neighbors,
+				                           (float)r, max_neighbors, n_threads);
+			else
+				tree->radius_neighbors(layer_points, layer_lengths, layer.neighbors, (float)r, max_neighbors, n_threads);
+			layer.neighbors_cols = n_points > 0 ? layer.neighbors.size() / n_points : 0;
+		}
+
+		// Pooling and upsampling indices
+		vector<PointXYZ> pool_points;
+		vector<int> pool_lengths;
+		unique_ptr<BatchKDTrees> pool_tree;
+		if (spec.pool)
+		{
+			// New subsampling length
+			double dl = 2 * r_normal / conv_radius;
+
+			// Subsampled points, in a random orientation of the grid for each batch element if rotations are given
+			if (nested)
+			{
+				pool_points.swap(nested_points[l]);
+				pool_lengths.swap(nested_lengths[l]);
+			}
+			else
+			{
+				vector<float> no_sub_features;
+				vector<int> no_sub_classes;
+				const float* R = rotations.size() > 0 ? rotations.data() + 9 * Nb * l : NULL;
+				batch_grid_subsampling(layer_points, pool_points, NULL, 0, no_sub_features, NULL, 0, no_sub_classes,
+				                       layer_lengths, pool_lengths, R, (float)dl, 0, n_threads);
+			}
+
+			// Pooled points sorted along a Morton curve, so that the neighbors of nearby points are close in memory
+			if (morton)
+				batch_morton_sort(pool_points, pool_lengths, (float)dl, n_threads);
+
+			// Pooled neighbors indices
+			double r = spec.pool_deform ? r_normal * deform_radius / conv_radius : r_normal;
+			if (k > 0)
+			{
+				layer.pools.resize(pool_points.size() * k);
+				tree->knn_neighbors(pool_points.data(), pool_lengths, layer.pools.data(), k, n_threads);
+			}
+			else if (csr)
+				tree->radius_neighbors_csr(pool_points.data(), pool_lengths, layer.pools_offsets, layer.pools, (float)r,
+				                           max_neighbors, n_threads);
+			else
+				tree->radius_neighbors(pool_points.data(), pool_lengths, layer.pools, (float)r, max_neighbors, n_threads);
+			layer.pools_cols = pool_points.size() > 0 ? layer.pools.size() / pool_points.size() : 0;
+
+			// Upsample indices, with the trees of the pooled points which are reused by the next layer
+			if (use_upsamples)
+			{
+				pool_tree.reset(new BatchKDTrees(pool_points.data(), pool_lengths, n_threads));
+				layer.upsamples.resize(n_points);
+				pool_tree->nearest_neighbors(layer_points, layer_lengths, layer.upsamples.data(), n_threads);
+			}
+		}
+
+		// Save the layer lengths and go to the next layer, whose points are moved into the pyramid (this keeps their
+		// buffer, so the trees built on them stay valid)
+		layer.lengths.swap(layer_lengths);
+		layer_lengths.swap(pool_lengths);
+		if (l + 1 < n_layers)
+		{
+			pyramid[l + 1].points.swap(pool_points);
+			layer_points = pyramid[l + 1].points.data();
+			n_points = pyramid[l + 1].points.size();
+		}
+		tree = move(pool_tree);
+		r_normal *= 2;
+	}
+
+	return;
+}
+
+
+// Index types of the outputs
+// **************************
+
+template void build_pyramid(const PointXYZ*, vector<int>&, vector<LayerSpec>&, vector<int>&, vector<int>&,
+                            vector<float>&, double, double, double, bool, bool, bool, bool, int,
+                            vector<PyramidLayer<int>>&);
+template void build_pyramid(const PointXYZ*, vector<int>&, vector<LayerSpec>&, vector<int>&, vector<int>&,
+                            vector<float>&, double, double, double, bool, bool, bool, bool, int,
+                            vector<PyramidLayer<int64_t>>&);
@@ -0,0 +1,103 @@
+
+
+#include "../../cpp_subsampling/grid_subsampling/grid_subsampling.h"
+#include "../../cpp_neighbors/neighbors/neighbors.h"
+
+#include <memory>
+
+using namespace std;
+
+
+// Operations done at each layer of the network, as read from the architecture
+class LayerSpec
+{
+public:
+
+	// Elements
+	// ********
+
+	bool conv;          // convolutions are done in this layer
+	bool conv_deform;   // these convolutions are deformable
+	bool pool;          // the layer ends with a pooling operation
+	bool pool_deform;   // this pooling operation is deformable
+
+
+	// Methods
+	// *******
+
+	LayerSpec()
+	{
+		conv = false;
+		conv_deform = false;
+		pool = false;
+		pool_deform = false;
+	}
+
+	LayerSpec(bool conv0, bool conv_deform0, bool pool0, bool pool_deform0)
+	{
+		conv = conv0;
+		conv_deform = conv_deform0;
+		pool = pool0;
+		pool_deform = pool_deform0;
+	}
+};
+
+
+// Inputs of one layer of the network. Matrices are stored row by row with the given number of columns, or as ragged
+// rows (offsets and flat indices) for the neighbors and pools when the pyramid is built in CSR format. The points of
+// the first layer are the input points, which are not copied, so its points container stays empty. Indices are int or
+// int64_t (IndexT). Layers with k nearest neighbors always have fixed width matrices.
+template <typename IndexT>
+class PyramidLayer
+{
+public:
+
+	// Elements
+	// ********
+
+	vector<PointXYZ> points;
+	vector<int> lengths;
+
+	vector<IndexT> neighbors;
+	vector<IndexT> neighbors_offsets;
+	size_t neighbors_cols;
+
+	vector<IndexT> pools;
+	vector<IndexT> pools_offsets;
+	size_t pools_cols;
+
+	vector<IndexT> upsamples;
+	size_t upsamples_cols;
+
+	bool ragged;
+
+
+	// Methods
+	// *******
+
+	PyramidLayer()
+	{
+		neighbors_cols = 1;
+		pools_cols = 1;
+		upsamples_cols = 1;
+		ragged = false;
+	}
+};
+
+
+template <typename IndexT>
+void build_pyramid(const PointXYZ* points,
+                   vector<int>& lengths,
+                   vector<LayerSpec>& layers,
+                   vector<int>& neighbor_limits,
+                   vector<int>& neighbor_k,
+                   vector<float>& rotations,
+                   double first_subsampling_dl,
+                   double conv_radius,
+                   double deform_radius,
+                   bool use_upsamples,
+                   bool csr,
+                   bool nested,
+                   bool morton,
+                   int n_threads,
+                   vector<PyramidLayer<IndexT>>& pyramid);
@@ -0,0 +1,343 @@
+#include <Python.h>
+#include <numpy/arrayobject.h>
+#include "pyramid/pyramid.h"
+#include "../cpp_utils/arrays/arrays.h"
+#include <string>
+
+
+
+// docstrings for our module
+// *************************
+
+static char module_docstring[] = "This module builds all the network inputs of a batch of stacked pointclouds in a single call";
+
+static char build_pyramid_docstring[] = "build_pyramid(points, lengths, layers, first_subsampling_dl, conv_radius, deform_radius, neighbor_limits=None, neighbor_k=None, rotations=None, upsamples=True, csr=False, nested=False, morton=False, n_threads=1, dtype=np.int32): subsample the points and compute the neighbors, pools and upsamples indices of every layer. layers is a (L, 4) matrix of flags [conv, deformable conv, pool, deformable pool], neighbor_limits is (L,) (0 means no limit), neighbor_k is (L,) and replaces the radius neighbors of the layers where it is positive by the k nearest neighbors (always as padded matrices), rotations is a (L, B, 3, 3) matrix orienting the subsampling grid of each batch element. With csr=True, the neighbors and pools of each layer are ragged tuples (offsets, indices) instead of matrices padded with the shadow index. With nested=True, the pooled points of every layer are subsampled from the input points in a single pass on nested grids (barycenters of the input points of each voxel, grids oriented by the rotations of the first pooling layer). With morton=True, the pooled points of each batch element are sorted along a Morton curve. Indices are int32, or int64 with dtype=np.int64. Returns the lists (points, neighbors, pools, upsamples, lengths)";
+
+
+// Declare the functions
+// *********************
+
+static PyObject *build_input_pyramid(PyObject *self, PyObject *args, PyObject *keywds);
+
+
+// Specify the members of the module
+// *********************************
+
+static PyMethodDef module_methods[] =
+{
+	{ "build_pyramid", (PyCFunction)build_input_pyramid, METH_VARARGS | METH_KEYWORDS, build_pyramid_docstring },
+	{NULL, NULL, 0, NULL}
+};
+
+
+// Initialize the module
+// *********************
+
+static struct PyModuleDef moduledef =
+{
+    PyModuleDef_HEAD_INIT,
+    "input_pyramid",        // m_name
+    module_docstring,       // m_doc
+    -1,                     // m_size
+    module_methods,         // m_methods
+    NULL,                   // m_reload
+    NULL,                   // m_traverse
+    NULL,                   // m_clear
+    NULL,                   // m_free
+};
+
+PyMODINIT_FUNC PyInit_input_pyramid(void)
+{
+    import_array();
+	return PyModule_Create(&moduledef);
+}
+
+
+// Conversion of the outputs
+// *************************
+
+// The arrays take over the buffers of the pyramid
+
+static PyObject* points_to_array(vector<PointXYZ>& points)
+{
+	npy_intp dims[2] = { (npy_intp)points.size(), 3 };
+	return vector_to_array(points, 2, dims, NPY_FLOAT);
+}
+
+template <typename IndexT>
+static PyObject* indices_to_array(vector<IndexT>& indices, size_t n_cols)
+{
+	npy_intp dims[2] = { (npy_intp)(n_cols > 0 ? indices.size() / n_cols : 0), (npy_intp)n_cols };
+	return vector_to_array(indices, 2, dims, index_typenum<IndexT>());
+}
+
+template <typename IndexT>
+static PyObject* csr_to_arrays(vector<IndexT>& offsets, vector<IndexT>& indices)
+{
+	// Layers without neighbors have no offsets at all
+	if (offsets.size() < 1)
+		offsets.push_back(0);
+
+	npy_intp offsets_dims[1] = { (npy_intp)offsets.size() };
+	npy_intp indices_dims[1] = { (npy_intp)indices.size() };
+	PyObject* offsets_obj = vector_to_array(offsets, 1, offsets_dims, index_typenum<IndexT>());
+	PyObject* indices_obj = vector_to_array(indices, 1, indices_dims, index_typenum<IndexT>());
+	if (offsets_obj == NULL || indices_obj == NULL)
+	{
+		Py_XDECREF(offsets_obj);
+		Py_XDECREF(indices_obj);
+		return NULL;
+	}
+	return Py_BuildValue("NN", offsets_obj, indices_obj);
+}
+
+static PyObject* lengths_to_array(vector<int>& lengths)
+{
+	npy_intp dims[1] = { (npy_intp)lengths.size() };
+	return vector_to_array(lengths, 1, dims, NPY_INT);
+}
+
+
+// Pyramid of the input points (read in place, and returned as the points of the first layer)
+template <typename IndexT>
+static PyObject* pyramid_outputs(PyObject* points_array,
+                                 vector<int>& lengths,
+                                 vector<LayerSpec>& layers,
+                                 vector<int>& neighbor_limits,
+                                 vector<int>& neighbor_k,
+                                 vector<float>& rotations,
+                                 double first_subsampling_dl,
+                                 double conv_radius,
+                                 double deform_radius,
+                                 bool use_upsamples,
+                                 bool csr,
+                                 bool nested,
+                                 bool morton,
+                                 int n_threads)
+{
+	const PointXYZ* points = (PointXYZ*)PyArray_DATA(points_array);
+
+	// Compute results (without the GIL, so that other python threads can run meanwhile)
+	vector<PyramidLayer<IndexT>> pyramid;
+	Py_BEGIN_ALLOW_THREADS
+	build_pyramid(points,
+	              lengths,
+	              layers,
+	              neighbor_limits,
+	              neighbor_k,
+	              rotations,
+	              first_subsampling_dl,
+	              conv_radius,
+	              deform_radius,
+	              use_upsamples,
+	              csr,
+	              nested,
+	              morton,
+	              n_threads,
+	              pyramid);
+	Py_END_ALLOW_THREADS
+
+
+	// Manage outputs
+	// **************
+
+	int L = (int)layers.size();
+	PyObject* points_list = PyList_New(L);
+	PyObject* neighbors_list = PyList_New(L);
+	PyObject* pools_list = PyList_New(L);
+	PyObject* upsamples_list = PyList_New(L);
+	PyObject* lengths_list = PyList_New(L);
+
+	// Fill the lists with the arrays of each layer (PyList_SET_ITEM steals the references)
+	for (int l = 0; l < L; l++)
+	{
+		PyramidLayer<IndexT>& layer = pyramid[l];
+		if (l == 0)
+		{
+			Py_INCREF(points_array);
+			PyList_SET_ITEM(points_list, l, points_array);
+		}
+		else
+			PyList_SET_ITEM(points_list, l, points_to_array(layer.points));
+		if (layer.ragged)
+		{
+			PyList_SET_ITEM(neighbors_list, l, csr_to_arrays(layer.neighbors_offsets, layer.neighbors));
+			PyList_SET_ITEM(pools_list, l, csr_to_arrays(layer.pools_offsets, layer.pools));
+		}
+		else
+		{
+			PyList_SET_ITEM(neighbors_list, l, indices_to_array(layer.neighbors, layer.neighbors_cols));
+			PyList_SET_ITEM(pools_list, l, indices_to_array(layer.pools, layer.pools_cols));
+		}
+		PyList_SET_ITEM(upsamples_list, l, indices_to_array(layer.upsamples, layer.upsamples_cols));
+		PyList_SET_ITEM(lengths_list, l, lengths_to_array(layer.lengths));
+	}
+
+	// Merge results
+	return Py_BuildValue("NNNNN", points_list, neighbors_list, pools_list, upsamples_list, lengths_list);
+}
+
+
+// Definition of the build_pyramid method
+// **************************************
+
+static PyObject* build_input_pyramid(PyObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	// Args containers
+	PyObject* points_obj = NULL;
+	PyObject* lengths_obj = NULL;
+	PyObject* layers_obj = NULL;
+	PyObject* limits_obj = NULL;
+	PyObject* k_obj = NULL;
+	PyObject* rotations_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "points", "lengths", "layers", "first_subsampling_dl", "conv_radius", "deform_radius",
+	                          "neighbor_limits", "neighbor_k", "rotations", "upsamples", "csr", "nested", "morton",
+	                          "n_threads", "dtype", NULL };
+	double first_subsampling_dl = 0.1;
+	double conv_radius = 2.5;
+	double deform_radius = 5.0;
+	int use_upsamples = 1;
+	int csr = 0;
+	int nested = 0;
+	int morton = 0;
+	int n_threads = 1;
+	int typenum = NPY_INT32;
+
+	// Parse the input
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OOO|$dddOOOppppiO&", kwlist, &points_obj, &lengths_obj, &layers_obj,
+	                                 &first_subsampling_dl, &conv_radius, &deform_radius, &limits_obj, &k_obj,
+	                                 &rotations_obj, &use_upsamples, &csr, &nested, &morton, &n_threads,
+	                                 index_dtype_converter, &typenum))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+
+	// Optional inputs
+	if (limits_obj == Py_None)
+		limits_obj = NULL;
+	if (k_obj == Py_None)
+		k_obj = NULL;
+	if (rotations_obj == Py_None)
+		rotations_obj = NULL;
+
+	// Interpret the input objects as numpy arrays.
+	PyObject* points_array = PyArray_FROM_OTF(points_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	PyObject* lengths_array = PyArray_FROM_OTF(lengths_obj, NPY_INT, NPY_IN_ARRAY);
+	PyObject* layers_array = PyArray_FROM_OTF(layers_obj, NPY_INT, NPY_IN_ARRAY);
+	PyObject* limits_array = NULL;
+	PyObject* k_array = NULL;
+	PyObject* rotations_array = NULL;
+	if (limits_obj != NULL)
+		limits_array = PyArray_FROM_OTF(limits_obj, NPY_INT, NPY_IN_ARRAY);
+	if (k_obj != NULL)
+		k_array = PyArray_FROM_OTF(k_obj, NPY_INT, NPY_IN_ARRAY);
+	if (rotations_obj != NULL)
+		rotations_array = PyArray_FROM_OTF(rotations_obj, NPY_FLOAT, NPY_IN_ARRAY);
+
+	// Verify data was load correctly.
+	string error;
+	if (points_array == NULL)
+		error = "Error converting input points to numpy arrays of type float32";
+	else if (lengths_array == NULL)
+		error = "Error converting input lengths to numpy arrays of type int32";
+	else if (layers_array == NULL)
+		error = "Error converting input layers to numpy arrays of type int32";
+	else if (limits_obj != NULL && limits_array == NULL)
+		error = "Error converting input neighbor_limits to numpy arrays of type int32";
+	else if (k_obj != NULL && k_array == NULL)
+		error = "Error converting input neighbor_k to numpy arrays of type int32";
+	else if (rotations_obj != NULL && rotations_array == NULL)
+		error = "Error converting input rotations to numpy arrays of type float32";
+
+	// Check that the input array respect the dims
+	else if ((int)PyArray_NDIM(points_array) != 2 || (int)PyArray_DIM(points_array, 1) != 3)
+		error = "Wrong dimensions : points.shape is not (N, 3)";
+	else if ((int)PyArray_NDIM(lengths_array) != 1)
+		error = "Wrong dimensions : lengths.shape is not (B,) ";
+	else if ((int)PyArray_NDIM(layers_array) != 2 || (int)PyArray_DIM(layers_array, 1) != 4)
+		error = "Wrong dimensions : layers.shape is not (L, 4)";
+	else if (limits_array != NULL && (int)PyArray_NDIM(limits_array) != 1)
+		error = "Wrong dimensions : neighbor_limits.shape is not (L,) ";
+	else if (k_array != NULL && (int)PyArray_NDIM(k_array) != 1)
+		error = "Wrong dimensions : neighbor_k.shape is not (L,) ";
+	else if (rotations_array != NULL && ((int)PyArray_NDIM(rotations_array) != 4 ||
+	                                     PyArray_DIM(rotations_array, 0) != PyArray_DIM(layers_array, 0) ||
+	                                     PyArray_DIM(rotations_array, 1) != PyArray_DIM(lengths_array, 0) ||
+	                                     PyArray_DIM(rotations_array, 2) != 3 ||
+	                                     PyArray_DIM(rotations_array, 3) != 3))
+		error = "Wrong dimensions : rotations.shape is not (L, B, 3, 3)";
+
+	if (!error.empty())
+	{
+		Py_XDECREF(points_array);
+		Py_XDECREF(lengths_array);
+		Py_XDECREF(layers_array);
+		Py_XDECREF(limits_array);
+		Py_XDECREF(k_array);
+		Py_XDECREF(rotations_array);
+		PyErr_SetString(PyExc_RuntimeError, error.c_str());
+		return NULL;
+	}
+
+	// Number of points, batch elements and layers
+	int N = (int)PyArray_DIM(points_array, 0);
+	int Nb = (int)PyArray_DIM(lengths_array, 0);
+	int L = (int)PyArray_DIM(layers_array, 0);
+
+	// The points are read in place, the small inputs are copied
+	vector<int> lengths((int*)PyArray_DATA(lengths_array), (int*)PyArray_DATA(lengths_array) + Nb);
+	vector<LayerSpec> layers;
+	int* layer_flags = (int*)PyArray_DATA(layers_array);
+	for (int l = 0; l < L; l++)
+		layers.push_back(LayerSpec(layer_flags[4 * l] != 0,
+		                           layer_flags[4 * l + 1] != 0,
+		                           layer_flags[4 * l + 2] != 0,
+		                           layer_flags[4 * l + 3] != 0));
+	vector<int> neighbor_limits;
+	if (limits_array != NULL)
+		neighbor_limits = vector<int>((int*)PyArray_DATA(limits_array),
+		                              (int*)PyArray_DATA(limits_array) + PyArray_SIZE(limits_array));
+	vector<int> neighbor_k;
+	if (k_array != NULL)
+		neighbor_k = vector<int>((int*)PyArray_DATA(k_array), (int*)PyArray_DATA(k_array) + PyArray_SIZE(k_array));
+	vector<float> rotations;
+	if (rotations_array != NULL)
+		rotations = vector<float>((float*)PyArray_DATA(rotations_array),
+		                          (float*)PyArray_DATA(rotations_array) + PyArray_SIZE(rotations_array));
+
+	Py_XDECREF(lengths_array);
+	Py_XDECREF(layers_array);
+	Py_XDECREF(limits_array);
+	Py_XDECREF(k_array);
+	Py_XDECREF(rotations_array);
+
+	// Check the batch lengths
+	if (accumulate(lengths.begin(), lengths.end(), (long long)0) != N)
+	{
+		Py_XDECREF(points_array);
+		PyErr_SetString(PyExc_RuntimeError, "Wrong batch lengths : the sum of lengths is not the number of points");
+		return NULL;
+	}
+
+	// Compute results, with indices of the required type
+	PyObject* ret = NULL;
+	if (typenum == NPY_INT64)
+		ret = pyramid_outputs<int64_t>(points_array, lengths, layers, neighbor_limits, neighbor_k, rotations,
+		                               first_subsampling_dl, conv_radius, deform_radius, use_upsamples != 0, csr != 0,
+		                               nested != 0, morton != 0, n_threads);
+	else
+		ret = pyramid_outputs<int>(points_array, lengths, layers, neighbor_limits, neighbor_k, rotations,
+		                           first_subsampling_dl, conv_radius, deform_radius, use_upsamples != 0, csr != 0,
+		                           nested != 0, morton != 0, n_threads);
+
+	Py_XDECREF(points_array);
+
+	return ret;
+}
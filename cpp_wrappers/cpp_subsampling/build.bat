@@ -1,5 +0,0 @@
-@echo off
-py setup.py build_ext --inplace
-
-
-pause
\ No newline at end of file
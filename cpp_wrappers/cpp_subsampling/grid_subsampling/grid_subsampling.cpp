@@ -2,80 +2,90 @@
 #include "grid_subsampling.h"
 
 
-void grid_subsampling(vector<PointXYZ>& original_points,
-                      vector<PointXYZ>& subsampled_points,
-                      vector<float>& original_features,
-                      vector<float>& subsampled_features,
-                      vector<int>& original_classes,
-                      vector<int>& subsampled_classes,
-                      float sampleDl,
-                      int verbose) {
-
-	// Initialize variables
-	// ******************
-
-	// Number of points in the cloud
-	size_t N = original_points.size();
+GridAccumulator::GridAccumulator(PointXYZ minCorner, PointXYZ maxCorner, float sampleDl, size_t fdim, size_t ldim)
+{
+	this->sampleDl = sampleDl;
+	this->fdim = fdim;
+	this->ldim = ldim;
+	label_min = 0;
+	n_labels = 0;
+	labels_range = false;
 
-	// Dimension of the features
-	size_t fdim = original_features.size() / N;
-	size_t ldim = original_classes.size() / N;
-
-	// Limits of the cloud
-	PointXYZ minCorner = min_point(original_points);
-	PointXYZ maxCorner = max_point(original_points);
-	PointXYZ originCorner = floor(minCorner * (1/sampleDl)) * sampleDl;
+	// Origin of the grid
+	originCorner = floor(minCorner * (1/sampleDl)) * sampleDl;
 
 	// Dimensions of the grid
-	size_t sampleNX = (size_t)floor((maxCorner.x - originCorner.x) / sampleDl) + 1;
-	size_t sampleNY = (size_t)floor((maxCorner.y - originCorner.y) / sampleDl) + 1;
-	//size_t sampleNZ = (size_t)floor((maxCorner.z - originCorner.z) / sampleDl) + 1;
-
-	// Check if features and classes need to be processed
-	bool use_feature = original_features.size() > 0;
-	bool use_classes = original_classes.size() > 0;
+	sampleNX = (size_t)floor((maxCorner.x - originCorner.x) / sampleDl) + 1;
+	sampleNY = (size_t)floor((maxCorner.y - originCorner.y) / sampleDl) + 1;
+	//sampleNZ = (size_t)floor((maxCorner.z - originCorner.z) / sampleDl) + 1;
+}
 
 
-	// Create the sampled map
-	// **********************
+void GridAccumulator::add(const PointXYZ* points, size_t N, const float* features, const int* classes, int verbose)
+{
+	// Check if features and classes need to be processed
+	bool use_feature = fdim > 0;
+	bool use_classes = ldim > 0;
 
 	// Verbose parameters
 	int i = 0;
 	int nDisp = N / 100;
 
+	// Range of the labels, for the dense votes
+	if (use_classes && !labels_range && N > 0)
+	{
+		auto minmax = minmax_element(classes, classes + N * ldim);
+		if ((int64_t)*minmax.second - *minmax.first < max_dense_labels)
+		{
+			label_min = *minmax.first;
+			n_labels = (size_t)(*minmax.second - *minmax.first + 1);
+		}
+		labels_range = true;
+	}
+
 	// Initialize variables
-	size_t iX, iY, iZ, mapIdx;
-	unordered_map<size_t, SampledData> data;
+	size_t mapIdx;
 
-	for (auto& p : original_points)
+	for (const PointXYZ* p_it = points; p_it != points + N; p_it++)
 	{
+		const PointXYZ& p = *p_it;
+
 		// Position of point in sample map
-		iX = (size_t)floor((p.x - originCorner.x) / sampleDl);
-		iY = (size_t)floor((p.y - originCorner.y) / sampleDl);
-		iZ = (size_t)floor((p.z - originCorner.z) / sampleDl);
-		mapIdx = iX + sampleNX*iY + sampleNX*sampleNY*iZ;
+		mapIdx = voxel_key(p);
 
 		// If not already created, create key
 		if (data.count(mapIdx) < 1)
-			data.emplace(mapIdx, SampledData(fdim, ldim));
+			data.emplace(mapIdx, SampledData(fdim, ldim, n_labels));
 
 		// Fill the sample map
 		if (use_feature && use_classes)
-			data[mapIdx].update_all(p, original_features.begin() + i * fdim, original_classes.begin() + i * ldim);
+			data[mapIdx].update_all(p, features + i * fdim, classes + i * ldim, ldim, label_min);
 		else if (use_feature)
-			data[mapIdx].update_features(p, original_features.begin() + i * fdim);
+			data[mapIdx].update_features(p, features + i * fdim);
 		else if (use_classes)
-			data[mapIdx].update_classes(p, original_classes.begin() + i * ldim);
+			data[mapIdx].update_classes(p, classes + i * ldim, ldim, label_min);
 		else
 			data[mapIdx].update_points(p);
 
 		// Display
 		i++;
-		if (verbose > 1 && i%nDisp == 0)
+		if (verbose > 1 && nDisp > 0 && i%nDisp == 0)
 			std::cout << "\rSampled Map : " << std::setw(3) << i / nDisp << "%";
 
 	}
 
+	return;
+}
+
+
+void GridAccumulator::results(vector<PointXYZ>& subsampled_points,
+                              vector<float>& subsampled_features,
+                              vector<int>& subsampled_classes)
+{
+	// Check if features and classes need to be processed
+	bool use_feature = fdim > 0;
+	bool use_classes = ldim > 0;
+
 	// Divide for barycentre and transfer to a vector
 	subsampled_points.reserve(data.size());
 	if (use_feature)
@@ -84,6 +94,7 @@ void grid_subsampling(vector<PointXYZ>& original_points,
 		subsampled_classes.reserve(data.size() * ldim);
 	for (auto& v : data)
 	{
+		v.second.index = (int)subsampled_points.size();
 		subsampled_points.push_back(v.second.point * (1.0 / v.second.count));
 		if (use_feature)
 		{
@@ -96,9 +107,8 @@ void grid_subsampling(vector<PointXYZ>& original_points,
 		}
 		if (use_classes)
 		{
-		    for (int i = 0; i < ldim; i++)
-		        subsampled_classes.push_back(max_element(v.second.labels[i].begin(), v.second.labels[i].end(),
-		        [](const pair<int, int>&a, const pair<int, int>&b){return a.second < b.second;})->first);
+		    for (size_t i = 0; i < ldim; i++)
+		        subsampled_classes.push_back(v.second.majority(i, ldim, label_min));
 		}
 	}
 
@@ -106,106 +116,631 @@ void grid_subsampling(vector<PointXYZ>& original_points,
 }
 
 
-void batch_grid_subsampling(vector<PointXYZ>& original_points,
-                              vector<PointXYZ>& subsampled_points,
-                              vector<float>& original_features,
-                              vector<float>& subsampled_features,
-                              vector<int>& original_classes,
-                              vector<int>& subsampled_classes,
-                              vector<int>& original_batches,
-                              vector<int>& subsampled_batches,
-                              float sampleDl,
-                              int max_p)
+void GridAccumulator::voxel_indices(const PointXYZ* points, size_t N, int* inds)
+{
+	for (size_t i = 0; i < N; i++)
+	{
+		auto it = data.find(voxel_key(points[i]));
+		inds[i] = it != data.end() ? it->second.index : -1;
+	}
+	return;
+}
+
+
+void GridAccumulator::voxel_counts(vector<int>& counts)
 {
+	counts.resize(data.size());
+	for (auto& v : data)
+	{
+		if (v.second.index >= 0)
+			counts[v.second.index] = v.second.count;
+	}
+	return;
+}
+
+
+void grid_subsampling(const PointXYZ* original_points,
+                      size_t N,
+                      vector<PointXYZ>& subsampled_points,
+                      const float* original_features,
+                      size_t fdim,
+                      vector<float>& subsampled_features,
+                      const int* original_classes,
+                      size_t ldim,
+                      vector<int>& subsampled_classes,
+                      float sampleDl,
+                      int verbose,
+                      vector<int>* voxel_inds,
+                      vector<int>* voxel_counts) {
+
 	// Initialize variables
 	// ******************
 
-	int b = 0;
-	int sum_b = 0;
+	// Nothing to subsample
+	if (N == 0)
+		return;
+
+	// Check if features and classes need to be processed
+	bool use_feature = original_features != NULL && fdim > 0;
+	bool use_classes = original_classes != NULL && ldim > 0;
+	if (!use_feature)
+		fdim = 0;
+	if (!use_classes)
+		ldim = 0;
+
+	// Limits of the cloud
+	PointXYZ minCorner = min_point(original_points, N);
+	PointXYZ maxCorner = max_point(original_points, N);
+
+
+	// Create the sampled map
+	// **********************
+
+	GridAccumulator grid(minCorner, maxCorner, sampleDl, fdim, ldim);
+	grid.add(original_points, N, original_features, original_classes, verbose);
+	grid.results(subsampled_points, subsampled_features, subsampled_classes);
+
+	// Voxel of each original point
+	if (voxel_inds != NULL)
+	{
+		voxel_inds->resize(N);
+		grid.voxel_indices(original_points, N, voxel_inds->data());
+	}
+	if (voxel_counts != NULL)
+		grid.voxel_counts(*voxel_counts);
+
+	return;
+}
+
+
+// Stable LSD radix sort of the keys, 8 bits per pass, moving the point indices along. Only the bytes needed by max_key
+// are sorted, and the passes where all keys share the same byte are skipped.
+static void radix_sort(vector<uint64_t>& keys, vector<uint32_t>& order, uint64_t max_key)
+{
+	size_t N = keys.size();
+	vector<uint64_t> tmp_keys(N);
+	vector<uint32_t> tmp_order(N);
+
+	for (int shift = 0; shift < 64 && (max_key >> shift) > 0; shift += 8)
+	{
+		// Histogram of the current byte
+		size_t counts[256] = { 0 };
+		for (size_t i = 0; i < N; i++)
+			counts[(keys[i] >> shift) & 0xFF]++;
+		if (counts[(keys[0] >> shift) & 0xFF] == N)
+			continue;
+
+		// Start of each bucket
+		size_t offset = 0;
+		for (int d = 0; d < 256; d++)
+		{
+			size_t c = counts[d];
+			counts[d] = offset;
+			offset += c;
+		}
+
+		// Scatter
+		for (size_t i = 0; i < N; i++)
+		{
+			size_t j = counts[(keys[i] >> shift) & 0xFF]++;
+			tmp_keys[j] = keys[i];
+			tmp_order[j] = order[i];
+		}
+		keys.swap(tmp_keys);
+		order.swap(tmp_order);
+	}
+	return;
+}
+
+
+void sorted_grid_subsampling(const PointXYZ* original_points,
+                             size_t N,
+                             vector<PointXYZ>& subsampled_points,
+                             const float* original_features,
+                             size_t fdim,
+                             vector<float>& subsampled_features,
+                             const int* original_classes,
+                             size_t ldim,
+                             vector<int>& subsampled_classes,
+                             float sampleDl,
+                             int verbose,
+                             vector<int>* voxel_inds,
+                             vector<int>* voxel_counts) {
+
+	// Initialize variables
+	// ******************
+
+	// Nothing to subsample
+	if (N == 0)
+		return;
+
+	// Check if features and classes need to be processed
+	bool use_feature = original_features != NULL && fdim > 0;
+	bool use_classes = original_classes != NULL && ldim > 0;
+	if (!use_feature)
+		fdim = 0;
+	if (!use_classes)
+		ldim = 0;
+
+	// Limits of the cloud
+	PointXYZ minCorner = min_point(original_points, N);
+	PointXYZ maxCorner = max_point(original_points, N);
+	PointXYZ originCorner = floor(minCorner * (1/sampleDl)) * sampleDl;
+
+	// Dimensions of the grid
+	size_t sampleNX = (size_t)floor((maxCorner.x - originCorner.x) / sampleDl) + 1;
+	size_t sampleNY = (size_t)floor((maxCorner.y - originCorner.y) / sampleDl) + 1;
+
+
+	// Sort the points by voxel
+	// ************************
+
+	// Verbose parameters
+	int nDisp = N / 100;
+
+	// Voxel key of every point (same keys as grid_subsampling), and point indices (the python wrapper limits N to int)
+	vector<uint64_t> keys(N);
+	vector<uint32_t> order(N);
+	uint64_t max_key = 0;
+	for (size_t i = 0; i < N; i++)
+	{
+		const PointXYZ& p = original_points[i];
+		size_t iX = (size_t)floor((p.x - originCorner.x) / sampleDl);
+		size_t iY = (size_t)floor((p.y - originCorner.y) / sampleDl);
+		size_t iZ = (size_t)floor((p.z - originCorner.z) / sampleDl);
+		keys[i] = iX + sampleNX*iY + sampleNX*sampleNY*iZ;
+		order[i] = (uint32_t)i;
+		max_key = max(max_key, keys[i]);
+
+		// Display
+		if (verbose > 1 && nDisp > 0 && (i + 1) % nDisp == 0)
+			std::cout << "\rSampled Map : " << std::setw(3) << (i + 1) / nDisp << "%";
+	}
+
+	// The sort is stable, so the points of a voxel stay in their input order and are summed in the same order as in
+	// grid_subsampling
+	radix_sort(keys, order, max_key);
+
+
+	// Reduce the voxels
+	// *****************
+
+	if (voxel_inds != NULL)
+		voxel_inds->resize(N);
+
+	vector<float> features(fdim);
+	vector<int> votes;
+	size_t i0 = 0;
+	while (i0 < N)
+	{
+		// Run of points in the same voxel
+		size_t i1 = i0 + 1;
+		while (i1 < N && keys[i1] == keys[i0])
+			i1++;
+		int count = (int)(i1 - i0);
+
+		// Voxel of each original point
+		if (voxel_inds != NULL)
+		{
+			for (size_t i = i0; i < i1; i++)
+				(*voxel_inds)[order[i]] = (int)subsampled_points.size();
+		}
+		if (voxel_counts != NULL)
+			voxel_counts->push_back(count);
+
+		// Barycenter
+		PointXYZ point = PointXYZ();
+		for (size_t i = i0; i < i1; i++)
+			point += original_points[order[i]];
+		subsampled_points.push_back(point * (1.0 / count));
+
+		// Mean features
+		if (use_feature)
+		{
+			fill(features.begin(), features.end(), 0.0f);
+			for (size_t i = i0; i < i1; i++)
+			{
+				const float* f_begin = original_features + order[i] * fdim;
+				transform(features.begin(), features.end(), f_begin, features.begin(), plus<float>());
+			}
+			float fcount = (float)count;
+			for (auto& f : features)
+				subsampled_features.push_back(f / fcount);
+		}
+
+		// Majority labels, found in the sorted votes of the voxel (the smallest label wins ties)
+		if (use_classes)
+		{
+			for (size_t c = 0; c < ldim; c++)
+			{
+				votes.clear();
+				for (size_t i = i0; i < i1; i++)
+					votes.push_back(original_classes[order[i] * ldim + c]);
+				sort(votes.begin(), votes.end());
+				int best_label = votes[0];
+				size_t best_count = 0;
+				size_t j0 = 0;
+				while (j0 < votes.size())
+				{
+					size_t j1 = j0 + 1;
+					while (j1 < votes.size() && votes[j1] == votes[j0])
+						j1++;
+					if (j1 - j0 > best_count)
+					{
+						best_count = j1 - j0;
+						best_label = votes[j0];
+					}
+					j0 = j1;
+				}
+				subsampled_classes.push_back(best_label);
+			}
+		}
+
+		i0 = i1;
+	}
+
+	return;
+}
+
+
+void rotate_points(PointXYZ* points, size_t n, const float* R, bool transpose)
+{
+	for (size_t i = 0; i < n; i++)
+	{
+		PointXYZ p = points[i];
+		float* q = &points[i].x;
+		for (int k = 0; k < 3; k++)
+		{
+			if (transpose)
+				q[k] = p.x * R[3 * k] + p.y * R[3 * k + 1] + p.z * R[3 * k + 2];
+			else
+				q[k] = p.x * R[k] + p.y * R[3 + k] + p.z * R[6 + k];
+		}
+	}
+	return;
+}
+
+
+void batch_grid_subsampling(const PointXYZ* original_points,
+                            vector<PointXYZ>& subsampled_points,
+                            const float* original_features,
+                            size_t fdim,
+                            vector<float>& subsampled_features,
+                            const int* original_classes,
+                            size_t ldim,
+                            vector<int>& subsampled_classes,
+                            vector<int>& original_batches,
+                            vector<int>& subsampled_batches,
+                            const float* rotations,
+                            float sampleDl,
+                            int max_p,
+                            int n_threads)
+{
+	// Initialize variables
+	// ******************
+
+	size_t Nb = original_batches.size();
 
 	// Number of points in the cloud
-	size_t N = original_points.size();
+	size_t N = accumulate(original_batches.begin(), original_batches.end(), (size_t)0);
 
-	// Dimension of the features
-	size_t fdim = original_features.size() / N;
-	size_t ldim = original_classes.size() / N;
+	// Check if features and classes need to be processed
+	bool use_feature = original_features != NULL && fdim > 0;
+	bool use_classes = original_classes != NULL && ldim > 0;
 
 	// Handle max_p = 0
 	if (max_p < 1)
 	    max_p = N;
 
-	// Loop over batches
-	// *****************
+	// Start of each batch element in the inputs
+	vector<size_t> starts(Nb, 0);
+	for (size_t b = 1; b < Nb; b++)
+		starts[b] = starts[b - 1] + original_batches[b - 1];
+
+	// Subsample the batch elements concurrently
+	// *****************************************
+
+	// Result containers of each batch element
+	vector<vector<PointXYZ>> b_s_points(Nb);
+	vector<vector<float>> b_s_features(Nb);
+	vector<vector<int>> b_s_classes(Nb);
+
+	parallel_for((int)Nb, n_threads, [&](int b)
+	{
+		// Points of the batch element, read in place or rotated in a copy to orient the grid
+		const PointXYZ* b_points = original_points + starts[b];
+		vector<PointXYZ> b_rotated_points;
+		if (rotations != NULL)
+		{
+			b_rotated_points.assign(b_points, b_points + original_batches[b]);
+			rotate_points(b_rotated_points.data(), b_rotated_points.size(), rotations + 9 * b, false);
+			b_points = b_rotated_points.data();
+		}
+
+		// Compute subsampling on current batch, reading its points features and labels in place
+		grid_subsampling(b_points,
+		                 original_batches[b],
+		                 b_s_points[b],
+		                 use_feature ? original_features + starts[b] * fdim : NULL,
+		                 fdim,
+		                 b_s_features[b],
+		                 use_classes ? original_classes + starts[b] * ldim : NULL,
+		                 ldim,
+		                 b_s_classes[b],
+		                 sampleDl,
+		                 0);
+		vector<PointXYZ>().swap(b_rotated_points);
+
+		// If too many points remove some
+		if (b_s_points[b].size() > max_p)
+		{
+			b_s_points[b].resize(max_p);
+			if (use_feature)
+				b_s_features[b].resize(max_p * fdim);
+			if (use_classes)
+				b_s_classes[b].resize(max_p * ldim);
+		}
+
+		// Back to the original orientation
+		if (rotations != NULL)
+			rotate_points(b_s_points[b].data(), b_s_points[b].size(), rotations + 9 * b, true);
+	});
+
+	// Stack batches points features and labels
+	// ****************************************
+
+	// Position of each batch element in the outputs (prefix sum of the subsampled lengths)
+	vector<size_t> offsets(Nb + 1, subsampled_points.size());
+	for (size_t b = 0; b < Nb; b++)
+	{
+		subsampled_batches.push_back(b_s_points[b].size());
+		offsets[b + 1] = offsets[b] + b_s_points[b].size();
+	}
+	subsampled_points.resize(offsets[Nb]);
+	if (use_feature)
+		subsampled_features.resize(offsets[Nb] * fdim);
+	if (use_classes)
+		subsampled_classes.resize(offsets[Nb] * ldim);
+
+	// Copy each batch element at its position
+	parallel_for((int)Nb, n_threads, [&](int b)
+	{
+		copy(b_s_points[b].begin(), b_s_points[b].end(), subsampled_points.begin() + offsets[b]);
+		if (use_feature)
+			copy(b_s_features[b].begin(), b_s_features[b].end(), subsampled_features.begin() + offsets[b] * fdim);
+		if (use_classes)
+			copy(b_s_classes[b].begin(), b_s_classes[b].end(), subsampled_classes.begin() + offsets[b] * ldim);
+	});
+
+	return;
+}
+
+
+void pyramid_grid_subsampling(const PointXYZ* original_points,
+                              size_t N,
+                              vector<vector<PointXYZ>>& subsampled_points,
+                              float sampleDl,
+                              int n_levels)
+{
+
+	// Initialize variables
+	// ******************
+
+	subsampled_points = vector<vector<PointXYZ>>(max(n_levels, 0));
 
-	for (b = 0; b < original_batches.size(); b++)
+	// Nothing to subsample
+	if (N == 0 || n_levels < 1)
+		return;
+
+	// Grid of the first level
+	PointXYZ minCorner = min_point(original_points, N);
+	PointXYZ maxCorner = max_point(original_points, N);
+	PointXYZ originCorner = floor(minCorner * (1/sampleDl)) * sampleDl;
+	size_t sampleNX = (size_t)floor((maxCorner.x - originCorner.x) / sampleDl) + 1;
+	size_t sampleNY = (size_t)floor((maxCorner.y - originCorner.y) / sampleDl) + 1;
+
+	// Integer coordinates, sums of points and counts of the voxels of the current level
+	vector<size_t> cells;
+	vector<PointXYZ> sums;
+	vector<int> counts;
+	unordered_map<size_t, size_t> voxels;
+
+
+	// First level, from the points
+	// ****************************
+
+	for (size_t i = 0; i < N; i++)
 	{
+		const PointXYZ& p = original_points[i];
+		size_t iX = (size_t)floor((p.x - originCorner.x) / sampleDl);
+		size_t iY = (size_t)floor((p.y - originCorner.y) / sampleDl);
+		size_t iZ = (size_t)floor((p.z - originCorner.z) / sampleDl);
+		auto it = voxels.emplace(iX + sampleNX*iY + sampleNX*sampleNY*iZ, counts.size());
+		if (it.second)
+		{
+			cells.insert(cells.end(), { iX, iY, iZ });
+			sums.push_back(p);
+			counts.push_back(1);
+		}
+		else
+		{
+			sums[it.first->second] += p;
+			counts[it.first->second] += 1;
+		}
+	}
+
+
+	// Next levels, from the voxels of the previous one
+	// ************************************************
+
+	for (int l = 0; l < n_levels; l++)
+	{
+		// Barycenters of the level
+		subsampled_points[l].reserve(counts.size());
+		for (size_t j = 0; j < counts.size(); j++)
+			subsampled_points[l].push_back(sums[j] * (1.0 / counts[j]));
+
+		if (l + 1 == n_levels)
+			break;
+
+		// Merge the voxels into their parents
+		sampleNX = ((sampleNX - 1) >> 1) + 1;
+		sampleNY = ((sampleNY - 1) >> 1) + 1;
+		vector<size_t> parent_cells;
+		vector<PointXYZ> parent_sums;
+		vector<int> parent_counts;
+		voxels.clear();
+		for (size_t j = 0; j < counts.size(); j++)
+		{
+			size_t iX = cells[3 * j] >> 1;
+			size_t iY = cells[3 * j + 1] >> 1;
+			size_t iZ = cells[3 * j + 2] >> 1;
+			auto it = voxels.emplace(iX + sampleNX*iY + sampleNX*sampleNY*iZ, parent_counts.size());
+			if (it.second)
+			{
+				parent_cells.insert(parent_cells.end(), { iX, iY, iZ });
+				parent_sums.push_back(sums[j]);
+				parent_counts.push_back(counts[j]);
+			}
+			else
+			{
+				parent_sums[it.first->second] += sums[j];
+				parent_counts[it.first->second] += counts[j];
+			}
+		}
+		cells.swap(parent_cells);
+		sums.swap(parent_sums);
+		counts.swap(parent_counts);
+	}
+
+	return;
+}
 
-	    // Extract batch points features and labels
-	    vector<PointXYZ> b_o_points = vector<PointXYZ>(original_points.begin () + sum_b,
-	                                                   original_points.begin () + sum_b + original_batches[b]);
 
-        vector<float> b_o_features;
-        if (original_features.size() > 0)
-        {
-            b_o_features = vector<float>(original_features.begin () + sum_b * fdim,
-                                         original_features.begin () + (sum_b + original_batches[b]) * fdim);
-	    }
+void batch_pyramid_grid_subsampling(const PointXYZ* original_points,
+                                    vector<int>& original_batches,
+                                    vector<vector<PointXYZ>>& subsampled_points,
+                                    vector<vector<int>>& subsampled_batches,
+                                    const float* rotations,
+                                    float sampleDl,
+                                    int n_levels,
+                                    int n_threads)
+{
+	// Initialize variables
+	// ******************
 
-	    vector<int> b_o_classes;
-        if (original_classes.size() > 0)
-        {
-            b_o_classes = vector<int>(original_classes.begin () + sum_b * ldim,
-                                      original_classes.begin () + sum_b + original_batches[b] * ldim);
-	    }
+	size_t Nb = original_batches.size();
+	n_levels = max(n_levels, 0);
 
+	// Start of each batch element in the input points
+	vector<size_t> starts(Nb + 1, 0);
+	for (size_t b = 0; b < Nb; b++)
+		starts[b + 1] = starts[b] + original_batches[b];
 
-        // Create result containers
-        vector<PointXYZ> b_s_points;
-        vector<float> b_s_features;
-        vector<int> b_s_classes;
 
-        // Compute subsampling on current batch
-        grid_subsampling(b_o_points,
-                         b_s_points,
-                         b_o_features,
-                         b_s_features,
-                         b_o_classes,
-                         b_s_classes,
-                         sampleDl,
-						 0);
+	// Subsample each batch element in parallel, into its own levels
+	// *************************************************************
 
-        // Stack batches points features and labels
-        // ****************************************
+	vector<vector<vector<PointXYZ>>> b_s_points(Nb);
+	parallel_for((int)Nb, n_threads, [&](int b)
+	{
+		// Points of the batch element, read in place or rotated in a copy to orient the grid
+		const PointXYZ* b_points = original_points + starts[b];
+		vector<PointXYZ> b_rotated_points;
+		if (rotations != NULL)
+		{
+			b_rotated_points.assign(b_points, b_points + original_batches[b]);
+			rotate_points(b_rotated_points.data(), b_rotated_points.size(), rotations + 9 * b, false);
+			b_points = b_rotated_points.data();
+		}
 
-        // If too many points remove some
-        if (b_s_points.size() <= max_p)
-        {
-            subsampled_points.insert(subsampled_points.end(), b_s_points.begin(), b_s_points.end());
+		pyramid_grid_subsampling(b_points, original_batches[b], b_s_points[b], sampleDl, n_levels);
+		vector<PointXYZ>().swap(b_rotated_points);
 
-            if (original_features.size() > 0)
-                subsampled_features.insert(subsampled_features.end(), b_s_features.begin(), b_s_features.end());
+		// Back to the original orientation
+		if (rotations != NULL)
+		{
+			for (auto& level_points : b_s_points[b])
+				rotate_points(level_points.data(), level_points.size(), rotations + 9 * b, true);
+		}
+	});
 
-            if (original_classes.size() > 0)
-                subsampled_classes.insert(subsampled_classes.end(), b_s_classes.begin(), b_s_classes.end());
 
-            subsampled_batches.push_back(b_s_points.size());
-        }
-        else
-        {
-            subsampled_points.insert(subsampled_points.end(), b_s_points.begin(), b_s_points.begin() + max_p);
+	// Stack the batch elements of each level
+	// **************************************
 
-            if (original_features.size() > 0)
-                subsampled_features.insert(subsampled_features.end(), b_s_features.begin(), b_s_features.begin() + max_p * fdim);
+	subsampled_points = vector<vector<PointXYZ>>(n_levels);
+	subsampled_batches = vector<vector<int>>(n_levels, vector<int>(Nb));
+	for (int l = 0; l < n_levels; l++)
+	{
+		for (size_t b = 0; b < Nb; b++)
+		{
+			subsampled_batches[l][b] = (int)b_s_points[b][l].size();
+			subsampled_points[l].insert(subsampled_points[l].end(), b_s_points[b][l].begin(), b_s_points[b][l].end());
+			vector<PointXYZ>().swap(b_s_points[b][l]);
+		}
+	}
 
-            if (original_classes.size() > 0)
-                subsampled_classes.insert(subsampled_classes.end(), b_s_classes.begin(), b_s_classes.begin() + max_p * ldim);
+	return;
+}
 
-            subsampled_batches.push_back(max_p);
-        }
 
-        // Stack new batch lengths
-        sum_b += original_batches[b];
+// Spread the 21 lower bits of a, with two zero bits between each of them
+static uint64_t spread_bits(uint64_t a)
+{
+	a &= 0x1FFFFF;
+	a = (a | a << 32) & 0x1F00000000FFFF;
+	a = (a | a << 16) & 0x1F0000FF0000FF;
+	a = (a | a << 8) & 0x100F00F00F00F00F;
+	a = (a | a << 4) & 0x10C30C30C30C30C3;
+	a = (a | a << 2) & 0x1249249249249249;
+	return a;
+}
+
+
+void morton_order(const PointXYZ* points, size_t n, float cellDl, vector<uint32_t>& order)
+{
+	order.resize(n);
+	iota(order.begin(), order.end(), 0);
+	if (n == 0)
+		return;
+
+	// Morton keys of the cells of the points
+	PointXYZ minCorner = min_point(points, n);
+	vector<uint64_t> keys(n);
+	uint64_t max_key = 0;
+	for (size_t i = 0; i < n; i++)
+	{
+		uint64_t iX = min((uint64_t)floor((points[i].x - minCorner.x) / cellDl), (uint64_t)0x1FFFFF);
+		uint64_t iY = min((uint64_t)floor((points[i].y - minCorner.y) / cellDl), (uint64_t)0x1FFFFF);
+		uint64_t iZ = min((uint64_t)floor((points[i].z - minCorner.z) / cellDl), (uint64_t)0x1FFFFF);
+		keys[i] = spread_bits(iX) | spread_bits(iY) << 1 | spread_bits(iZ) << 2;
+		max_key = max(max_key, keys[i]);
 	}
 
+	radix_sort(keys, order, max_key);
+	return;
+}
+
+
+void batch_morton_sort(vector<PointXYZ>& points, vector<int>& lengths, float cellDl, int n_threads)
+{
+	// Start of each batch element
+	size_t Nb = lengths.size();
+	vector<size_t> starts(Nb + 1, 0);
+	for (size_t b = 0; b < Nb; b++)
+		starts[b + 1] = starts[b] + lengths[b];
+
+	parallel_for((int)Nb, n_threads, [&](int b)
+	{
+		PointXYZ* b_points = points.data() + starts[b];
+		vector<uint32_t> order;
+		morton_order(b_points, lengths[b], cellDl, order);
+		vector<PointXYZ> sorted_points(order.size());
+		for (size_t i = 0; i < order.size(); i++)
+			sorted_points[i] = b_points[order[i]];
+		copy(sorted_points.begin(), sorted_points.end(), b_points);
+	});
+
 	return;
 }
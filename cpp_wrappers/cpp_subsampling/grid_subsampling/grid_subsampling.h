@@ -1,6 +1,7 @@
 
 
 #include "../../cpp_utils/cloud/cloud.h"
+#include "../../cpp_utils/parallel/parallel.h"
 
 #include <set>
 #include <cstdint>
@@ -15,8 +16,10 @@ public:
 	// ********
 
 	int count;
+	int index;
 	PointXYZ point;
 	vector<float> features;
+	vector<int> votes;
 	vector<unordered_map<int, int>> labels;
 
 
@@ -27,48 +30,59 @@ public:
 	SampledData() 
 	{ 
 		count = 0; 
+		index = -1;
 		point = PointXYZ();
 	}
 
-	SampledData(const size_t fdim, const size_t ldim)
+	// Labels are voted in dense counts (ldim, n_labels) for the labels in [label_min, label_min + n_labels), and in maps
+	// for the others (which are only created when needed)
+	SampledData(const size_t fdim, const size_t ldim, const size_t n_labels = 0)
 	{
 		count = 0;
+		index = -1;
 		point = PointXYZ();
 	    features = vector<float>(fdim);
-	    labels = vector<unordered_map<int, int>>(ldim);
+	    votes = vector<int>(ldim * n_labels);
 	}
 
 	// Method Update
-	void update_all(const PointXYZ p, vector<float>::iterator f_begin, vector<int>::iterator l_begin)
+	void vote(const int* l_begin, const size_t ldim, const int label_min)
+	{
+		size_t n_labels = votes.size() / ldim;
+		for (size_t i = 0; i < ldim; i++)
+		{
+			size_t c = (size_t)((int64_t)l_begin[i] - label_min);
+			if (c < n_labels)
+				votes[i * n_labels + c] += 1;
+			else
+			{
+				if (labels.empty())
+					labels = vector<unordered_map<int, int>>(ldim);
+				labels[i][l_begin[i]] += 1;
+			}
+		}
+		return;
+	}
+	void update_all(const PointXYZ p, const float* f_begin, const int* l_begin, const size_t ldim, const int label_min)
 	{
 		count += 1;
 		point += p;
 		transform (features.begin(), features.end(), f_begin, features.begin(), plus<float>());
-		int i = 0;
-		for(vector<int>::iterator it = l_begin; it != l_begin + labels.size(); ++it)
-		{
-		    labels[i][*it] += 1;
-		    i++;
-		}
+		vote(l_begin, ldim, label_min);
 		return;
 	}
-	void update_features(const PointXYZ p, vector<float>::iterator f_begin)
+	void update_features(const PointXYZ p, const float* f_begin)
 	{
 		count += 1;
 		point += p;
 		transform (features.begin(), features.end(), f_begin, features.begin(), plus<float>());
 		return;
 	}
-	void update_classes(const PointXYZ p, vector<int>::iterator l_begin)
+	void update_classes(const PointXYZ p, const int* l_begin, const size_t ldim, const int label_min)
 	{
 		count += 1;
 		point += p;
-		int i = 0;
-		for(vector<int>::iterator it = l_begin; it != l_begin + labels.size(); ++it)
-		{
-		    labels[i][*it] += 1;
-		    i++;
-		}
+		vote(l_begin, ldim, label_min);
 		return;
 	}
 	void update_points(const PointXYZ p)
@@ -77,25 +91,171 @@ public:
 		point += p;
 		return;
 	}
+
+	// Majority label of the label dimension i (the smallest label wins the ties of the dense counts)
+	int majority(const size_t i, const size_t ldim, const int label_min)
+	{
+		size_t n_labels = votes.size() / ldim;
+		int best_label = 0;
+		int best_count = 0;
+		for (size_t c = 0; c < n_labels; c++)
+		{
+			if (votes[i * n_labels + c] > best_count)
+			{
+				best_label = label_min + (int)c;
+				best_count = votes[i * n_labels + c];
+			}
+		}
+		if (!labels.empty())
+		{
+			for (auto& l : labels[i])
+			{
+				if (l.second > best_count)
+				{
+					best_label = l.first;
+					best_count = l.second;
+				}
+			}
+		}
+		return best_label;
+	}
 };
 
-void grid_subsampling(vector<PointXYZ>& original_points,
+// Voxel sums of a grid subsampling (counts, sums of points and features, label votes), which can be filled chunk by
+// chunk. The grid is defined by the limits of the whole cloud, so the voxels do not depend on the chunks, and the same
+// points added in the same order give the same result as grid_subsampling. Features and classes are used when fdim and
+// ldim are positive. The range of the labels is detected on the first points added: when it is small, the labels are
+// voted with dense counts per voxel, and the labels outside of it fall back to maps.
+class GridAccumulator
+{
+public:
+
+	// Elements
+	// ********
+
+	PointXYZ originCorner;
+	size_t sampleNX;
+	size_t sampleNY;
+	float sampleDl;
+	size_t fdim;
+	size_t ldim;
+	int label_min;
+	size_t n_labels;
+	bool labels_range;
+	unordered_map<size_t, SampledData> data;
+
+	// Largest range of labels voted with dense counts
+	static const int max_dense_labels = 64;
+
+
+	// Methods
+	// *******
+
+	GridAccumulator(PointXYZ minCorner, PointXYZ maxCorner, float sampleDl, size_t fdim, size_t ldim);
+
+	// Key of the voxel containing a point
+	size_t voxel_key(const PointXYZ& p)
+	{
+		size_t iX = (size_t)floor((p.x - originCorner.x) / sampleDl);
+		size_t iY = (size_t)floor((p.y - originCorner.y) / sampleDl);
+		size_t iZ = (size_t)floor((p.z - originCorner.z) / sampleDl);
+		return iX + sampleNX*iY + sampleNX*sampleNY*iZ;
+	}
+
+	// Add N points, with their features (N, fdim) and classes (N, ldim), read in place
+	void add(const PointXYZ* points, size_t N, const float* features, const int* classes, int verbose);
+
+	// Barycenters, mean features and majority classes of the voxels, which are numbered in this order
+	void results(vector<PointXYZ>& subsampled_points, vector<float>& subsampled_features, vector<int>& subsampled_classes);
+
+	// Once the results are computed: index of the voxel of each point (-1 for points outside the voxels), and number of
+	// points in each voxel
+	void voxel_indices(const PointXYZ* points, size_t N, int* inds);
+	void voxel_counts(vector<int>& counts);
+};
+
+// The original points, features (N, fdim) and classes (N, ldim) are read in place. Features and classes are not used
+// when their pointer is NULL. When voxel_inds and voxel_counts are given, they receive the index of the subsampled
+// point of each original point (N,) and the number of original points of each subsampled point.
+void grid_subsampling(const PointXYZ* original_points,
+                      size_t N,
                       vector<PointXYZ>& subsampled_points,
-                      vector<float>& original_features,
+                      const float* original_features,
+                      size_t fdim,
                       vector<float>& subsampled_features,
-                      vector<int>& original_classes,
+                      const int* original_classes,
+                      size_t ldim,
                       vector<int>& subsampled_classes,
                       float sampleDl,
-                      int verbose);
+                      int verbose,
+                      vector<int>* voxel_inds = NULL,
+                      vector<int>* voxel_counts = NULL);
 
-void batch_grid_subsampling(vector<PointXYZ>& original_points,
+// Same subsampling as grid_subsampling, computed by sorting the voxel keys of the points (stable LSD radix sort) and
+// reducing the runs of equal keys, instead of filling a hash map. The voxels are returned in the order of their keys.
+void sorted_grid_subsampling(const PointXYZ* original_points,
+                             size_t N,
+                             vector<PointXYZ>& subsampled_points,
+                             const float* original_features,
+                             size_t fdim,
+                             vector<float>& subsampled_features,
+                             const int* original_classes,
+                             size_t ldim,
+                             vector<int>& subsampled_classes,
+                             float sampleDl,
+                             int verbose,
+                             vector<int>* voxel_inds = NULL,
+                             vector<int>* voxel_counts = NULL);
+
+// Rotate n points with a 3x3 matrix R stored row by row (p * R), or with its transpose to go back (p * R^T)
+void rotate_points(PointXYZ* points, size_t n, const float* R, bool transpose);
+
+// Subsampling of each element of a batch of stacked pointclouds, keeping at most max_p points per element (max_p < 1
+// keeps them all). When rotations (B, 3, 3) are given, the grid of each batch element is oriented by its matrix: the
+// points are rotated before the subsampling and the subsampled points are rotated back. Batch elements are processed
+// concurrently on n_threads threads (n_threads < 1 uses all cores).
+void batch_grid_subsampling(const PointXYZ* original_points,
                             vector<PointXYZ>& subsampled_points,
-                            vector<float>& original_features,
+                            const float* original_features,
+                            size_t fdim,
                             vector<float>& subsampled_features,
-                            vector<int>& original_classes,
+                            const int* original_classes,
+                            size_t ldim,
                             vector<int>& subsampled_classes,
                             vector<int>& original_batches,
                             vector<int>& subsampled_batches,
+                            const float* rotations,
                             float sampleDl,
-                            int max_p);
+                            int max_p,
+                            int n_threads);
+
+// Nested grid subsampling of a pointcloud at sampleDl * 2^l for each level l < n_levels, in a single pass over the
+// points. The voxels of a level are merged into the voxels of the next one (their integer coordinates shifted by one
+// bit), so the points of each level are the barycenters of the original points of its voxels.
+void pyramid_grid_subsampling(const PointXYZ* original_points,
+                              size_t N,
+                              vector<vector<PointXYZ>>& subsampled_points,
+                              float sampleDl,
+                              int n_levels);
+
+// Nested grid subsampling of each element of a batch of stacked pointclouds, returning the stacked points and the
+// batch lengths of every level. When rotations (B, 3, 3) are given, the grids of each batch element are oriented by its
+// matrix (the same for all the levels, to keep them nested). Batch elements are processed concurrently on n_threads
+// threads (n_threads < 1 uses all cores).
+void batch_pyramid_grid_subsampling(const PointXYZ* original_points,
+                                    vector<int>& original_batches,
+                                    vector<vector<PointXYZ>>& subsampled_points,
+                                    vector<vector<int>>& subsampled_batches,
+                                    const float* rotations,
+                                    float sampleDl,
+                                    int n_levels,
+                                    int n_threads);
+
+// Order of n points along a Morton (Z-order) curve through cells of size cellDl (at most 2^21 cells per axis): the
+// bits of the integer cell coordinates are interleaved and the keys are radix sorted. Points of the same cell keep
+// their order.
+void morton_order(const PointXYZ* points, size_t n, float cellDl, vector<uint32_t>& order);
 
+// Sort the points of each element of a batch of stacked pointclouds along a Morton curve, in place. Batch elements
+// are processed concurrently on n_threads threads (n_threads < 1 uses all cores).
+void batch_morton_sort(vector<PointXYZ>& points, vector<int>& lengths, float cellDl, int n_threads);
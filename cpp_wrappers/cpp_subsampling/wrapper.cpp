@@ -1,7 +1,9 @@
 #include <Python.h>
 #include <numpy/arrayobject.h>
 #include "grid_subsampling/grid_subsampling.h"
+#include "../cpp_utils/arrays/arrays.h"
 #include <string>
+#include <mutex>
 
 
 
@@ -10,9 +12,23 @@
 
 static char module_docstring[] = "This module provides an interface for the subsampling of a batch of stacked pointclouds";
 
-static char subsample_docstring[] = "function subsampling a pointcloud";
+static char subsample_docstring[] = "function subsampling a pointcloud. engine=\"hash\" (default) accumulates the voxels in a hash map, engine=\"sort\" radix sorts the voxel keys of the points and reduces the runs of equal keys (same voxels, returned in the order of their keys). With return_inverse=True, also returns the index of the subsampled point of each input point (N,) and the number of input points of each subsampled point, both int32";
 
-static char subsample_batch_docstring[] = "function subsampling a batch of stacked pointclouds";
+static char grid_subsampler_docstring[] = "GridSubsampler(min_corner, max_corner, sampleDl=0.1, fdim=0, ldim=0): grid subsampling of a pointcloud added chunk by chunk, so that the whole cloud never needs to be in memory. The grid is defined by the (3,) limits of the whole cloud. Points added in the same order give the same result as subsample. Features (fdim columns) and classes (ldim columns) are used when fdim and ldim are positive";
+
+static char grid_subsampler_add_docstring[] = "add(points, features=None, classes=None): accumulate a chunk of points into the voxels";
+
+static char grid_subsampler_result_docstring[] = "result(): subsampled points, with features and/or classes like subsample";
+
+static char grid_subsampler_voxel_indices_docstring[] = "voxel_indices(points): once the result is computed, index of the subsampled point of each point (-1 for points outside the voxels), as a (N,) int32 array";
+
+static char grid_subsampler_voxel_counts_docstring[] = "voxel_counts(): once the result is computed, number of points added in each voxel, as a (Ns,) int32 array";
+
+static char subsample_batch_docstring[] = "function subsampling a batch of stacked pointclouds. With rotations (B, 3, 3), the grid of each batch element is oriented by its rotation matrix (points rotated by p * R before the subsampling and rotated back after). Batch elements are subsampled concurrently on n_threads threads (n_threads < 1 uses all cores)";
+
+static char subsample_pyramid_docstring[] = "subsample_pyramid(points, lengths, dl0=0.1, n_levels=1, rotations=None, n_threads=1): nested grid subsampling of a batch of stacked pointclouds at dl0 * 2^l for each level l < n_levels, computed in a single pass over the points (the voxels of each level are merged into the voxels of the next one). The points of each level are the barycenters of the original points of its voxels. With rotations (B, 3, 3), the grids of each batch element are oriented by its rotation matrix. Returns the lists (points, lengths) of the levels";
+
+static char morton_order_docstring[] = "morton_order(points, sampleDl=0.1): order of the points along a Morton (Z-order) curve through cells of size sampleDl, as a (N,) int32 permutation (points of the same cell keep their order). Sorting a subsampled cloud with it puts nearby points close in memory";
 
 
 // Declare the functions
@@ -20,6 +36,8 @@ static char subsample_batch_docstring[] = "function subsampling a batch of stack
 
 static PyObject *cloud_subsampling(PyObject* self, PyObject* args, PyObject* keywds);
 static PyObject *batch_subsampling(PyObject *self, PyObject *args, PyObject *keywds);
+static PyObject *pyramid_subsampling(PyObject *self, PyObject *args, PyObject *keywds);
+static PyObject *points_morton_order(PyObject *self, PyObject *args, PyObject *keywds);
 
 
 // Specify the members of the module
@@ -29,6 +47,8 @@ static PyMethodDef module_methods[] =
 {
 	{ "subsample", (PyCFunction)cloud_subsampling, METH_VARARGS | METH_KEYWORDS, subsample_docstring },
 	{ "subsample_batch", (PyCFunction)batch_subsampling, METH_VARARGS | METH_KEYWORDS, subsample_batch_docstring },
+	{ "subsample_pyramid", (PyCFunction)pyramid_subsampling, METH_VARARGS | METH_KEYWORDS, subsample_pyramid_docstring },
+	{ "morton_order", (PyCFunction)points_morton_order, METH_VARARGS | METH_KEYWORDS, morton_order_docstring },
 	{NULL, NULL, 0, NULL}
 };
 
@@ -49,10 +69,72 @@ static struct PyModuleDef moduledef =
     NULL,                   // m_free
 };
 
+// Python type accumulating the voxels of a cloud chunk by chunk
+// *************************************************************
+
+// The methods run without the GIL, so the voxels of an instance are guarded by its own mutex: several python threads
+// can share an instance, their calls are serialized. The mutex is only taken once the GIL is released (and released
+// before taking the GIL back), so that a thread waiting for it never blocks the others.
+typedef struct
+{
+	PyObject_HEAD
+	GridAccumulator* grid;
+	mutex* lock;
+} GridSubsamplerObject;
+
+static int GridSubsampler_init(GridSubsamplerObject* self, PyObject* args, PyObject* keywds);
+static void GridSubsampler_dealloc(GridSubsamplerObject* self);
+static PyObject* GridSubsampler_add(GridSubsamplerObject* self, PyObject* args, PyObject* keywds);
+static PyObject* GridSubsampler_result(GridSubsamplerObject* self, PyObject* args);
+static PyObject* GridSubsampler_voxel_indices(GridSubsamplerObject* self, PyObject* args);
+static PyObject* GridSubsampler_voxel_counts(GridSubsamplerObject* self, PyObject* args);
+
+static PyMethodDef GridSubsampler_methods[] =
+{
+	{ "add", (PyCFunction)GridSubsampler_add, METH_VARARGS | METH_KEYWORDS, grid_subsampler_add_docstring },
+	{ "result", (PyCFunction)GridSubsampler_result, METH_NOARGS, grid_subsampler_result_docstring },
+	{ "voxel_indices", (PyCFunction)GridSubsampler_voxel_indices, METH_VARARGS, grid_subsampler_voxel_indices_docstring },
+	{ "voxel_counts", (PyCFunction)GridSubsampler_voxel_counts, METH_NOARGS, grid_subsampler_voxel_counts_docstring },
+	{NULL, NULL, 0, NULL}
+};
+
+static PyType_Slot GridSubsampler_slots[] =
+{
+	{ Py_tp_doc, (void*)grid_subsampler_docstring },
+	{ Py_tp_new, (void*)PyType_GenericNew },
+	{ Py_tp_init, (void*)GridSubsampler_init },
+	{ Py_tp_dealloc, (void*)GridSubsampler_dealloc },
+	{ Py_tp_methods, (void*)GridSubsampler_methods },
+	{ 0, NULL }
+};
+
+static PyType_Spec GridSubsampler_spec =
+{
+	"grid_subsampling.GridSubsampler",  // name
+	sizeof(GridSubsamplerObject),       // basicsize
+	0,                                  // itemsize
+	Py_TPFLAGS_DEFAULT,                 // flags
+	GridSubsampler_slots                // slots
+};
+
 PyMODINIT_FUNC PyInit_grid_subsampling(void)
 {
     import_array();
-	return PyModule_Create(&moduledef);
+
+	PyObject* m = PyModule_Create(&moduledef);
+	if (m == NULL)
+		return NULL;
+
+	// Add the GridSubsampler type to the module
+	PyObject* grid_subsampler_type = PyType_FromSpec(&GridSubsampler_spec);
+	if (grid_subsampler_type == NULL || PyModule_AddObject(m, "GridSubsampler", grid_subsampler_type) < 0)
+	{
+		Py_XDECREF(grid_subsampler_type);
+		Py_DECREF(m);
+		return NULL;
+	}
+
+	return m;
 }
 
 
@@ -70,16 +152,18 @@ static PyObject* batch_subsampling(PyObject* self, PyObject* args, PyObject* key
 	PyObject* features_obj = NULL;
 	PyObject* classes_obj = NULL;
 	PyObject* batches_obj = NULL;
+	PyObject* rotations_obj = NULL;
 
 	// Keywords containers
-	static char* kwlist[] = { "points", "batches", "features", "classes", "sampleDl", "method", "max_p", "verbose", NULL };
+	static char* kwlist[] = { "points", "batches", "features", "classes", "sampleDl", "method", "max_p", "verbose", "rotations", "n_threads", NULL };
 	float sampleDl = 0.1;
 	const char* method_buffer = "barycenters";
 	int verbose = 0;
 	int max_p = 0;
+	int n_threads = 1;
 
 	// Parse the input  
-	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$OOfsii", kwlist, &points_obj, &batches_obj, &features_obj, &classes_obj, &sampleDl, &method_buffer, &max_p, &verbose))
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$OOfsiiOi", kwlist, &points_obj, &batches_obj, &features_obj, &classes_obj, &sampleDl, &method_buffer, &max_p, &verbose, &rotations_obj, &n_threads))
 	{
 		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
 		return NULL;
@@ -97,9 +181,9 @@ static PyObject* batch_subsampling(PyObject* self, PyObject* args, PyObject* key
 
 	// Check if using features or classes
 	bool use_feature = true, use_classes = true;
-	if (features_obj == NULL)
+	if (features_obj == NULL || features_obj == Py_None)
 		use_feature = false;
-	if (classes_obj == NULL)
+	if (classes_obj == NULL || classes_obj == Py_None)
 		use_classes = false;
 
 	// Interpret the input objects as numpy arrays.
@@ -234,33 +318,73 @@ static PyObject* batch_subsampling(PyObject* self, PyObject* args, PyObject* key
 		cout << "Computing cloud pyramid with support points: " << endl;
 
 
-	// Convert PyArray to Cloud C++ class
-	vector<PointXYZ> original_points;
-	vector<int> original_batches;
-	vector<float> original_features;
-	vector<int> original_classes;
-	original_points = vector<PointXYZ>((PointXYZ*)PyArray_DATA(points_array), (PointXYZ*)PyArray_DATA(points_array) + N);
-	original_batches = vector<int>((int*)PyArray_DATA(batches_array), (int*)PyArray_DATA(batches_array) + Nb);
-	if (use_feature)
-		original_features = vector<float>((float*)PyArray_DATA(features_array), (float*)PyArray_DATA(features_array) + N * fdim);
-	if (use_classes)
-		original_classes = vector<int>((int*)PyArray_DATA(classes_array), (int*)PyArray_DATA(classes_array) + N * ldim);
+	// The original points, features and classes are read in place, only the batch lengths are copied
+	const PointXYZ* original_points = (PointXYZ*)PyArray_DATA(points_array);
+	vector<int> original_batches((int*)PyArray_DATA(batches_array), (int*)PyArray_DATA(batches_array) + Nb);
+	const float* original_features = use_feature ? (float*)PyArray_DATA(features_array) : NULL;
+	const int* original_classes = use_classes ? (int*)PyArray_DATA(classes_array) : NULL;
+
+	// Check the batch lengths
+	if (accumulate(original_batches.begin(), original_batches.end(), (long long)0) != N)
+	{
+		Py_XDECREF(points_array);
+		Py_XDECREF(batches_array);
+		Py_XDECREF(classes_array);
+		Py_XDECREF(features_array);
+		PyErr_SetString(PyExc_RuntimeError, "Wrong batch lengths : the sum of batches is not the number of points");
+		return NULL;
+	}
 
-	// Subsample
+	// Rotations orienting the grid of each batch element
+	PyObject* rotations_array = NULL;
+	const float* rotations = NULL;
+	if (rotations_obj != NULL && rotations_obj != Py_None)
+	{
+		rotations_array = PyArray_FROM_OTF(rotations_obj, NPY_FLOAT, NPY_IN_ARRAY);
+		if (rotations_array == NULL)
+		{
+			Py_XDECREF(points_array);
+			Py_XDECREF(batches_array);
+			Py_XDECREF(classes_array);
+			Py_XDECREF(features_array);
+			PyErr_SetString(PyExc_RuntimeError, "Error converting input rotations to numpy arrays of type float32");
+			return NULL;
+		}
+		if ((int)PyArray_NDIM(rotations_array) != 3 || (int)PyArray_DIM(rotations_array, 0) != Nb ||
+			(int)PyArray_DIM(rotations_array, 1) != 3 || (int)PyArray_DIM(rotations_array, 2) != 3)
+		{
+			Py_XDECREF(points_array);
+			Py_XDECREF(batches_array);
+			Py_XDECREF(classes_array);
+			Py_XDECREF(features_array);
+			Py_XDECREF(rotations_array);
+			PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : rotations.shape is not (B, 3, 3)");
+			return NULL;
+		}
+		rotations = (float*)PyArray_DATA(rotations_array);
+	}
+
+	// Subsample (without the GIL, so that other python threads can run meanwhile)
 	vector<PointXYZ> subsampled_points;
 	vector<float> subsampled_features;
 	vector<int> subsampled_classes;
 	vector<int> subsampled_batches;
+	Py_BEGIN_ALLOW_THREADS
 	batch_grid_subsampling(original_points,
 							subsampled_points,
 							original_features,
+							fdim,
 							subsampled_features,
 							original_classes,
+							ldim,
 							subsampled_classes,
 							original_batches,
 							subsampled_batches,
+							rotations,
 							sampleDl,
-							max_p);
+							max_p,
+							n_threads);
+	Py_END_ALLOW_THREADS
 
 	// Check result
 	if (subsampled_points.size() < 1)
@@ -272,43 +396,23 @@ static PyObject* batch_subsampling(PyObject* self, PyObject* args, PyObject* key
 	// Manage outputs
 	// **************
 
-	// Dimension of input containers
-	npy_intp* point_dims = new npy_intp[2];
-	point_dims[0] = subsampled_points.size();
-	point_dims[1] = 3;
-	npy_intp* feature_dims = new npy_intp[2];
-	feature_dims[0] = subsampled_points.size();
-	feature_dims[1] = fdim;
-	npy_intp* classes_dims = new npy_intp[2];
-	classes_dims[0] = subsampled_points.size();
-	classes_dims[1] = ldim;
-	npy_intp* batches_dims = new npy_intp[1];
-	batches_dims[0] = Nb;
-
-	// Create output array
-	PyObject* res_points_obj = PyArray_SimpleNew(2, point_dims, NPY_FLOAT);
-	PyObject* res_batches_obj = PyArray_SimpleNew(1, batches_dims, NPY_INT);
+	// Dimension of output containers
+	npy_intp Ns = subsampled_points.size();
+	npy_intp point_dims[2] = { Ns, 3 };
+	npy_intp feature_dims[2] = { Ns, fdim };
+	npy_intp classes_dims[2] = { Ns, ldim };
+	npy_intp batches_dims[1] = { Nb };
+
+	// Create output arrays, taking over the buffers of the results
+	PyObject* res_points_obj = vector_to_array(subsampled_points, 2, point_dims, NPY_FLOAT);
+	PyObject* res_batches_obj = vector_to_array(subsampled_batches, 1, batches_dims, NPY_INT);
 	PyObject* res_features_obj = NULL;
 	PyObject* res_classes_obj = NULL;
 	PyObject* ret = NULL;
-
-	// Fill output array with values
-	size_t size_in_bytes = subsampled_points.size() * 3 * sizeof(float);
-	memcpy(PyArray_DATA(res_points_obj), subsampled_points.data(), size_in_bytes);
-	size_in_bytes = Nb * sizeof(int);
-	memcpy(PyArray_DATA(res_batches_obj), subsampled_batches.data(), size_in_bytes);
 	if (use_feature)
-	{
-		size_in_bytes = subsampled_points.size() * fdim * sizeof(float);
-		res_features_obj = PyArray_SimpleNew(2, feature_dims, NPY_FLOAT);
-		memcpy(PyArray_DATA(res_features_obj), subsampled_features.data(), size_in_bytes);
-	}
+		res_features_obj = vector_to_array(subsampled_features, 2, feature_dims, NPY_FLOAT);
 	if (use_classes)
-	{
-		size_in_bytes = subsampled_points.size() * ldim * sizeof(int);
-		res_classes_obj = PyArray_SimpleNew(2, classes_dims, NPY_INT);
-		memcpy(PyArray_DATA(res_classes_obj), subsampled_classes.data(), size_in_bytes);
-	}
+		res_classes_obj = vector_to_array(subsampled_classes, 2, classes_dims, NPY_INT);
 
 
 	// Merge results
@@ -328,10 +432,181 @@ static PyObject* batch_subsampling(PyObject* self, PyObject* args, PyObject* key
 	Py_DECREF(batches_array);
 	Py_XDECREF(features_array);
 	Py_XDECREF(classes_array);
+	Py_XDECREF(rotations_array);
 
 	return ret;
 }
 
+// Definition of the morton_order method
+// *************************************
+
+static PyObject* points_morton_order(PyObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	PyObject* points_obj = NULL;
+	static char* kwlist[] = { "points", "sampleDl", NULL };
+	float sampleDl = 0.1;
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "O|f", kwlist, &points_obj, &sampleDl))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+
+	PyObject* points_array = PyArray_FROM_OTF(points_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	if (points_array == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error converting input points to numpy arrays of type float32");
+		return NULL;
+	}
+	if ((int)PyArray_NDIM(points_array) != 2 || (int)PyArray_DIM(points_array, 1) != 3)
+	{
+		Py_DECREF(points_array);
+		PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : points.shape is not (N, 3)");
+		return NULL;
+	}
+
+
+	// Call the C++ function
+	// *********************
+
+	size_t N = (size_t)PyArray_DIM(points_array, 0);
+	vector<uint32_t> order;
+	Py_BEGIN_ALLOW_THREADS
+	morton_order((PointXYZ*)PyArray_DATA(points_array), N, sampleDl, order);
+	Py_END_ALLOW_THREADS
+	Py_DECREF(points_array);
+
+	// Manage outputs (the indices fit in int32 as the points are counted with int elsewhere)
+	vector<int> indices(order.begin(), order.end());
+	npy_intp dims[1] = { (npy_intp)N };
+	return vector_to_array(indices, 1, dims, NPY_INT);
+}
+
+// Definition of the subsample_pyramid method
+// *******************************************
+
+static PyObject* pyramid_subsampling(PyObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	// Args containers
+	PyObject* points_obj = NULL;
+	PyObject* lengths_obj = NULL;
+	PyObject* rotations_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "points", "lengths", "dl0", "n_levels", "rotations", "n_threads", NULL };
+	float dl0 = 0.1;
+	int n_levels = 1;
+	int n_threads = 1;
+
+	// Parse the input
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|fi$Oi", kwlist, &points_obj, &lengths_obj, &dl0, &n_levels,
+	                                 &rotations_obj, &n_threads))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+	if (rotations_obj == Py_None)
+		rotations_obj = NULL;
+
+	// Interpret the input objects as numpy arrays.
+	PyObject* points_array = PyArray_FROM_OTF(points_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	PyObject* lengths_array = PyArray_FROM_OTF(lengths_obj, NPY_INT, NPY_IN_ARRAY);
+	PyObject* rotations_array = NULL;
+	if (rotations_obj != NULL)
+		rotations_array = PyArray_FROM_OTF(rotations_obj, NPY_FLOAT, NPY_IN_ARRAY);
+
+	// Verify data was load correctly.
+	string error;
+	if (points_array == NULL)
+		error = "Error converting input points to numpy arrays of type float32";
+	else if (lengths_array == NULL)
+		error = "Error converting input lengths to numpy arrays of type int32";
+	else if (rotations_obj != NULL && rotations_array == NULL)
+		error = "Error converting input rotations to numpy arrays of type float32";
+
+	// Check that the input array respect the dims
+	else if ((int)PyArray_NDIM(points_array) != 2 || (int)PyArray_DIM(points_array, 1) != 3)
+		error = "Wrong dimensions : points.shape is not (N, 3)";
+	else if ((int)PyArray_NDIM(lengths_array) != 1)
+		error = "Wrong dimensions : lengths.shape is not (B,) ";
+	else if (rotations_array != NULL && ((int)PyArray_NDIM(rotations_array) != 3 ||
+	                                     PyArray_DIM(rotations_array, 0) != PyArray_DIM(lengths_array, 0) ||
+	                                     PyArray_DIM(rotations_array, 1) != 3 ||
+	                                     PyArray_DIM(rotations_array, 2) != 3))
+		error = "Wrong dimensions : rotations.shape is not (B, 3, 3)";
+	else if (n_levels < 1)
+		error = "Wrong number of levels : n_levels should be at least 1";
+
+	// Check the batch lengths
+	else if (accumulate((int*)PyArray_DATA(lengths_array),
+	                    (int*)PyArray_DATA(lengths_array) + PyArray_DIM(lengths_array, 0),
+	                    (long long)0) != PyArray_DIM(points_array, 0))
+		error = "Wrong batch lengths : the sum of lengths is not the number of points";
+
+	if (!error.empty())
+	{
+		Py_XDECREF(points_array);
+		Py_XDECREF(lengths_array);
+		Py_XDECREF(rotations_array);
+		PyErr_SetString(PyExc_RuntimeError, error.c_str());
+		return NULL;
+	}
+
+
+	// Call the C++ function
+	// *********************
+
+	// The points and rotations are read in place, only the batch lengths are copied
+	int Nb = (int)PyArray_DIM(lengths_array, 0);
+	const PointXYZ* original_points = (PointXYZ*)PyArray_DATA(points_array);
+	vector<int> original_batches((int*)PyArray_DATA(lengths_array), (int*)PyArray_DATA(lengths_array) + Nb);
+	const float* rotations = rotations_array != NULL ? (float*)PyArray_DATA(rotations_array) : NULL;
+
+	// Subsample (without the GIL, so that other python threads can run meanwhile)
+	vector<vector<PointXYZ>> subsampled_points;
+	vector<vector<int>> subsampled_batches;
+	Py_BEGIN_ALLOW_THREADS
+	batch_pyramid_grid_subsampling(original_points,
+	                               original_batches,
+	                               subsampled_points,
+	                               subsampled_batches,
+	                               rotations,
+	                               dl0,
+	                               n_levels,
+	                               n_threads);
+	Py_END_ALLOW_THREADS
+
+
+	// Manage outputs
+	// **************
+
+	PyObject* points_list = PyList_New(n_levels);
+	PyObject* lengths_list = PyList_New(n_levels);
+	for (int l = 0; l < n_levels; l++)
+	{
+		npy_intp point_dims[2] = { (npy_intp)subsampled_points[l].size(), 3 };
+		npy_intp batches_dims[1] = { Nb };
+		PyList_SET_ITEM(points_list, l, vector_to_array(subsampled_points[l], 2, point_dims, NPY_FLOAT));
+		PyList_SET_ITEM(lengths_list, l, vector_to_array(subsampled_batches[l], 1, batches_dims, NPY_INT));
+	}
+
+	// Clean up
+	// ********
+
+	Py_DECREF(points_array);
+	Py_DECREF(lengths_array);
+	Py_XDECREF(rotations_array);
+
+	return Py_BuildValue("NN", points_list, lengths_list);
+}
+
 // Definition of the subsample method
 // ****************************************
 
@@ -347,13 +622,15 @@ static PyObject* cloud_subsampling(PyObject* self, PyObject* args, PyObject* key
 	PyObject* classes_obj = NULL;
 
 	// Keywords containers
-	static char* kwlist[] = { "points", "features", "classes", "sampleDl", "method", "verbose", NULL };
+	static char* kwlist[] = { "points", "features", "classes", "sampleDl", "method", "verbose", "engine", "return_inverse", NULL };
 	float sampleDl = 0.1;
 	const char* method_buffer = "barycenters";
 	int verbose = 0;
+	const char* engine_buffer = "hash";
+	int return_inverse = 0;
 
 	// Parse the input  
-	if (!PyArg_ParseTupleAndKeywords(args, keywds, "O|$OOfsi", kwlist, &points_obj, &features_obj, &classes_obj, &sampleDl, &method_buffer, &verbose))
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "O|$OOfsisp", kwlist, &points_obj, &features_obj, &classes_obj, &sampleDl, &method_buffer, &verbose, &engine_buffer, &return_inverse))
 	{
 		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
 		return NULL;
@@ -369,6 +646,14 @@ static PyObject* cloud_subsampling(PyObject* self, PyObject* args, PyObject* key
 		return NULL;
 	}
 
+	// Interpret engine
+	string engine(engine_buffer);
+	if (engine.compare("hash") && engine.compare("sort"))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing engine. Valid engine names are \"hash\" and \"sort\" ");
+		return NULL;
+	}
+
 	// Check if using features or classes
 	bool use_feature = true, use_classes = true;
 	if (features_obj == NULL)
@@ -478,28 +763,49 @@ static PyObject* cloud_subsampling(PyObject* self, PyObject* args, PyObject* key
 		cout << "Computing cloud pyramid with support points: " << endl;
 
 
-	// Convert PyArray to Cloud C++ class
-	vector<PointXYZ> original_points;
-	vector<float> original_features;
-	vector<int> original_classes;
-	original_points = vector<PointXYZ>((PointXYZ*)PyArray_DATA(points_array), (PointXYZ*)PyArray_DATA(points_array) + N);
-	if (use_feature)
-		original_features = vector<float>((float*)PyArray_DATA(features_array), (float*)PyArray_DATA(features_array) + N * fdim);
-	if (use_classes)
-		original_classes = vector<int>((int*)PyArray_DATA(classes_array), (int*)PyArray_DATA(classes_array) + N * ldim);
+	// The original points, features and classes are read in place
+	const PointXYZ* original_points = (PointXYZ*)PyArray_DATA(points_array);
+	const float* original_features = use_feature ? (float*)PyArray_DATA(features_array) : NULL;
+	const int* original_classes = use_classes ? (int*)PyArray_DATA(classes_array) : NULL;
 
-	// Subsample
+	// Subsample (without the GIL, so that other python threads can run meanwhile)
 	vector<PointXYZ> subsampled_points;
 	vector<float> subsampled_features;
 	vector<int> subsampled_classes;
-	grid_subsampling(original_points,
-		subsampled_points,
-		original_features,
-		subsampled_features,
-		original_classes,
-		subsampled_classes,
-		sampleDl,
-		verbose);
+	vector<int> voxel_inds;
+	vector<int> voxel_counts;
+	vector<int>* inds_ptr = return_inverse ? &voxel_inds : NULL;
+	vector<int>* counts_ptr = return_inverse ? &voxel_counts : NULL;
+	Py_BEGIN_ALLOW_THREADS
+	if (engine == "sort")
+		sorted_grid_subsampling(original_points,
+			N,
+			subsampled_points,
+			original_features,
+			fdim,
+			subsampled_features,
+			original_classes,
+			ldim,
+			subsampled_classes,
+			sampleDl,
+			verbose,
+			inds_ptr,
+			counts_ptr);
+	else
+		grid_subsampling(original_points,
+			N,
+			subsampled_points,
+			original_features,
+			fdim,
+			subsampled_features,
+			original_classes,
+			ldim,
+			subsampled_classes,
+			sampleDl,
+			verbose,
+			inds_ptr,
+			counts_ptr);
+	Py_END_ALLOW_THREADS
 
 	// Check result
 	if (subsampled_points.size() < 1)
@@ -511,42 +817,40 @@ static PyObject* cloud_subsampling(PyObject* self, PyObject* args, PyObject* key
 	// Manage outputs
 	// **************
 
-	// Dimension of input containers
-	npy_intp* point_dims = new npy_intp[2];
-	point_dims[0] = subsampled_points.size();
-	point_dims[1] = 3;
-	npy_intp* feature_dims = new npy_intp[2];
-	feature_dims[0] = subsampled_points.size();
-	feature_dims[1] = fdim;
-	npy_intp* classes_dims = new npy_intp[2];
-	classes_dims[0] = subsampled_points.size();
-	classes_dims[1] = ldim;
-
-	// Create output array
-	PyObject* res_points_obj = PyArray_SimpleNew(2, point_dims, NPY_FLOAT);
+	// Dimension of output containers
+	npy_intp Ns = subsampled_points.size();
+	npy_intp point_dims[2] = { Ns, 3 };
+	npy_intp feature_dims[2] = { Ns, fdim };
+	npy_intp classes_dims[2] = { Ns, ldim };
+
+	// Create output arrays, taking over the buffers of the results
+	PyObject* res_points_obj = vector_to_array(subsampled_points, 2, point_dims, NPY_FLOAT);
 	PyObject* res_features_obj = NULL;
 	PyObject* res_classes_obj = NULL;
 	PyObject* ret = NULL;
-
-	// Fill output array with values
-	size_t size_in_bytes = subsampled_points.size() * 3 * sizeof(float);
-	memcpy(PyArray_DATA(res_points_obj), subsampled_points.data(), size_in_bytes);
 	if (use_feature)
-	{
-		size_in_bytes = subsampled_points.size() * fdim * sizeof(float);
-		res_features_obj = PyArray_SimpleNew(2, feature_dims, NPY_FLOAT);
-		memcpy(PyArray_DATA(res_features_obj), subsampled_features.data(), size_in_bytes);
-	}
+		res_features_obj = vector_to_array(subsampled_features, 2, feature_dims, NPY_FLOAT);
 	if (use_classes)
-	{
-		size_in_bytes = subsampled_points.size() * ldim * sizeof(int);
-		res_classes_obj = PyArray_SimpleNew(2, classes_dims, NPY_INT);
-		memcpy(PyArray_DATA(res_classes_obj), subsampled_classes.data(), size_in_bytes);
-	}
+		res_classes_obj = vector_to_array(subsampled_classes, 2, classes_dims, NPY_INT);
 
 
 	// Merge results
-	if (use_feature && use_classes)
+	if (return_inverse)
+	{
+		npy_intp inds_dims[1] = { (npy_intp)N };
+		npy_intp counts_dims[1] = { Ns };
+		PyObject* res_inds_obj = vector_to_array(voxel_inds, 1, inds_dims, NPY_INT);
+		PyObject* res_counts_obj = vector_to_array(voxel_counts, 1, counts_dims, NPY_INT);
+		if (use_feature && use_classes)
+			ret = Py_BuildValue("NNNNN", res_points_obj, res_features_obj, res_classes_obj, res_inds_obj, res_counts_obj);
+		else if (use_feature)
+			ret = Py_BuildValue("NNNN", res_points_obj, res_features_obj, res_inds_obj, res_counts_obj);
+		else if (use_classes)
+			ret = Py_BuildValue("NNNN", res_points_obj, res_classes_obj, res_inds_obj, res_counts_obj);
+		else
+			ret = Py_BuildValue("NNN", res_points_obj, res_inds_obj, res_counts_obj);
+	}
+	else if (use_feature && use_classes)
 		ret = Py_BuildValue("NNN", res_points_obj, res_features_obj, res_classes_obj);
 	else if (use_feature)
 		ret = Py_BuildValue("NN", res_points_obj, res_features_obj);
@@ -563,4 +867,311 @@ static PyObject* cloud_subsampling(PyObject* self, PyObject* args, PyObject* key
 	Py_XDECREF(classes_array);
 
 	return ret;
-}
\ No newline at end of file
+}
+
+
+// Definition of the GridSubsampler methods
+// ****************************************
+
+static int GridSubsampler_init(GridSubsamplerObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	// Args containers
+	PyObject* min_obj = NULL;
+	PyObject* max_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "min_corner", "max_corner", "sampleDl", "fdim", "ldim", NULL };
+	float sampleDl = 0.1;
+	int fdim = 0;
+	int ldim = 0;
+
+	// Parse the input  
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$fii", kwlist, &min_obj, &max_obj, &sampleDl, &fdim, &ldim))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return -1;
+	}
+
+	// Interpret the input objects as numpy arrays.
+	PyObject* min_array = PyArray_FROM_OTF(min_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	PyObject* max_array = PyArray_FROM_OTF(max_obj, NPY_FLOAT, NPY_IN_ARRAY);
+
+	// Verify data was load correctly.
+	string error;
+	if (min_array == NULL || max_array == NULL)
+		error = "Error converting input corners to numpy arrays of type float32";
+	else if (PyArray_SIZE(min_array) != 3 || PyArray_SIZE(max_array) != 3)
+		error = "Wrong dimensions : corners shape is not (3,)";
+	else if (sampleDl <= 0 || fdim < 0 || ldim < 0)
+		error = "Wrong parameters : sampleDl must be positive, fdim and ldim must not be negative";
+
+	if (!error.empty())
+	{
+		Py_XDECREF(min_array);
+		Py_XDECREF(max_array);
+		PyErr_SetString(PyExc_RuntimeError, error.c_str());
+		return -1;
+	}
+
+	// Create the voxel grid
+	float* min_data = (float*)PyArray_DATA(min_array);
+	float* max_data = (float*)PyArray_DATA(max_array);
+	PointXYZ minCorner(min_data[0], min_data[1], min_data[2]);
+	PointXYZ maxCorner(max_data[0], max_data[1], max_data[2]);
+	Py_DECREF(min_array);
+	Py_DECREF(max_array);
+
+	GridAccumulator* grid = new GridAccumulator(minCorner, maxCorner, sampleDl, fdim, ldim);
+	if (self->lock == NULL)
+		self->lock = new mutex();
+	Py_BEGIN_ALLOW_THREADS
+	{
+		lock_guard<mutex> guard(*self->lock);
+		swap(self->grid, grid);
+	}
+	Py_END_ALLOW_THREADS
+	delete grid;
+
+	return 0;
+}
+
+static void GridSubsampler_dealloc(GridSubsamplerObject* self)
+{
+	PyTypeObject* tp = Py_TYPE(self);
+	delete self->grid;
+	delete self->lock;
+	tp->tp_free((PyObject*)self);
+	Py_DECREF(tp);
+}
+
+static PyObject* GridSubsampler_add(GridSubsamplerObject* self, PyObject* args, PyObject* keywds)
+{
+	if (self->grid == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "GridSubsampler is not initialized");
+		return NULL;
+	}
+	size_t fdim = self->grid->fdim;
+	size_t ldim = self->grid->ldim;
+
+	// Manage inputs
+	// *************
+
+	// Args containers
+	PyObject* points_obj = NULL;
+	PyObject* features_obj = NULL;
+	PyObject* classes_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "points", "features", "classes", NULL };
+
+	// Parse the input  
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "O|$OO", kwlist, &points_obj, &features_obj, &classes_obj))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+	if (features_obj == Py_None)
+		features_obj = NULL;
+	if (classes_obj == Py_None)
+		classes_obj = NULL;
+
+	// Interpret the input objects as numpy arrays.
+	PyObject* points_array = PyArray_FROM_OTF(points_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	PyObject* features_array = NULL;
+	PyObject* classes_array = NULL;
+	if (features_obj != NULL)
+		features_array = PyArray_FROM_OTF(features_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	if (classes_obj != NULL)
+		classes_array = PyArray_FROM_OTF(classes_obj, NPY_INT, NPY_IN_ARRAY);
+
+	// Verify data was load correctly and respect the dims
+	string error;
+	if (points_array == NULL)
+		error = "Error converting input points to numpy arrays of type float32";
+	else if (features_obj != NULL && features_array == NULL)
+		error = "Error converting input features to numpy arrays of type float32";
+	else if (classes_obj != NULL && classes_array == NULL)
+		error = "Error converting input classes to numpy arrays of type int32";
+	else if ((int)PyArray_NDIM(points_array) != 2 || (int)PyArray_DIM(points_array, 1) != 3)
+		error = "Wrong dimensions : points.shape is not (N, 3)";
+	else if ((fdim > 0) != (features_array != NULL))
+		error = "Wrong inputs : features must be given if and only if fdim is positive";
+	else if ((ldim > 0) != (classes_array != NULL))
+		error = "Wrong inputs : classes must be given if and only if ldim is positive";
+	else if (features_array != NULL && ((int)PyArray_NDIM(features_array) != 2 ||
+	                                    PyArray_DIM(features_array, 0) != PyArray_DIM(points_array, 0) ||
+	                                    (size_t)PyArray_DIM(features_array, 1) != fdim))
+		error = "Wrong dimensions : features.shape is not (N, fdim)";
+	else if (classes_array != NULL && (PyArray_SIZE(classes_array) != PyArray_DIM(points_array, 0) * (npy_intp)ldim ||
+	                                   PyArray_DIM(classes_array, 0) != PyArray_DIM(points_array, 0)))
+		error = "Wrong dimensions : classes.shape is not (N,) or (N, ldim)";
+
+	if (!error.empty())
+	{
+		Py_XDECREF(points_array);
+		Py_XDECREF(features_array);
+		Py_XDECREF(classes_array);
+		PyErr_SetString(PyExc_RuntimeError, error.c_str());
+		return NULL;
+	}
+
+	// Accumulate the points, read in place (without the GIL, so that other python threads can run meanwhile)
+	size_t N = (size_t)PyArray_DIM(points_array, 0);
+	const PointXYZ* points = (PointXYZ*)PyArray_DATA(points_array);
+	const float* features = features_array != NULL ? (float*)PyArray_DATA(features_array) : NULL;
+	const int* classes = classes_array != NULL ? (int*)PyArray_DATA(classes_array) : NULL;
+	bool reinitialized = false;
+	Py_BEGIN_ALLOW_THREADS
+	{
+		lock_guard<mutex> guard(*self->lock);
+		reinitialized = self->grid->fdim != fdim || self->grid->ldim != ldim;
+		if (!reinitialized)
+			self->grid->add(points, N, features, classes, 0);
+	}
+	Py_END_ALLOW_THREADS
+
+	Py_DECREF(points_array);
+	Py_XDECREF(features_array);
+	Py_XDECREF(classes_array);
+
+	if (reinitialized)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "GridSubsampler was reinitialized with other dimensions during add");
+		return NULL;
+	}
+
+	Py_RETURN_NONE;
+}
+
+static PyObject* GridSubsampler_result(GridSubsamplerObject* self, PyObject* args)
+{
+	if (self->grid == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "GridSubsampler is not initialized");
+		return NULL;
+	}
+	// Barycenters, mean features and majority classes of the voxels
+	size_t fdim = 0;
+	size_t ldim = 0;
+	vector<PointXYZ> subsampled_points;
+	vector<float> subsampled_features;
+	vector<int> subsampled_classes;
+	Py_BEGIN_ALLOW_THREADS
+	{
+		lock_guard<mutex> guard(*self->lock);
+		fdim = self->grid->fdim;
+		ldim = self->grid->ldim;
+		self->grid->results(subsampled_points, subsampled_features, subsampled_classes);
+	}
+	Py_END_ALLOW_THREADS
+	bool use_feature = fdim > 0;
+	bool use_classes = ldim > 0;
+
+	// Manage outputs
+	// **************
+
+	// Dimension of output containers
+	npy_intp Ns = subsampled_points.size();
+	npy_intp point_dims[2] = { Ns, 3 };
+	npy_intp feature_dims[2] = { Ns, (npy_intp)fdim };
+	npy_intp classes_dims[2] = { Ns, (npy_intp)ldim };
+
+	// Create output arrays, taking over the buffers of the results
+	PyObject* res_points_obj = vector_to_array(subsampled_points, 2, point_dims, NPY_FLOAT);
+	PyObject* res_features_obj = NULL;
+	PyObject* res_classes_obj = NULL;
+	PyObject* ret = NULL;
+	if (use_feature)
+		res_features_obj = vector_to_array(subsampled_features, 2, feature_dims, NPY_FLOAT);
+	if (use_classes)
+		res_classes_obj = vector_to_array(subsampled_classes, 2, classes_dims, NPY_INT);
+
+	// Merge results
+	if (use_feature && use_classes)
+		ret = Py_BuildValue("NNN", res_points_obj, res_features_obj, res_classes_obj);
+	else if (use_feature)
+		ret = Py_BuildValue("NN", res_points_obj, res_features_obj);
+	else if (use_classes)
+		ret = Py_BuildValue("NN", res_points_obj, res_classes_obj);
+	else
+		ret = Py_BuildValue("N", res_points_obj);
+
+	return ret;
+}
+
+static PyObject* GridSubsampler_voxel_indices(GridSubsamplerObject* self, PyObject* args)
+{
+	if (self->grid == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "GridSubsampler is not initialized");
+		return NULL;
+	}
+
+	// Args containers
+	PyObject* points_obj = NULL;
+	if (!PyArg_ParseTuple(args, "O", &points_obj))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+
+	// Interpret the input object as a numpy array
+	PyObject* points_array = PyArray_FROM_OTF(points_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	if (points_array == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error converting input points to numpy arrays of type float32");
+		return NULL;
+	}
+	if ((int)PyArray_NDIM(points_array) != 2 || (int)PyArray_DIM(points_array, 1) != 3)
+	{
+		Py_DECREF(points_array);
+		PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : points.shape is not (N, 3)");
+		return NULL;
+	}
+
+	// Voxel of each point, written directly in the output array
+	npy_intp N = PyArray_DIM(points_array, 0);
+	PyObject* res_obj = PyArray_SimpleNew(1, &N, NPY_INT);
+	if (res_obj == NULL)
+	{
+		Py_DECREF(points_array);
+		return NULL;
+	}
+	const PointXYZ* points = (PointXYZ*)PyArray_DATA(points_array);
+	int* inds = (int*)PyArray_DATA((PyArrayObject*)res_obj);
+	Py_BEGIN_ALLOW_THREADS
+	{
+		lock_guard<mutex> guard(*self->lock);
+		self->grid->voxel_indices(points, (size_t)N, inds);
+	}
+	Py_END_ALLOW_THREADS
+
+	Py_DECREF(points_array);
+
+	return res_obj;
+}
+
+static PyObject* GridSubsampler_voxel_counts(GridSubsamplerObject* self, PyObject* args)
+{
+	if (self->grid == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "GridSubsampler is not initialized");
+		return NULL;
+	}
+
+	vector<int> counts;
+	Py_BEGIN_ALLOW_THREADS
+	{
+		lock_guard<mutex> guard(*self->lock);
+		self->grid->voxel_counts(counts);
+	}
+	Py_END_ALLOW_THREADS
+	npy_intp counts_dims[1] = { (npy_intp)counts.size() };
+
+	return vector_to_array(counts, 1, counts_dims, NPY_INT);
+}
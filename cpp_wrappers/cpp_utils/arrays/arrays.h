@@ -0,0 +1,98 @@
+//
+//
+//		0==========================0
+//		|    Numpy array helpers   |
+//		0==========================0
+//
+//---------------------------------------------------
+//
+//		Numpy arrays taking over the buffer of a std::vector, so that the results of the C++ functions are returned
+//		without being copied. Include it in the wrapper file, after numpy/arrayobject.h.
+//
+//----------------------------------------------------
+
+
+# pragma once
+
+#include <Python.h>
+#include <numpy/arrayobject.h>
+#include <vector>
+
+
+// Destructor of the capsule owning the vector
+template <typename T>
+static void free_vector_capsule(PyObject* capsule)
+{
+	delete (std::vector<T>*)PyCapsule_GetPointer(capsule, NULL);
+}
+
+
+// Array of the given shape and type viewing the buffer of the vector, which is moved (values is left empty) into a
+// capsule used as the base of the array and freed with it
+template <typename T>
+static PyObject* vector_to_array(std::vector<T>& values, int nd, npy_intp* dims, int typenum)
+{
+	// Nothing to take over
+	if (values.empty())
+		return PyArray_ZEROS(nd, dims, typenum, 0);
+
+	// Move the buffer out of the vector
+	std::vector<T>* owner = new std::vector<T>();
+	owner->swap(values);
+
+	PyObject* array = PyArray_SimpleNewFromData(nd, dims, typenum, (void*)owner->data());
+	if (array == NULL)
+	{
+		delete owner;
+		return NULL;
+	}
+
+	PyObject* capsule = PyCapsule_New((void*)owner, NULL, free_vector_capsule<T>);
+	if (capsule == NULL)
+	{
+		Py_DECREF(array);
+		delete owner;
+		return NULL;
+	}
+
+	// The array steals the reference to the capsule (even if this fails, in which case the capsule frees the buffer)
+	if (PyArray_SetBaseObject((PyArrayObject*)array, capsule) < 0)
+	{
+		Py_DECREF(array);
+		return NULL;
+	}
+
+	return array;
+}
+
+
+// Numpy type of an index type (int or int64_t)
+template <typename IndexT>
+static int index_typenum()
+{
+	return sizeof(IndexT) == 8 ? NPY_INT64 : NPY_INT32;
+}
+
+
+// Converter ("O&" format) of the dtype argument of indices outputs, which can be int32 or int64 (None keeps the default)
+static int index_dtype_converter(PyObject* dtype_obj, int* typenum)
+{
+	if (dtype_obj == Py_None)
+		return 1;
+
+	PyArray_Descr* descr = NULL;
+	if (!PyArray_DescrConverter(dtype_obj, &descr))
+		return 0;
+
+	bool valid = descr->kind == 'i' && (descr->elsize == 4 || descr->elsize == 8);
+	if (valid)
+		*typenum = descr->elsize == 8 ? NPY_INT64 : NPY_INT32;
+	Py_DECREF(descr);
+
+	if (!valid)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Wrong dtype : indices are int32 or int64");
+		return 0;
+	}
+	return 1;
+}
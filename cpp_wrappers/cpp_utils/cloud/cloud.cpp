@@ -64,4 +64,48 @@ PointXYZ min_point(std::vector<PointXYZ> points)
 	}
 
 	return minP;
-}
\ No newline at end of file
+}
+
+PointXYZ max_point(const PointXYZ* points, size_t n_points)
+{
+	// Initialize limits
+	PointXYZ maxP(points[0]);
+
+	// Loop over all points
+	for (size_t i = 1; i < n_points; i++)
+	{
+		const PointXYZ& p = points[i];
+		if (p.x > maxP.x)
+			maxP.x = p.x;
+
+		if (p.y > maxP.y)
+			maxP.y = p.y;
+
+		if (p.z > maxP.z)
+			maxP.z = p.z;
+	}
+
+	return maxP;
+}
+
+PointXYZ min_point(const PointXYZ* points, size_t n_points)
+{
+	// Initialize limits
+	PointXYZ minP(points[0]);
+
+	// Loop over all points
+	for (size_t i = 1; i < n_points; i++)
+	{
+		const PointXYZ& p = points[i];
+		if (p.x < minP.x)
+			minP.x = p.x;
+
+		if (p.y < minP.y)
+			minP.y = p.y;
+
+		if (p.z < minP.z)
+			minP.z = p.z;
+	}
+
+	return minP;
+}
@@ -145,6 +145,8 @@ inline PointXYZ floor(const PointXYZ P)
 
 PointXYZ max_point(std::vector<PointXYZ> points);
 PointXYZ min_point(std::vector<PointXYZ> points);
+PointXYZ max_point(const PointXYZ* points, size_t n_points);
+PointXYZ min_point(const PointXYZ* points, size_t n_points);
 
 
 struct PointCloud
@@ -174,12 +176,27 @@ struct PointCloud
 };
 
 
+// Same interface over a range of points owned by someone else (for example a numpy buffer), nothing is copied. The
+// memory must stay valid as long as a tree uses the view.
+struct PointCloudView
+{
 
+	const PointXYZ* pts;
+	size_t n_pts;
 
+	PointCloudView() { pts = NULL; n_pts = 0; }
+	PointCloudView(const PointXYZ* pts0, size_t n_pts0) { pts = pts0; n_pts = n_pts0; }
 
+	inline size_t kdtree_get_point_count() const { return n_pts; }
 
+	inline float kdtree_get_pt(const size_t idx, const size_t dim) const
+	{
+		if (dim == 0) return pts[idx].x;
+		else if (dim == 1) return pts[idx].y;
+		else return pts[idx].z;
+	}
 
+	template <class BBOX>
+	bool kdtree_get_bbox(BBOX& /* bb */) const { return false; }
 
-
-
-
+};
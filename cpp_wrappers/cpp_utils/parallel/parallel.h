@@ -0,0 +1,79 @@
+//
+//
+//		0==========================0
+//		|    Local feature test    |
+//		0==========================0
+//
+//		version 1.0 : 
+//			> 
+//
+//---------------------------------------------------
+//
+//		Parallel header :
+//		Minimal thread pool used to process independent batch elements
+//
+//----------------------------------------------------
+//
+
+
+# pragma once
+
+#include <vector>
+#include <thread>
+#include <atomic>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+
+// Number of threads actually used for a given request (n_threads < 1 means all available cores)
+inline int get_num_threads(int n_threads, int n_tasks)
+{
+	if (n_threads < 1)
+		n_threads = (int)std::thread::hardware_concurrency();
+	if (n_threads > n_tasks)
+		n_threads = n_tasks;
+	if (n_threads < 1)
+		n_threads = 1;
+	return n_threads;
+}
+
+
+// Call task(i) for every i in [0, n_tasks). Tasks are distributed dynamically because batch elements can have very
+// different sizes. With a single thread, tasks are executed in order in the calling thread. When compiled with OpenMP,
+// the threads come from its pool instead of being created at each call.
+template <typename Task>
+void parallel_for(int n_tasks, int n_threads, Task task)
+{
+	n_threads = get_num_threads(n_threads, n_tasks);
+
+	if (n_threads == 1)
+	{
+		for (int i = 0; i < n_tasks; i++)
+			task(i);
+		return;
+	}
+
+#ifdef _OPENMP
+	#pragma omp parallel for schedule(dynamic, 1) num_threads(n_threads)
+	for (int i = 0; i < n_tasks; i++)
+		task(i);
+#else
+	std::atomic<int> next_task(0);
+	std::vector<std::thread> workers;
+	workers.reserve(n_threads);
+	for (int t = 0; t < n_threads; t++)
+	{
+		workers.emplace_back([&]()
+		{
+			for (int i = next_task++; i < n_tasks; i = next_task++)
+				task(i);
+		});
+	}
+	for (auto& w : workers)
+		w.join();
+#endif
+
+	return;
+}
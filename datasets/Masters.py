@@ -40,7 +40,8 @@ from datasets.common import PointCloudDataset
 from torch.utils.data import Sampler, get_worker_info
 from utils.mayavi_visu import *
 
-from datasets.common import grid_subsampling
+from datasets.common import grid_subsampling, apply_to_neighbors, neighbors_counts, padding_waste, pin_tensor
+from datasets.common import chunked_grid_subsampling, CellIndex, PotentialField, PotentialScheduler
 from utils.config import bcolors
 
 
@@ -155,6 +156,10 @@ class MastersDataset(PointCloudDataset):
         # Start loading
         self.load_subsampled_clouds()
 
+        # Move the clouds in shared memory, read by all the input pipeline workers
+        if config.shared_clouds:
+            self.share_clouds('input_intensities', 'input_labels')
+
         ############################
         # Batch selection parameters
         ############################
@@ -163,24 +168,10 @@ class MastersDataset(PointCloudDataset):
         self.batch_limit = torch.tensor([1], dtype=torch.float32)
         self.batch_limit.share_memory_()
 
-        # Initialize potentials
+        # Initialize potentials (and their minimum, in a segment tree in shared memory)
         if use_potentials:
-            self.potentials = []
-            self.min_potentials = []
-            self.argmin_potentials = []
-            for i, tree in enumerate(self.pot_trees):
-                self.potentials += [torch.from_numpy(np.random.rand(tree.data.shape[0]) * 1e-3)]
-                min_ind = int(torch.argmin(self.potentials[-1]))
-                self.argmin_potentials += [min_ind]
-                self.min_potentials += [float(self.potentials[-1][min_ind])]
-
-            # Share potential memory
-            self.argmin_potentials = torch.from_numpy(np.array(self.argmin_potentials, dtype=np.int64))
-            self.min_potentials = torch.from_numpy(np.array(self.min_potentials, dtype=np.float64))
-            self.argmin_potentials.share_memory_()
-            self.min_potentials.share_memory_()
-            for i, _ in enumerate(self.pot_trees):
-                self.potentials[i].share_memory_()
+            self.pot_field = PotentialField([np.random.rand(tree.data.shape[0]) * 1e-3 for tree in self.pot_trees])
+            self.potentials = self.pot_field.potentials
 
             self.worker_waiting = torch.tensor([0 for _ in range(config.input_threads)], dtype=torch.int32)
             self.worker_waiting.share_memory_()
@@ -188,9 +179,8 @@ class MastersDataset(PointCloudDataset):
             self.epoch_i = 0
 
         else:
+            self.pot_field = None
             self.potentials = None
-            self.min_potentials = None
-            self.argmin_potentials = None
             self.epoch_inds = torch.from_numpy(np.zeros((2, self.epoch_n), dtype=np.int64))
             # self.epoch_inds = torch.from_numpy(np.zeros((2, 300), dtype=np.int64))
             self.epoch_i = torch.from_numpy(np.zeros((1,), dtype=np.int64))
@@ -199,6 +189,14 @@ class MastersDataset(PointCloudDataset):
 
         self.worker_lock = Lock()
 
+        # Centers of the input spheres, chosen ahead of the workers by a thread of the main process (started by the
+        # sampler, once the workers exist)
+        self.scheduler = None
+        if use_potentials:
+            self.scheduler = PotentialScheduler(self,
+                                                queue_size=max(config.input_threads, 1),
+                                                threaded=config.input_threads > 0)
+
         # For ERF visualization, we want only one cloud per batch and no randomness
         if self.set == 'ERF':
             self.batch_limit = torch.tensor([1], dtype=torch.float32)
@@ -264,52 +262,22 @@ class MastersDataset(PointCloudDataset):
                 print(message)
                 self.worker_waiting[wid] = 0
 
-            with self.worker_lock:
-
-                if debug_workers:
-                    message = ''
-                    for wi in range(info.num_workers):
-                        if wi == wid:
-                            message += ' {:}v{:} '.format(bcolors.OKGREEN, bcolors.ENDC)
-                        elif self.worker_waiting[wi] == 0:
-                            message += '   '
-                        elif self.worker_waiting[wi] == 1:
-                            message += ' | '
-                        elif self.worker_waiting[wi] == 2:
-                            message += ' o '
-                    print(message)
-                    self.worker_waiting[wid] = 1
-
-                # Get potential minimum
-                cloud_ind = int(torch.argmin(self.min_potentials))
-                point_ind = int(self.argmin_potentials[cloud_ind])
-
-                # Get potential points from tree structure
-                pot_points = np.array(self.pot_trees[cloud_ind].data, copy=False)
-
-                # Center point of input region
-                center_point = pot_points[point_ind, :].copy().reshape(1, -1)
+            # Center of the input sphere, chosen ahead by the scheduler (potentials already updated)
+            cloud_ind, point_ind, center_point = self.scheduler.get()
 
-                # Add a small noise to center point
-                if self.set != 'ERF':
-                    center_point += np.random.normal(scale=self.config.in_radius / 10, size=center_point.shape)
-
-                # Indices of points in input region
-                pot_inds, dists = self.pot_trees[cloud_ind].query_radius(center_point,
-                                                                         r=self.config.in_radius,
-                                                                         return_distance=True)
-
-                d2s = np.square(dists[0])
-                pot_inds = pot_inds[0]
-
-                # Update potentials (Tukey weights)
-                if self.set != 'ERF':
-                    tukeys = np.square(1 - d2s / np.square(self.config.in_radius))
-                    tukeys[d2s > np.square(self.config.in_radius)] = 0
-                    self.potentials[cloud_ind][pot_inds] += tukeys
-                    min_ind = torch.argmin(self.potentials[cloud_ind])
-                    self.min_potentials[[cloud_ind]] = self.potentials[cloud_ind][min_ind]
-                    self.argmin_potentials[[cloud_ind]] = min_ind
+            if debug_workers:
+                message = ''
+                for wi in range(info.num_workers):
+                    if wi == wid:
+                        message += ' {:}v{:} '.format(bcolors.OKGREEN, bcolors.ENDC)
+                    elif self.worker_waiting[wi] == 0:
+                        message += '   '
+                    elif self.worker_waiting[wi] == 1:
+                        message += ' | '
+                    elif self.worker_waiting[wi] == 2:
+                        message += ' o '
+                print(message)
+                self.worker_waiting[wid] = 1
 
             t += [time.time()]
 
@@ -320,6 +288,10 @@ class MastersDataset(PointCloudDataset):
             input_inds = self.input_trees[cloud_ind].query_radius(center_point,
                                                                   r=self.config.in_radius)[0]
 
+            # Sphere in memory order (along the Morton curve of the cloud when it is sorted)
+            if self.config.morton_order:
+                input_inds = np.sort(input_inds)
+
             t += [time.time()]
 
             # Number collected
@@ -328,7 +300,7 @@ class MastersDataset(PointCloudDataset):
             # Safe check for empty spheres
             if n < 2:
                 print(f"DEBUG: Empty Sphere...\n"
-                      f"{pot_points[point_ind, :].reshape(1, -1)=}\n"
+                      f"{self.pot_trees[cloud_ind].data[point_ind, :].reshape(1, -1)=}\n"
                       f"{center_point=}, {self.config.in_radius=}\n"
                       f"{input_inds=}\n")
                 failed_attempts += 1
@@ -339,7 +311,7 @@ class MastersDataset(PointCloudDataset):
                 continue
 
             # Collect labels and colors
-            input_points = (self.input_trees[cloud_ind].data.base[input_inds] - center_point).astype(np.float32)
+            input_points = (self.input_trees[cloud_ind].data[input_inds] - center_point).astype(np.float32)
             if self.input_intensities[0] is not None:
                 input_intensity = self.input_intensities[cloud_ind][input_inds]
             if self.set in ['test', 'ERF']:
@@ -536,6 +508,10 @@ class MastersDataset(PointCloudDataset):
             input_inds = self.input_trees[cloud_ind].query_radius(center_point,
                                                                   r=self.config.in_radius)[0]
 
+            # Sphere in memory order (along the Morton curve of the cloud when it is sorted)
+            if self.config.morton_order:
+                input_inds = np.sort(input_inds)
+
             # Number collected
             n = input_inds.shape[0]
 
@@ -645,9 +621,9 @@ class MastersDataset(PointCloudDataset):
         if not exists(tree_path):
             makedirs(tree_path)
 
-        ##############
-        # Load KDTrees
-        ##############
+        #####################
+        # Load spatial index
+        #####################
 
         for i, file_path in enumerate(self.files):
 
@@ -658,47 +634,77 @@ class MastersDataset(PointCloudDataset):
             cloud_name = self.cloud_names[i]
 
             # Name of the input files
-            KDTree_file = join(tree_path, '{:s}_KDTree.pkl'.format(cloud_name))
+            index_file = join(tree_path, '{:s}_index.bin'.format(cloud_name))
             sub_npy_file = join(tree_path, '{:s}.npy'.format(cloud_name))
 
             # Check if inputs have already been computed
-            if exists(KDTree_file):
-                print('\nFound KDTree for cloud {:s}, subsampled at {:.3f}'.format(cloud_name, dl))
+            if exists(index_file):
+                print('\nFound spatial index for cloud {:s}, subsampled at {:.3f}'.format(cloud_name, dl))
 
                 data = np.load(sub_npy_file)
                 sub_intensity = data[:, 3].reshape(-1,1) # Expected as a 2D array
                 sub_labels = data[:, 4].astype(np.int32)
 
-                # Read pkl with search tree
-                with open(KDTree_file, 'rb') as f:
-                    search_tree = pickle.load(f)
+                # Open the spatial index (memory-mapped)
+                search_tree = CellIndex.load(index_file)
 
             else:
-                print('\nPreparing KDTree for cloud {:s}, subsampled at {:.3f}'.format(cloud_name, dl))
+                print('\nPreparing spatial index for cloud {:s}, subsampled at {:.3f}'.format(cloud_name, dl))
 
-                data = np.load(file_path).astype(np.float32)
-                points = data[:, :3]
-                intensity = data[:, 3].reshape(-1,1) # Expected as a 2D array
-                labels = data[:, -1].astype(np.int32)
+                # The validation and test clouds also need the subsampled point of each original point, for reprojection
+                need_proj = self.set in ['validate', 'test']
 
-                # Subsample cloud
-                sub_points, sub_intensity, sub_labels = grid_subsampling(points,
-                                                                         features=intensity,
-                                                                         labels=labels,
-                                                                         sampleDl=dl)
+                if self.config.subsampling_chunk_size > 0:
+
+                    # Subsample the memory-mapped cloud chunk by chunk
+                    chunk_size = self.config.subsampling_chunk_size
+                    data = np.load(file_path, mmap_mode='r')
+
+                    def read_chunk(i0, i1):
+                        chunk = data[i0:i1].astype(np.float32)
+                        return chunk[:, :3], chunk[:, 3].reshape(-1, 1), chunk[:, -1].astype(np.int32)
+
+                    sub_outputs = chunked_grid_subsampling(read_chunk,
+                                                           data.shape[0],
+                                                           sampleDl=dl,
+                                                           chunk_size=chunk_size,
+                                                           return_inverse=need_proj,
+                                                           morton_order=self.config.morton_order)
+
+                else:
+                    data = np.load(file_path).astype(np.float32)
+                    points = data[:, :3]
+                    intensity = data[:, 3].reshape(-1,1) # Expected as a 2D array
+                    labels = data[:, -1].astype(np.int32)
+
+                    # Subsample cloud
+                    sub_outputs = grid_subsampling(points,
+                                                   features=intensity,
+                                                   labels=labels,
+                                                   sampleDl=dl,
+                                                   engine=self.config.subsampling_engine,
+                                                   return_inverse=need_proj,
+                                                   morton_order=self.config.morton_order)
+
+                sub_points, sub_intensity, sub_labels = sub_outputs[:3]
+
+                # Save the reprojection indices, which are directly given by the voxel of each original point
+                if need_proj:
+                    proj_file = join(tree_path, '{:s}_proj.pkl'.format(cloud_name))
+                    proj_inds = sub_outputs[3]
+                    labels = np.array(np.load(file_path, mmap_mode='r')[:, -1])
+                    with open(proj_file, 'wb') as f:
+                        pickle.dump([proj_inds, labels], f)
 
                 # Rescale float color and squeeze label
                 # sub_colors = sub_colors / 255
                 sub_labels = np.squeeze(sub_labels)
 
                 # Get chosen neighborhoods
-                search_tree = KDTree(sub_points, leaf_size=10)
-                # search_tree = nnfln.KDTree(n_neighbors=1, metric='L2', leaf_size=10)
-                # search_tree.fit(sub_points)
+                search_tree = CellIndex(sub_points)
 
-                # Save KDTree
-                with open(KDTree_file, 'wb') as f:
-                    pickle.dump(search_tree, f)
+                # Save spatial index
+                search_tree.save(index_file)
 
                 # Save npy, we DONT structure this because headaches
                 joined = np.column_stack((sub_points, sub_intensity, sub_labels))
@@ -732,25 +738,25 @@ class MastersDataset(PointCloudDataset):
                 cloud_name = self.cloud_names[i]
 
                 # Name of the input files
-                coarse_KDTree_file = join(tree_path, '{:s}_coarse_KDTree.pkl'.format(cloud_name))
+                coarse_index_file = join(tree_path, '{:s}_coarse_index.bin'.format(cloud_name))
 
                 # Check if inputs have already been computed
-                if exists(coarse_KDTree_file):
-                    # Read pkl with search tree
-                    with open(coarse_KDTree_file, 'rb') as f:
-                        search_tree = pickle.load(f)
+                if exists(coarse_index_file):
+                    # Open the spatial index (memory-mapped)
+                    search_tree = CellIndex.load(coarse_index_file)
 
                 else:
                     # Subsample cloud
                     sub_points = np.array(self.input_trees[cloud_ind].data, copy=False)
-                    coarse_points = grid_subsampling(sub_points.astype(np.float32), sampleDl=pot_dl)
+                    coarse_points = grid_subsampling(sub_points.astype(np.float32),
+                                                     sampleDl=pot_dl,
+                                                     engine=self.config.subsampling_engine)
 
                     # Get chosen neighborhoods
-                    search_tree = KDTree(coarse_points, leaf_size=10)
+                    search_tree = CellIndex(coarse_points)
 
-                    # Save KDTree
-                    with open(coarse_KDTree_file, 'wb') as f:
-                        pickle.dump(search_tree, f)
+                    # Save spatial index
+                    search_tree.save(coarse_index_file)
 
                 # Fill data containers
                 self.pot_trees += [search_tree]
@@ -782,7 +788,7 @@ class MastersDataset(PointCloudDataset):
                 # File name for saving
                 proj_file = join(tree_path, '{:s}_proj.pkl'.format(cloud_name))
 
-                # Try to load previous indices
+                # Try to load previous indices (saved with the subsampled cloud), else use the nearest subsampled points
                 if exists(proj_file):
                     with open(proj_file, 'rb') as f:
                         proj_inds, labels = pickle.load(f)
@@ -915,6 +921,10 @@ class MastersSampler(Sampler):
             # Update epoch inds
             self.dataset.epoch_inds += torch.from_numpy(all_epoch_inds)
 
+        # Start choosing the sphere centers (the workers exist once the first batch is asked)
+        if self.dataset.use_potentials:
+            self.dataset.scheduler.start()
+
         # Generator loop
         for i in range(self.N):
             yield i
@@ -1009,6 +1019,7 @@ class MastersSampler(Sampler):
                                average batch size (number of stacked pointclouds) is the one asked.
         Neighbors calibration: Set the "neighborhood_limits" (the maximum number of neighbors allowed in convolutions)
                                so that 90% of the neighborhoods remain untouched. There is a limit for each layer.
+                               Skipped in the knn neighborhood mode.
         """
 
         ##############################
@@ -1059,6 +1070,9 @@ class MastersSampler(Sampler):
         # Neighbors limit
         # ***************
 
+        # The knn neighborhoods have a fixed size and do not need limits
+        calib_neighbors = self.dataset.config.neighborhood_mode != 'knn'
+
         # Load neighb_limits dictionary
         neighb_lim_file = join(self.dataset.path, 'neighbors_limits.pkl')
         if exists(neighb_lim_file):
@@ -1081,12 +1095,14 @@ class MastersSampler(Sampler):
             if key in neighb_lim_dict:
                 neighb_limits += [neighb_lim_dict[key]]
 
-        if not redo and len(neighb_limits) == self.dataset.config.num_layers:
+        if not calib_neighbors:
+            self.dataset.neighborhood_limits = []
+        elif not redo and len(neighb_limits) == self.dataset.config.num_layers:
             self.dataset.neighborhood_limits = neighb_limits
         else:
             redo = True
 
-        if verbose:
+        if verbose and calib_neighbors:
             print('Check neighbors limit dictionary')
             for layer_ind in range(self.dataset.config.num_layers):
                 dl = self.dataset.config.first_subsampling_dl * (2 ** layer_ind)
@@ -1163,10 +1179,10 @@ class MastersSampler(Sampler):
                 for batch_i, batch in enumerate(dataloader):
 
                     # Update neighborhood histogram
-                    counts = [np.sum(neighb_mat.numpy() < neighb_mat.shape[0], axis=1) for neighb_mat in
-                              batch.neighbors]
-                    hists = [np.bincount(c, minlength=hist_n)[:hist_n] for c in counts]
-                    neighb_hists += np.vstack(hists)
+                    if calib_neighbors:
+                        counts = [neighbors_counts(neighb_mat) for neighb_mat in batch.neighbors]
+                        hists = [np.bincount(c, minlength=hist_n)[:hist_n] for c in counts]
+                        neighb_hists += np.vstack(hists)
 
                     # batch length
                     b = len(batch.cloud_inds)
@@ -1246,40 +1262,42 @@ class MastersSampler(Sampler):
 
                 # a = 1 / 0
 
-            # Use collected neighbor histogram to get neighbors limit
-            cumsum = np.cumsum(neighb_hists.T, axis=0)
-            percentiles = np.sum(cumsum < (untouched_ratio * cumsum[hist_n - 1, :]), axis=0)
-            self.dataset.neighborhood_limits = percentiles
-
-            if verbose:
-
-                # Crop histogram
-                while np.sum(neighb_hists[:, -1]) == 0:
-                    neighb_hists = neighb_hists[:, :-1]
-                hist_n = neighb_hists.shape[1]
-
-                print('\n**************************************************\n')
-                line0 = 'neighbors_num '
-                for layer in range(neighb_hists.shape[0]):
-                    line0 += '|  layer {:2d}  '.format(layer)
-                print(line0)
-                for neighb_size in range(hist_n):
-                    line0 = '     {:4d}     '.format(neighb_size)
-                    for layer in range(neighb_hists.shape[0]):
-                        if neighb_size > percentiles[layer]:
-                            color = bcolors.FAIL
-                        else:
-                            color = bcolors.OKGREEN
-                        line0 += '|{:}{:10d}{:}  '.format(color,
-                                                          neighb_hists[layer, neighb_size],
-                                                          bcolors.ENDC)
+            if calib_neighbors:
 
-                    print(line0)
+                # Use collected neighbor histogram to get neighbors limit
+                cumsum = np.cumsum(neighb_hists.T, axis=0)
+                percentiles = np.sum(cumsum < (untouched_ratio * cumsum[hist_n - 1, :]), axis=0)
+                self.dataset.neighborhood_limits = percentiles
 
-                print('\n**************************************************\n')
-                print('\nchosen neighbors limits: ',
-                      percentiles)  # Its choosing these based off something to do with percentiles which relates to where the verbose printing turned red
-                print()
+                if verbose:
+
+                    # Crop histogram
+                    while np.sum(neighb_hists[:, -1]) == 0:
+                        neighb_hists = neighb_hists[:, :-1]
+                    hist_n = neighb_hists.shape[1]
+
+                    print('\n**************************************************\n')
+                    line0 = 'neighbors_num '
+                    for layer in range(neighb_hists.shape[0]):
+                        line0 += '|  layer {:2d}  '.format(layer)
+                    print(line0)
+                    for neighb_size in range(hist_n):
+                        line0 = '     {:4d}     '.format(neighb_size)
+                        for layer in range(neighb_hists.shape[0]):
+                            if neighb_size > percentiles[layer]:
+                                color = bcolors.FAIL
+                            else:
+                                color = bcolors.OKGREEN
+                            line0 += '|{:}{:10d}{:}  '.format(color,
+                                                              neighb_hists[layer, neighb_size],
+                                                              bcolors.ENDC)
+
+                        print(line0)
+
+                    print('\n**************************************************\n')
+                    print('\nchosen neighbors limits: ',
+                          percentiles)  # Its choosing these based off something to do with percentiles which relates to where the verbose printing turned red
+                    print()
 
             # Save batch_limit dictionary
             if self.dataset.use_potentials:
@@ -1295,16 +1313,17 @@ class MastersSampler(Sampler):
                 pickle.dump(batch_lim_dict, file)
 
             # Save neighb_limit dictionary
-            for layer_ind in range(self.dataset.config.num_layers):
-                dl = self.dataset.config.first_subsampling_dl * (2 ** layer_ind)
-                if self.dataset.config.deform_layers[layer_ind]:
-                    r = dl * self.dataset.config.deform_radius
-                else:
-                    r = dl * self.dataset.config.conv_radius
-                key = '{:.3f}_{:.3f}'.format(dl, r)
-                neighb_lim_dict[key] = self.dataset.neighborhood_limits[layer_ind]
-            with open(neighb_lim_file, 'wb') as file:
-                pickle.dump(neighb_lim_dict, file)
+            if calib_neighbors:
+                for layer_ind in range(self.dataset.config.num_layers):
+                    dl = self.dataset.config.first_subsampling_dl * (2 ** layer_ind)
+                    if self.dataset.config.deform_layers[layer_ind]:
+                        r = dl * self.dataset.config.deform_radius
+                    else:
+                        r = dl * self.dataset.config.conv_radius
+                    key = '{:.3f}_{:.3f}'.format(dl, r)
+                    neighb_lim_dict[key] = self.dataset.neighborhood_limits[layer_ind]
+                with open(neighb_lim_file, 'wb') as file:
+                    pickle.dump(neighb_lim_dict, file)
 
         print('Calibration done in {:.1f}s\n'.format(time.time() - t0))
         return
@@ -1323,15 +1342,15 @@ class MastersCustomBatch:
 
         # Extract input tensors from the list of numpy array
         ind = 0
-        self.points = [torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]]
+        self.points = [torch.as_tensor(nparray) for nparray in input_list[ind:ind + L]]
         ind += L
-        self.neighbors = [torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]]
+        self.neighbors = [apply_to_neighbors(nparray, torch.as_tensor) for nparray in input_list[ind:ind + L]]
         ind += L
-        self.pools = [torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]]
+        self.pools = [apply_to_neighbors(nparray, torch.as_tensor) for nparray in input_list[ind:ind + L]]
         ind += L
-        self.upsamples = [torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]]
+        self.upsamples = [torch.as_tensor(nparray) for nparray in input_list[ind:ind + L]]
         ind += L
-        self.lengths = [torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]]
+        self.lengths = [torch.as_tensor(nparray) for nparray in input_list[ind:ind + L]]
         ind += L
         self.features = torch.from_numpy(input_list[ind])
         ind += 1
@@ -1354,11 +1373,11 @@ class MastersCustomBatch:
         Manual pinning of the memory
         """
 
-        self.points = [in_tensor.pin_memory() for in_tensor in self.points]
-        self.neighbors = [in_tensor.pin_memory() for in_tensor in self.neighbors]
-        self.pools = [in_tensor.pin_memory() for in_tensor in self.pools]
-        self.upsamples = [in_tensor.pin_memory() for in_tensor in self.upsamples]
-        self.lengths = [in_tensor.pin_memory() for in_tensor in self.lengths]
+        self.points = [pin_tensor(in_tensor) for in_tensor in self.points]
+        self.neighbors = [apply_to_neighbors(in_tensor, pin_tensor) for in_tensor in self.neighbors]
+        self.pools = [apply_to_neighbors(in_tensor, pin_tensor) for in_tensor in self.pools]
+        self.upsamples = [pin_tensor(in_tensor) for in_tensor in self.upsamples]
+        self.lengths = [pin_tensor(in_tensor) for in_tensor in self.lengths]
         self.features = self.features.pin_memory()
         self.labels = self.labels.pin_memory()
         self.scales = self.scales.pin_memory()
@@ -1372,8 +1391,8 @@ class MastersCustomBatch:
     def to(self, device):
 
         self.points = [in_tensor.to(device) for in_tensor in self.points]
-        self.neighbors = [in_tensor.to(device) for in_tensor in self.neighbors]
-        self.pools = [in_tensor.to(device) for in_tensor in self.pools]
+        self.neighbors = [apply_to_neighbors(in_tensor, lambda t: t.to(device)) for in_tensor in self.neighbors]
+        self.pools = [apply_to_neighbors(in_tensor, lambda t: t.to(device)) for in_tensor in self.pools]
         self.upsamples = [in_tensor.to(device) for in_tensor in self.upsamples]
         self.lengths = [in_tensor.to(device) for in_tensor in self.lengths]
         self.features = self.features.to(device)
@@ -1589,6 +1608,35 @@ def debug_show_clouds(dataset, loader):
     print(counts)
 
 
+def debug_padding_waste(dataset, loader):
+    """Fraction of the padded neighbors and pools matrices taken by shadow neighbors, at each layer"""
+
+    L = dataset.config.num_layers
+
+    for epoch in range(10):
+
+        neighb_waste = np.zeros(L)
+        pool_waste = np.zeros(L)
+        n_batches = 0
+
+        for batch_i, batch in enumerate(loader):
+
+            # Waste of each layer (also computed for ragged neighbors, as the padding they avoid)
+            for layer in range(L):
+                n_supports = batch.points[layer].shape[0]
+                neighb_waste[layer] += padding_waste(neighbors_counts(batch.neighbors[layer], n_supports))
+                pool_waste[layer] += padding_waste(neighbors_counts(batch.pools[layer], n_supports))
+            n_batches += 1
+
+        print('\nPadding waste (fraction of shadow neighbors)')
+        for layer in range(L):
+            print('layer {:2d} : neighbors {:5.1f}%  pools {:5.1f}%'.format(layer,
+                                                                          100 * neighb_waste[layer] / n_batches,
+                                                                          100 * pool_waste[layer] / n_batches))
+
+        print('************* Epoch ended *************')
+
+
 def debug_batch_and_neighbors_calib(dataset, loader):
     """Timing of generator function"""
 
@@ -39,7 +39,7 @@ from datasets.common import PointCloudDataset
 from torch.utils.data import Sampler, get_worker_info
 from utils.mayavi_visu import *
 
-from datasets.common import grid_subsampling
+from datasets.common import grid_subsampling, apply_to_neighbors, neighbors_counts, pin_tensor
 from utils.config import bcolors
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -444,6 +444,7 @@ class ModelNet40Sampler(Sampler):
                                average batch size (number of stacked pointclouds) is the one asked.
         Neighbors calibration: Set the "neighborhood_limits" (the maximum number of neighbors allowed in convolutions)
                                so that 90% of the neighborhoods remain untouched. There is a limit for each layer.
+                               Skipped in the knn neighborhood mode.
         """
 
         ##############################
@@ -488,6 +489,9 @@ class ModelNet40Sampler(Sampler):
         # Neighbors limit
         # ***************
 
+        # The knn neighborhoods have a fixed size and do not need limits
+        calib_neighbors = self.dataset.config.neighborhood_mode != 'knn'
+
         # Load neighb_limits dictionary
         neighb_lim_file = join(self.dataset.path, 'neighbors_limits.pkl')
         if exists(neighb_lim_file):
@@ -510,12 +514,14 @@ class ModelNet40Sampler(Sampler):
             if key in neighb_lim_dict:
                 neighb_limits += [neighb_lim_dict[key]]
 
-        if len(neighb_limits) == self.dataset.config.num_layers:
+        if not calib_neighbors:
+            self.dataset.neighborhood_limits = []
+        elif len(neighb_limits) == self.dataset.config.num_layers:
             self.dataset.neighborhood_limits = neighb_limits
         else:
             redo = True
 
-        if verbose:
+        if verbose and calib_neighbors:
             print('Check neighbors limit dictionary')
             for layer_ind in range(self.dataset.config.num_layers):
                 dl = self.dataset.config.first_subsampling_dl * (2**layer_ind)
@@ -575,9 +581,10 @@ class ModelNet40Sampler(Sampler):
                 for batch_i, batch in enumerate(dataloader):
 
                     # Update neighborhood histogram
-                    counts = [np.sum(neighb_mat.numpy() < neighb_mat.shape[0], axis=1) for neighb_mat in batch.neighbors]
-                    hists = [np.bincount(c, minlength=hist_n)[:hist_n] for c in counts]
-                    neighb_hists += np.vstack(hists)
+                    if calib_neighbors:
+                        counts = [neighbors_counts(neighb_mat) for neighb_mat in batch.neighbors]
+                        hists = [np.bincount(c, minlength=hist_n)[:hist_n] for c in counts]
+                        neighb_hists += np.vstack(hists)
 
                     # batch length
                     b = len(batch.labels)
@@ -620,39 +627,41 @@ class ModelNet40Sampler(Sampler):
                 if breaking:
                     break
 
-            # Use collected neighbor histogram to get neighbors limit
-            cumsum = np.cumsum(neighb_hists.T, axis=0)
-            percentiles = np.sum(cumsum < (untouched_ratio * cumsum[hist_n - 1, :]), axis=0)
-            self.dataset.neighborhood_limits = percentiles
-
-            if verbose:
-
-                # Crop histogram
-                while np.sum(neighb_hists[:, -1]) == 0:
-                    neighb_hists = neighb_hists[:, :-1]
-                hist_n = neighb_hists.shape[1]
-
-                print('\n**************************************************\n')
-                line0 = 'neighbors_num '
-                for layer in range(neighb_hists.shape[0]):
-                    line0 += '|  layer {:2d}  '.format(layer)
-                print(line0)
-                for neighb_size in range(hist_n):
-                    line0 = '     {:4d}     '.format(neighb_size)
-                    for layer in range(neighb_hists.shape[0]):
-                        if neighb_size > percentiles[layer]:
-                            color = bcolors.FAIL
-                        else:
-                            color = bcolors.OKGREEN
-                        line0 += '|{:}{:10d}{:}  '.format(color,
-                                                         neighb_hists[layer, neighb_size],
-                                                         bcolors.ENDC)
+            if calib_neighbors:
 
-                    print(line0)
+                # Use collected neighbor histogram to get neighbors limit
+                cumsum = np.cumsum(neighb_hists.T, axis=0)
+                percentiles = np.sum(cumsum < (untouched_ratio * cumsum[hist_n - 1, :]), axis=0)
+                self.dataset.neighborhood_limits = percentiles
 
-                print('\n**************************************************\n')
-                print('\nchosen neighbors limits: ', percentiles)
-                print()
+                if verbose:
+
+                    # Crop histogram
+                    while np.sum(neighb_hists[:, -1]) == 0:
+                        neighb_hists = neighb_hists[:, :-1]
+                    hist_n = neighb_hists.shape[1]
+
+                    print('\n**************************************************\n')
+                    line0 = 'neighbors_num '
+                    for layer in range(neighb_hists.shape[0]):
+                        line0 += '|  layer {:2d}  '.format(layer)
+                    print(line0)
+                    for neighb_size in range(hist_n):
+                        line0 = '     {:4d}     '.format(neighb_size)
+                        for layer in range(neighb_hists.shape[0]):
+                            if neighb_size > percentiles[layer]:
+                                color = bcolors.FAIL
+                            else:
+                                color = bcolors.OKGREEN
+                            line0 += '|{:}{:10d}{:}  '.format(color,
+                                                             neighb_hists[layer, neighb_size],
+                                                             bcolors.ENDC)
+
+                        print(line0)
+
+                    print('\n**************************************************\n')
+                    print('\nchosen neighbors limits: ', percentiles)
+                    print()
 
             # Save batch_limit dictionary
             key = '{:.3f}_{:d}'.format(self.dataset.config.first_subsampling_dl,
@@ -662,16 +671,17 @@ class ModelNet40Sampler(Sampler):
                 pickle.dump(batch_lim_dict, file)
 
             # Save neighb_limit dictionary
-            for layer_ind in range(self.dataset.config.num_layers):
-                dl = self.dataset.config.first_subsampling_dl * (2 ** layer_ind)
-                if self.dataset.config.deform_layers[layer_ind]:
-                    r = dl * self.dataset.config.deform_radius
-                else:
-                    r = dl * self.dataset.config.conv_radius
-                key = '{:.3f}_{:.3f}'.format(dl, r)
-                neighb_lim_dict[key] = self.dataset.neighborhood_limits[layer_ind]
-            with open(neighb_lim_file, 'wb') as file:
-                pickle.dump(neighb_lim_dict, file)
+            if calib_neighbors:
+                for layer_ind in range(self.dataset.config.num_layers):
+                    dl = self.dataset.config.first_subsampling_dl * (2 ** layer_ind)
+                    if self.dataset.config.deform_layers[layer_ind]:
+                        r = dl * self.dataset.config.deform_radius
+                    else:
+                        r = dl * self.dataset.config.conv_radius
+                    key = '{:.3f}_{:.3f}'.format(dl, r)
+                    neighb_lim_dict[key] = self.dataset.neighborhood_limits[layer_ind]
+                with open(neighb_lim_file, 'wb') as file:
+                    pickle.dump(neighb_lim_dict, file)
 
 
         print('Calibration done in {:.1f}s\n'.format(time.time() - t0))
@@ -691,13 +701,13 @@ class ModelNet40CustomBatch:
 
         # Extract input tensors from the list of numpy array
         ind = 0
-        self.points = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.points = [torch.as_tensor(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.neighbors = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.neighbors = [apply_to_neighbors(nparray, torch.as_tensor) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.pools = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.pools = [apply_to_neighbors(nparray, torch.as_tensor) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.lengths = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.lengths = [torch.as_tensor(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
         self.features = torch.from_numpy(input_list[ind])
         ind += 1
@@ -716,10 +726,10 @@ class ModelNet40CustomBatch:
         Manual pinning of the memory
         """
 
-        self.points = [in_tensor.pin_memory() for in_tensor in self.points]
-        self.neighbors = [in_tensor.pin_memory() for in_tensor in self.neighbors]
-        self.pools = [in_tensor.pin_memory() for in_tensor in self.pools]
-        self.lengths = [in_tensor.pin_memory() for in_tensor in self.lengths]
+        self.points = [pin_tensor(in_tensor) for in_tensor in self.points]
+        self.neighbors = [apply_to_neighbors(in_tensor, pin_tensor) for in_tensor in self.neighbors]
+        self.pools = [apply_to_neighbors(in_tensor, pin_tensor) for in_tensor in self.pools]
+        self.lengths = [pin_tensor(in_tensor) for in_tensor in self.lengths]
         self.features = self.features.pin_memory()
         self.labels = self.labels.pin_memory()
         self.scales = self.scales.pin_memory()
@@ -731,8 +741,8 @@ class ModelNet40CustomBatch:
     def to(self, device):
 
         self.points = [in_tensor.to(device) for in_tensor in self.points]
-        self.neighbors = [in_tensor.to(device) for in_tensor in self.neighbors]
-        self.pools = [in_tensor.to(device) for in_tensor in self.pools]
+        self.neighbors = [apply_to_neighbors(in_tensor, lambda t: t.to(device)) for in_tensor in self.neighbors]
+        self.pools = [apply_to_neighbors(in_tensor, lambda t: t.to(device)) for in_tensor in self.pools]
         self.lengths = [in_tensor.to(device) for in_tensor in self.lengths]
         self.features = self.features.to(device)
         self.labels = self.labels.to(device)
@@ -40,7 +40,8 @@ from datasets.common import PointCloudDataset
 from torch.utils.data import Sampler, get_worker_info
 from utils.mayavi_visu import *
 
-from datasets.common import grid_subsampling
+from datasets.common import grid_subsampling, apply_to_neighbors, neighbors_counts, pin_tensor
+from datasets.common import chunked_grid_subsampling, CellIndex, PotentialField, PotentialScheduler
 from utils.config import bcolors
 
 
@@ -170,6 +171,10 @@ class S3DISDataset(PointCloudDataset):
         # Start loading
         self.load_subsampled_clouds()
 
+        # Move the clouds in shared memory, read by all the input pipeline workers
+        if config.shared_clouds:
+            self.share_clouds('input_colors', 'input_labels')
+
         ############################
         # Batch selection parameters
         ############################
@@ -178,24 +183,10 @@ class S3DISDataset(PointCloudDataset):
         self.batch_limit = torch.tensor([1], dtype=torch.float32)
         self.batch_limit.share_memory_()
 
-        # Initialize potentials
+        # Initialize potentials (and their minimum, in a segment tree in shared memory)
         if use_potentials:
-            self.potentials = []
-            self.min_potentials = []
-            self.argmin_potentials = []
-            for i, tree in enumerate(self.pot_trees):
-                self.potentials += [torch.from_numpy(np.random.rand(tree.data.shape[0]) * 1e-3)]
-                min_ind = int(torch.argmin(self.potentials[-1]))
-                self.argmin_potentials += [min_ind]
-                self.min_potentials += [float(self.potentials[-1][min_ind])]
-
-            # Share potential memory
-            self.argmin_potentials = torch.from_numpy(np.array(self.argmin_potentials, dtype=np.int64))
-            self.min_potentials = torch.from_numpy(np.array(self.min_potentials, dtype=np.float64))
-            self.argmin_potentials.share_memory_()
-            self.min_potentials.share_memory_()
-            for i, _ in enumerate(self.pot_trees):
-                self.potentials[i].share_memory_()
+            self.pot_field = PotentialField([np.random.rand(tree.data.shape[0]) * 1e-3 for tree in self.pot_trees])
+            self.potentials = self.pot_field.potentials
 
             self.worker_waiting = torch.tensor([0 for _ in range(config.input_threads)], dtype=torch.int32)
             self.worker_waiting.share_memory_()
@@ -203,9 +194,8 @@ class S3DISDataset(PointCloudDataset):
             self.epoch_i = 0
 
         else:
+            self.pot_field = None
             self.potentials = None
-            self.min_potentials = None
-            self.argmin_potentials = None
             self.epoch_inds = torch.from_numpy(np.zeros((2, self.epoch_n), dtype=np.int64))
             self.epoch_i = torch.from_numpy(np.zeros((1,), dtype=np.int64))
             self.epoch_i.share_memory_()
@@ -213,6 +203,14 @@ class S3DISDataset(PointCloudDataset):
 
         self.worker_lock = Lock()
 
+        # Centers of the input spheres, chosen ahead of the workers by a thread of the main process (started by the
+        # sampler, once the workers exist)
+        self.scheduler = None
+        if use_potentials:
+            self.scheduler = PotentialScheduler(self,
+                                                queue_size=max(config.input_threads, 1),
+                                                threaded=config.input_threads > 0)
+
         # For ERF visualization, we want only one cloud per batch and no randomness
         if self.set == 'ERF':
             self.batch_limit = torch.tensor([1], dtype=torch.float32)
@@ -278,53 +276,22 @@ class S3DISDataset(PointCloudDataset):
                 print(message)
                 self.worker_waiting[wid] = 0
 
-            with self.worker_lock:
-
-                if debug_workers:
-                    message = ''
-                    for wi in range(info.num_workers):
-                        if wi == wid:
-                            message += ' {:}v{:} '.format(bcolors.OKGREEN, bcolors.ENDC)
-                        elif self.worker_waiting[wi] == 0:
-                            message += '   '
-                        elif self.worker_waiting[wi] == 1:
-                            message += ' | '
-                        elif self.worker_waiting[wi] == 2:
-                            message += ' o '
-                    print(message)
-                    self.worker_waiting[wid] = 1
-
-                # Get potential minimum
-                cloud_ind = int(torch.argmin(self.min_potentials))
-                point_ind = int(self.argmin_potentials[cloud_ind])
-
-                # Get potential points from tree structure
-                pot_points = np.array(self.pot_trees[cloud_ind].data, copy=False)
+            # Center of the input sphere, chosen ahead by the scheduler (potentials already updated)
+            cloud_ind, point_ind, center_point = self.scheduler.get()
 
-                # Center point of input region
-                # THIS IS ONE POINT
-                center_point = pot_points[point_ind, :].reshape(1, -1)
-
-                # Add a small noise to center point
-                if self.set != 'ERF':
-                    center_point += np.random.normal(scale=self.config.in_radius / 10, size=center_point.shape)
-
-                # Indices of points in input region
-                pot_inds, dists = self.pot_trees[cloud_ind].query_radius(center_point,
-                                                                         r=self.config.in_radius,
-                                                                         return_distance=True)
-
-                d2s = np.square(dists[0])
-                pot_inds = pot_inds[0]
-
-                # Update potentials (Tukey weights)
-                if self.set != 'ERF':
-                    tukeys = np.square(1 - d2s / np.square(self.config.in_radius))
-                    tukeys[d2s > np.square(self.config.in_radius)] = 0
-                    self.potentials[cloud_ind][pot_inds] += tukeys
-                    min_ind = torch.argmin(self.potentials[cloud_ind])
-                    self.min_potentials[[cloud_ind]] = self.potentials[cloud_ind][min_ind]
-                    self.argmin_potentials[[cloud_ind]] = min_ind
+            if debug_workers:
+                message = ''
+                for wi in range(info.num_workers):
+                    if wi == wid:
+                        message += ' {:}v{:} '.format(bcolors.OKGREEN, bcolors.ENDC)
+                    elif self.worker_waiting[wi] == 0:
+                        message += '   '
+                    elif self.worker_waiting[wi] == 1:
+                        message += ' | '
+                    elif self.worker_waiting[wi] == 2:
+                        message += ' o '
+                print(message)
+                self.worker_waiting[wid] = 1
 
             t += [time.time()]
 
@@ -335,6 +302,10 @@ class S3DISDataset(PointCloudDataset):
             input_inds = self.input_trees[cloud_ind].query_radius(center_point,
                                                                   r=self.config.in_radius)[0]
 
+            # Sphere in memory order (along the Morton curve of the cloud when it is sorted)
+            if self.config.morton_order:
+                input_inds = np.sort(input_inds)
+
             t += [time.time()]
 
             # Number collected
@@ -545,6 +516,10 @@ class S3DISDataset(PointCloudDataset):
             input_inds = self.input_trees[cloud_ind].query_radius(center_point,
                                                                   r=self.config.in_radius)[0]
 
+            # Sphere in memory order (along the Morton curve of the cloud when it is sorted)
+            if self.config.morton_order:
+                input_inds = np.sort(input_inds)
+
             # Number collected
             n = input_inds.shape[0]
 
@@ -727,9 +702,9 @@ class S3DISDataset(PointCloudDataset):
         if not exists(tree_path):
             makedirs(tree_path)
 
-        ##############
-        # Load KDTrees
-        ##############
+        #####################
+        # Load spatial index
+        #####################
 
         for i, file_path in enumerate(self.files):
 
@@ -740,12 +715,12 @@ class S3DISDataset(PointCloudDataset):
             cloud_name = self.cloud_names[i]
 
             # Name of the input files
-            KDTree_file = join(tree_path, '{:s}_KDTree.pkl'.format(cloud_name))
+            index_file = join(tree_path, '{:s}_index.bin'.format(cloud_name))
             sub_ply_file = join(tree_path, '{:s}.ply'.format(cloud_name))
 
             # Check if inputs have already been computed
-            if exists(KDTree_file):
-                print('\nFound KDTree for cloud {:s}, subsampled at {:.3f}'.format(cloud_name, dl))
+            if exists(index_file):
+                print('\nFound spatial index for cloud {:s}, subsampled at {:.3f}'.format(cloud_name, dl))
 
                 # read ply with data
                 data = read_ply(sub_ply_file)
@@ -753,45 +728,75 @@ class S3DISDataset(PointCloudDataset):
                     sub_colors = np.vstack((data['red'], data['green'], data['blue'])).T
                 sub_labels = data['class']
 
-                # Read pkl with search tree
-                with open(KDTree_file, 'rb') as f:
-                    search_tree = pickle.load(f)
+                # Open the spatial index (memory-mapped)
+                search_tree = CellIndex.load(index_file)
 
             else:
-                print('\nPreparing KDTree for cloud {:s}, subsampled at {:.3f}'.format(cloud_name, dl))
+                print('\nPreparing spatial index for cloud {:s}, subsampled at {:.3f}'.format(cloud_name, dl))
 
-                # Read ply file
-                data = read_ply(file_path)
-                points = np.vstack((data['x'], data['y'], data['z'])).T
-                if len(data.dtype) > 4:
-                    colors = np.vstack((data['red'], data['green'], data['blue'])).T
-                labels = data['class']
+                # The validation and test clouds also need the subsampled point of each original point, for reprojection
+                need_proj = self.set in ['validation', 'test']
+
+                if self.config.subsampling_chunk_size > 0:
+
+                    # Subsample the memory-mapped cloud chunk by chunk
+                    chunk_size = self.config.subsampling_chunk_size
+                    data = read_ply(file_path, mmap=True)
+
+                    def read_chunk(i0, i1):
+                        points = np.vstack((data['x'][i0:i1], data['y'][i0:i1], data['z'][i0:i1])).T
+                        colors = None
+                        if len(data.dtype) > 4:
+                            colors = np.vstack((data['red'][i0:i1], data['green'][i0:i1], data['blue'][i0:i1])).T
+                        return points, colors, data['class'][i0:i1]
+
+                    sub_outputs = chunked_grid_subsampling(read_chunk,
+                                                           data.shape[0],
+                                                           sampleDl=dl,
+                                                           chunk_size=chunk_size,
+                                                           return_inverse=need_proj,
+                                                           morton_order=self.config.morton_order)
+
+                else:
+
+                    # Read ply file
+                    data = read_ply(file_path)
+                    points = np.vstack((data['x'], data['y'], data['z'])).T
+                    if len(data.dtype) > 4:
+                        colors = np.vstack((data['red'], data['green'], data['blue'])).T
+                    labels = data['class']
+
+                    # Subsample cloud
+                    sub_outputs = grid_subsampling(points,
+                                                   features=colors if len(data.dtype) > 4 else None,
+                                                   labels=labels,
+                                                   sampleDl=dl,
+                                                   engine=self.config.subsampling_engine,
+                                                   return_inverse=need_proj,
+                                                   morton_order=self.config.morton_order)
 
-                # Subsample cloud
                 if len(data.dtype) > 4:
-                    sub_points, sub_colors, sub_labels = grid_subsampling(points,
-                                                                          features=colors,
-                                                                          labels=labels,
-                                                                          sampleDl=dl)
+                    sub_points, sub_colors, sub_labels = sub_outputs[:3]
                     # Rescale float color
                     sub_colors = sub_colors / 255
                 else:
-                    sub_points, sub_labels = grid_subsampling(points,
-                                                              features=None,
-                                                              labels=labels,
-                                                              sampleDl=dl)
+                    sub_points, sub_labels = sub_outputs[:2]
+
+                # Save the reprojection indices, which are directly given by the voxel of each original point
+                if need_proj:
+                    proj_file = join(tree_path, '{:s}_proj.pkl'.format(cloud_name))
+                    proj_inds = sub_outputs[-2]
+                    with open(proj_file, 'wb') as f:
+                        pickle.dump([proj_inds, np.array(data['class'])], f)
 
                 # squeeze label
                 sub_labels = np.squeeze(sub_labels)
 
                 # Get chosen neighborhoods
-                search_tree = KDTree(sub_points, leaf_size=10)
-                # search_tree = nnfln.KDTree(n_neighbors=1, metric='L2', leaf_size=10)
-                # search_tree.fit(sub_points)
+                search_tree = CellIndex(sub_points)
 
-                # Save KDTree
-                with open(KDTree_file, 'wb') as f:
-                    pickle.dump(search_tree, f)
+                # Save spatial index
+                search_tree.save(index_file)
 
                 # Save ply
                 if len(data.dtype) > 4:
@@ -831,25 +836,25 @@ class S3DISDataset(PointCloudDataset):
                 cloud_name = self.cloud_names[i]
 
                 # Name of the input files
-                coarse_KDTree_file = join(tree_path, '{:s}_coarse_KDTree.pkl'.format(cloud_name))
+                coarse_index_file = join(tree_path, '{:s}_coarse_index.bin'.format(cloud_name))
 
                 # Check if inputs have already been computed
-                if exists(coarse_KDTree_file):
-                    # Read pkl with search tree
-                    with open(coarse_KDTree_file, 'rb') as f:
-                        search_tree = pickle.load(f)
+                if exists(coarse_index_file):
+                    # Open the spatial index (memory-mapped)
+                    search_tree = CellIndex.load(coarse_index_file)
 
                 else:
                     # Subsample cloud
                     sub_points = np.array(self.input_trees[cloud_ind].data, copy=False)
-                    coarse_points = grid_subsampling(sub_points.astype(np.float32), sampleDl=pot_dl)
+                    coarse_points = grid_subsampling(sub_points.astype(np.float32),
+                                                     sampleDl=pot_dl,
+                                                     engine=self.config.subsampling_engine)
 
                     # Get chosen neighborhoods
-                    search_tree = KDTree(coarse_points, leaf_size=10)
+                    search_tree = CellIndex(coarse_points)
 
-                    # Save KDTree
-                    with open(coarse_KDTree_file, 'wb') as f:
-                        pickle.dump(search_tree, f)
+                    # Save spatial index
+                    search_tree.save(coarse_index_file)
 
                 # Fill data containers
                 self.pot_trees += [search_tree]
@@ -1009,6 +1014,10 @@ class S3DISSampler(Sampler):
             # Update epoch inds
             self.dataset.epoch_inds += torch.from_numpy(all_epoch_inds)
 
+        # Start choosing the sphere centers (the workers exist once the first batch is asked)
+        if self.dataset.use_potentials:
+            self.dataset.scheduler.start()
+
         # Generator loop
         for i in range(self.N):
             yield i
@@ -1103,6 +1112,7 @@ class S3DISSampler(Sampler):
                                average batch size (number of stacked pointclouds) is the one asked.
         Neighbors calibration: Set the "neighborhood_limits" (the maximum number of neighbors allowed in convolutions)
                                so that 90% of the neighborhoods remain untouched. There is a limit for each layer.
+                               Skipped in the knn neighborhood mode.
         """
 
         ##############################
@@ -1153,6 +1163,9 @@ class S3DISSampler(Sampler):
         # Neighbors limit
         # ***************
 
+        # The knn neighborhoods have a fixed size and do not need limits
+        calib_neighbors = self.dataset.config.neighborhood_mode != 'knn'
+
         # Load neighb_limits dictionary
         neighb_lim_file = join(self.dataset.path, 'neighbors_limits.pkl')
         if exists(neighb_lim_file):
@@ -1175,12 +1188,14 @@ class S3DISSampler(Sampler):
             if key in neighb_lim_dict:
                 neighb_limits += [neighb_lim_dict[key]]
 
-        if not redo and len(neighb_limits) == self.dataset.config.num_layers:
+        if not calib_neighbors:
+            self.dataset.neighborhood_limits = []
+        elif not redo and len(neighb_limits) == self.dataset.config.num_layers:
             self.dataset.neighborhood_limits = neighb_limits
         else:
             redo = True
 
-        if verbose:
+        if verbose and calib_neighbors:
             print('Check neighbors limit dictionary')
             for layer_ind in range(self.dataset.config.num_layers):
                 dl = self.dataset.config.first_subsampling_dl * (2 ** layer_ind)
@@ -1257,10 +1272,10 @@ class S3DISSampler(Sampler):
                 for batch_i, batch in enumerate(dataloader):
 
                     # Update neighborhood histogram
-                    counts = [np.sum(neighb_mat.numpy() < neighb_mat.shape[0], axis=1) for neighb_mat in
-                              batch.neighbors]
-                    hists = [np.bincount(c, minlength=hist_n)[:hist_n] for c in counts]
-                    neighb_hists += np.vstack(hists)
+                    if calib_neighbors:
+                        counts = [neighbors_counts(neighb_mat) for neighb_mat in batch.neighbors]
+                        hists = [np.bincount(c, minlength=hist_n)[:hist_n] for c in counts]
+                        neighb_hists += np.vstack(hists)
 
                     # batch length
                     b = len(batch.cloud_inds)
@@ -1340,39 +1355,41 @@ class S3DISSampler(Sampler):
 
                 a = 1 / 0
 
-            # Use collected neighbor histogram to get neighbors limit
-            cumsum = np.cumsum(neighb_hists.T, axis=0)
-            percentiles = np.sum(cumsum < (untouched_ratio * cumsum[hist_n - 1, :]), axis=0)
-            self.dataset.neighborhood_limits = percentiles
-
-            if verbose:
-
-                # Crop histogram
-                while np.sum(neighb_hists[:, -1]) == 0:
-                    neighb_hists = neighb_hists[:, :-1]
-                hist_n = neighb_hists.shape[1]
-
-                print('\n**************************************************\n')
-                line0 = 'neighbors_num '
-                for layer in range(neighb_hists.shape[0]):
-                    line0 += '|  layer {:2d}  '.format(layer)
-                print(line0)
-                for neighb_size in range(hist_n):
-                    line0 = '     {:4d}     '.format(neighb_size)
-                    for layer in range(neighb_hists.shape[0]):
-                        if neighb_size > percentiles[layer]:
-                            color = bcolors.FAIL
-                        else:
-                            color = bcolors.OKGREEN
-                        line0 += '|{:}{:10d}{:}  '.format(color,
-                                                          neighb_hists[layer, neighb_size],
-                                                          bcolors.ENDC)
+            if calib_neighbors:
 
-                    print(line0)
+                # Use collected neighbor histogram to get neighbors limit
+                cumsum = np.cumsum(neighb_hists.T, axis=0)
+                percentiles = np.sum(cumsum < (untouched_ratio * cumsum[hist_n - 1, :]), axis=0)
+                self.dataset.neighborhood_limits = percentiles
 
-                print('\n**************************************************\n')
-                print('\nchosen neighbors limits: ', percentiles)
-                print()
+                if verbose:
+
+                    # Crop histogram
+                    while np.sum(neighb_hists[:, -1]) == 0:
+                        neighb_hists = neighb_hists[:, :-1]
+                    hist_n = neighb_hists.shape[1]
+
+                    print('\n**************************************************\n')
+                    line0 = 'neighbors_num '
+                    for layer in range(neighb_hists.shape[0]):
+                        line0 += '|  layer {:2d}  '.format(layer)
+                    print(line0)
+                    for neighb_size in range(hist_n):
+                        line0 = '     {:4d}     '.format(neighb_size)
+                        for layer in range(neighb_hists.shape[0]):
+                            if neighb_size > percentiles[layer]:
+                                color = bcolors.FAIL
+                            else:
+                                color = bcolors.OKGREEN
+                            line0 += '|{:}{:10d}{:}  '.format(color,
+                                                              neighb_hists[layer, neighb_size],
+                                                              bcolors.ENDC)
+
+                        print(line0)
+
+                    print('\n**************************************************\n')
+                    print('\nchosen neighbors limits: ', percentiles)
+                    print()
 
             # Save batch_limit dictionary
             if self.dataset.use_potentials:
@@ -1388,16 +1405,17 @@ class S3DISSampler(Sampler):
                 pickle.dump(batch_lim_dict, file)
 
             # Save neighb_limit dictionary
-            for layer_ind in range(self.dataset.config.num_layers):
-                dl = self.dataset.config.first_subsampling_dl * (2 ** layer_ind)
-                if self.dataset.config.deform_layers[layer_ind]:
-                    r = dl * self.dataset.config.deform_radius
-                else:
-                    r = dl * self.dataset.config.conv_radius
-                key = '{:.3f}_{:.3f}'.format(dl, r)
-                neighb_lim_dict[key] = self.dataset.neighborhood_limits[layer_ind]
-            with open(neighb_lim_file, 'wb') as file:
-                pickle.dump(neighb_lim_dict, file)
+            if calib_neighbors:
+                for layer_ind in range(self.dataset.config.num_layers):
+                    dl = self.dataset.config.first_subsampling_dl * (2 ** layer_ind)
+                    if self.dataset.config.deform_layers[layer_ind]:
+                        r = dl * self.dataset.config.deform_radius
+                    else:
+                        r = dl * self.dataset.config.conv_radius
+                    key = '{:.3f}_{:.3f}'.format(dl, r)
+                    neighb_lim_dict[key] = self.dataset.neighborhood_limits[layer_ind]
+                with open(neighb_lim_file, 'wb') as file:
+                    pickle.dump(neighb_lim_dict, file)
 
         print('Calibration done in {:.1f}s\n'.format(time.time() - t0))
         return
@@ -1416,15 +1434,15 @@ class S3DISCustomBatch:
 
         # Extract input tensors from the list of numpy array
         ind = 0
-        self.points = [torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]]
+        self.points = [torch.as_tensor(nparray) for nparray in input_list[ind:ind + L]]
         ind += L
-        self.neighbors = [torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]]
+        self.neighbors = [apply_to_neighbors(nparray, torch.as_tensor) for nparray in input_list[ind:ind + L]]
         ind += L
-        self.pools = [torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]]
+        self.pools = [apply_to_neighbors(nparray, torch.as_tensor) for nparray in input_list[ind:ind + L]]
         ind += L
-        self.upsamples = [torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]]
+        self.upsamples = [torch.as_tensor(nparray) for nparray in input_list[ind:ind + L]]
         ind += L
-        self.lengths = [torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]]
+        self.lengths = [torch.as_tensor(nparray) for nparray in input_list[ind:ind + L]]
         ind += L
         self.features = torch.from_numpy(input_list[ind])
         ind += 1
@@ -1447,11 +1465,11 @@ class S3DISCustomBatch:
         Manual pinning of the memory
         """
 
-        self.points = [in_tensor.pin_memory() for in_tensor in self.points]
-        self.neighbors = [in_tensor.pin_memory() for in_tensor in self.neighbors]
-        self.pools = [in_tensor.pin_memory() for in_tensor in self.pools]
-        self.upsamples = [in_tensor.pin_memory() for in_tensor in self.upsamples]
-        self.lengths = [in_tensor.pin_memory() for in_tensor in self.lengths]
+        self.points = [pin_tensor(in_tensor) for in_tensor in self.points]
+        self.neighbors = [apply_to_neighbors(in_tensor, pin_tensor) for in_tensor in self.neighbors]
+        self.pools = [apply_to_neighbors(in_tensor, pin_tensor) for in_tensor in self.pools]
+        self.upsamples = [pin_tensor(in_tensor) for in_tensor in self.upsamples]
+        self.lengths = [pin_tensor(in_tensor) for in_tensor in self.lengths]
         self.features = self.features.pin_memory()
         self.labels = self.labels.pin_memory()
         self.scales = self.scales.pin_memory()
@@ -1465,8 +1483,8 @@ class S3DISCustomBatch:
     def to(self, device):
 
         self.points = [in_tensor.to(device) for in_tensor in self.points]
-        self.neighbors = [in_tensor.to(device) for in_tensor in self.neighbors]
-        self.pools = [in_tensor.to(device) for in_tensor in self.pools]
+        self.neighbors = [apply_to_neighbors(in_tensor, lambda t: t.to(device)) for in_tensor in self.neighbors]
+        self.pools = [apply_to_neighbors(in_tensor, lambda t: t.to(device)) for in_tensor in self.pools]
         self.upsamples = [in_tensor.to(device) for in_tensor in self.upsamples]
         self.lengths = [in_tensor.to(device) for in_tensor in self.lengths]
         self.features = self.features.to(device)
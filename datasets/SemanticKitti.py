@@ -41,7 +41,7 @@ from torch.utils.data import Sampler, get_worker_info
 from utils.mayavi_visu import *
 from utils.metrics import fast_confusion
 
-from datasets.common import grid_subsampling
+from datasets.common import grid_subsampling, apply_to_neighbors, neighbors_counts, pin_tensor
 from utils.config import bcolors
 
 
@@ -976,6 +976,7 @@ class SemanticKittiSampler(Sampler):
                                average batch size (number of stacked pointclouds) is the one asked.
         Neighbors calibration: Set the "neighborhood_limits" (the maximum number of neighbors allowed in convolutions)
                                so that 90% of the neighborhoods remain untouched. There is a limit for each layer.
+                               Skipped in the knn neighborhood mode.
         """
 
         ##############################
@@ -1027,6 +1028,9 @@ class SemanticKittiSampler(Sampler):
         # Neighbors limit
         # ***************
 
+        # The knn neighborhoods have a fixed size and do not need limits
+        calib_neighbors = self.dataset.config.neighborhood_mode != 'knn'
+
         # Load neighb_limits dictionary
         neighb_lim_file = join(self.dataset.path, 'neighbors_limits.pkl')
         if exists(neighb_lim_file):
@@ -1049,12 +1053,14 @@ class SemanticKittiSampler(Sampler):
             if key in neighb_lim_dict:
                 neighb_limits += [neighb_lim_dict[key]]
 
-        if not redo and len(neighb_limits) == self.dataset.config.num_layers:
+        if not calib_neighbors:
+            self.dataset.neighborhood_limits = []
+        elif not redo and len(neighb_limits) == self.dataset.config.num_layers:
             self.dataset.neighborhood_limits = neighb_limits
         else:
             redo = True
 
-        if verbose:
+        if verbose and calib_neighbors:
             print('Check neighbors limit dictionary')
             for layer_ind in range(self.dataset.config.num_layers):
                 dl = self.dataset.config.first_subsampling_dl * (2**layer_ind)
@@ -1125,9 +1131,10 @@ class SemanticKittiSampler(Sampler):
                     all_n += int(batch.lengths[0].shape[0])
 
                     # Update neighborhood histogram
-                    counts = [np.sum(neighb_mat.numpy() < neighb_mat.shape[0], axis=1) for neighb_mat in batch.neighbors]
-                    hists = [np.bincount(c, minlength=hist_n)[:hist_n] for c in counts]
-                    neighb_hists += np.vstack(hists)
+                    if calib_neighbors:
+                        counts = [neighbors_counts(neighb_mat) for neighb_mat in batch.neighbors]
+                        hists = [np.bincount(c, minlength=hist_n)[:hist_n] for c in counts]
+                        neighb_hists += np.vstack(hists)
 
                     # batch length
                     b = len(batch.frame_inds)
@@ -1170,39 +1177,41 @@ class SemanticKittiSampler(Sampler):
                 if breaking:
                     break
 
-            # Use collected neighbor histogram to get neighbors limit
-            cumsum = np.cumsum(neighb_hists.T, axis=0)
-            percentiles = np.sum(cumsum < (untouched_ratio * cumsum[hist_n - 1, :]), axis=0)
-            self.dataset.neighborhood_limits = percentiles
+            if calib_neighbors:
 
-            if verbose:
+                # Use collected neighbor histogram to get neighbors limit
+                cumsum = np.cumsum(neighb_hists.T, axis=0)
+                percentiles = np.sum(cumsum < (untouched_ratio * cumsum[hist_n - 1, :]), axis=0)
+                self.dataset.neighborhood_limits = percentiles
 
-                # Crop histogram
-                while np.sum(neighb_hists[:, -1]) == 0:
-                    neighb_hists = neighb_hists[:, :-1]
-                hist_n = neighb_hists.shape[1]
-
-                print('\n**************************************************\n')
-                line0 = 'neighbors_num '
-                for layer in range(neighb_hists.shape[0]):
-                    line0 += '|  layer {:2d}  '.format(layer)
-                print(line0)
-                for neighb_size in range(hist_n):
-                    line0 = '     {:4d}     '.format(neighb_size)
-                    for layer in range(neighb_hists.shape[0]):
-                        if neighb_size > percentiles[layer]:
-                            color = bcolors.FAIL
-                        else:
-                            color = bcolors.OKGREEN
-                        line0 += '|{:}{:10d}{:}  '.format(color,
-                                                         neighb_hists[layer, neighb_size],
-                                                         bcolors.ENDC)
+                if verbose:
 
-                    print(line0)
+                    # Crop histogram
+                    while np.sum(neighb_hists[:, -1]) == 0:
+                        neighb_hists = neighb_hists[:, :-1]
+                    hist_n = neighb_hists.shape[1]
 
-                print('\n**************************************************\n')
-                print('\nchosen neighbors limits: ', percentiles)
-                print()
+                    print('\n**************************************************\n')
+                    line0 = 'neighbors_num '
+                    for layer in range(neighb_hists.shape[0]):
+                        line0 += '|  layer {:2d}  '.format(layer)
+                    print(line0)
+                    for neighb_size in range(hist_n):
+                        line0 = '     {:4d}     '.format(neighb_size)
+                        for layer in range(neighb_hists.shape[0]):
+                            if neighb_size > percentiles[layer]:
+                                color = bcolors.FAIL
+                            else:
+                                color = bcolors.OKGREEN
+                            line0 += '|{:}{:10d}{:}  '.format(color,
+                                                             neighb_hists[layer, neighb_size],
+                                                             bcolors.ENDC)
+
+                        print(line0)
+
+                    print('\n**************************************************\n')
+                    print('\nchosen neighbors limits: ', percentiles)
+                    print()
 
             # Control max_in_points value
             print('\n**************************************************\n')
@@ -1228,16 +1237,17 @@ class SemanticKittiSampler(Sampler):
                 pickle.dump(batch_lim_dict, file)
 
             # Save neighb_limit dictionary
-            for layer_ind in range(self.dataset.config.num_layers):
-                dl = self.dataset.config.first_subsampling_dl * (2 ** layer_ind)
-                if self.dataset.config.deform_layers[layer_ind]:
-                    r = dl * self.dataset.config.deform_radius
-                else:
-                    r = dl * self.dataset.config.conv_radius
-                key = '{:s}_{:d}_{:.3f}_{:.3f}'.format(sampler_method, self.dataset.max_in_p, dl, r)
-                neighb_lim_dict[key] = self.dataset.neighborhood_limits[layer_ind]
-            with open(neighb_lim_file, 'wb') as file:
-                pickle.dump(neighb_lim_dict, file)
+            if calib_neighbors:
+                for layer_ind in range(self.dataset.config.num_layers):
+                    dl = self.dataset.config.first_subsampling_dl * (2 ** layer_ind)
+                    if self.dataset.config.deform_layers[layer_ind]:
+                        r = dl * self.dataset.config.deform_radius
+                    else:
+                        r = dl * self.dataset.config.conv_radius
+                    key = '{:s}_{:d}_{:.3f}_{:.3f}'.format(sampler_method, self.dataset.max_in_p, dl, r)
+                    neighb_lim_dict[key] = self.dataset.neighborhood_limits[layer_ind]
+                with open(neighb_lim_file, 'wb') as file:
+                    pickle.dump(neighb_lim_dict, file)
 
 
         print('Calibration done in {:.1f}s\n'.format(time.time() - t0))
@@ -1257,15 +1267,15 @@ class SemanticKittiCustomBatch:
 
         # Extract input tensors from the list of numpy array
         ind = 1
-        self.points = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.points = [torch.as_tensor(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.neighbors = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.neighbors = [apply_to_neighbors(nparray, torch.as_tensor) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.pools = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.pools = [apply_to_neighbors(nparray, torch.as_tensor) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.upsamples = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.upsamples = [torch.as_tensor(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.lengths = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.lengths = [torch.as_tensor(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
         self.features = torch.from_numpy(input_list[ind])
         ind += 1
@@ -1292,11 +1302,11 @@ class SemanticKittiCustomBatch:
         Manual pinning of the memory
         """
 
-        self.points = [in_tensor.pin_memory() for in_tensor in self.points]
-        self.neighbors = [in_tensor.pin_memory() for in_tensor in self.neighbors]
-        self.pools = [in_tensor.pin_memory() for in_tensor in self.pools]
-        self.upsamples = [in_tensor.pin_memory() for in_tensor in self.upsamples]
-        self.lengths = [in_tensor.pin_memory() for in_tensor in self.lengths]
+        self.points = [pin_tensor(in_tensor) for in_tensor in self.points]
+        self.neighbors = [apply_to_neighbors(in_tensor, pin_tensor) for in_tensor in self.neighbors]
+        self.pools = [apply_to_neighbors(in_tensor, pin_tensor) for in_tensor in self.pools]
+        self.upsamples = [pin_tensor(in_tensor) for in_tensor in self.upsamples]
+        self.lengths = [pin_tensor(in_tensor) for in_tensor in self.lengths]
         self.features = self.features.pin_memory()
         self.labels = self.labels.pin_memory()
         self.scales = self.scales.pin_memory()
@@ -1309,8 +1319,8 @@ class SemanticKittiCustomBatch:
     def to(self, device):
 
         self.points = [in_tensor.to(device) for in_tensor in self.points]
-        self.neighbors = [in_tensor.to(device) for in_tensor in self.neighbors]
-        self.pools = [in_tensor.to(device) for in_tensor in self.pools]
+        self.neighbors = [apply_to_neighbors(in_tensor, lambda t: t.to(device)) for in_tensor in self.neighbors]
+        self.pools = [apply_to_neighbors(in_tensor, lambda t: t.to(device)) for in_tensor in self.pools]
         self.upsamples = [in_tensor.to(device) for in_tensor in self.upsamples]
         self.lengths = [in_tensor.to(device) for in_tensor in self.lengths]
         self.features = self.features.to(device)
@@ -23,17 +23,31 @@
 # Common libs
 import time
 import os
+import atexit
+import hashlib
 import numpy as np
+from functools import partial
 import sys
+import threading
+import multiprocessing
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, get_worker_info
 from utils.config import Config
 from utils.mayavi_visu import *
 from kernels.kernel_points import create_3D_rotations
 
-# Subsampling extension
-import cpp_wrappers.cpp_subsampling.grid_subsampling as cpp_subsampling
-import cpp_wrappers.cpp_neighbors.radius_neighbors as cpp_neighbors
+# Point operations extension (built once by compile_wrappers.sh), or its slower NumPy version if it is not built
+try:
+    from cpp_wrappers.cpp_pointops.pointops import subsampling as cpp_subsampling
+    from cpp_wrappers.cpp_pointops.pointops import neighbors as cpp_neighbors
+    from cpp_wrappers.cpp_pointops.pointops import pyramid as cpp_pyramid
+except ImportError:
+    print('Warning: the pointops extension is not built (see INSTALL.md), using its slower NumPy version')
+    import cpp_wrappers.cpp_pointops.numpy_pointops as cpp_subsampling
+    cpp_neighbors = cpp_pyramid = cpp_subsampling
+
+# Torch version of the input pyramid, computed on any device
+import cpp_wrappers.cpp_pointops.torch_pointops as torch_pointops
 
 # ----------------------------------------------------------------------------------------------------------------------
 #
@@ -41,7 +55,8 @@ import cpp_wrappers.cpp_neighbors.radius_neighbors as cpp_neighbors
 #       \***********************/
 #
 
-def grid_subsampling(points, features=None, labels=None, sampleDl=0.1, verbose=0):
+def grid_subsampling(points, features=None, labels=None, sampleDl=0.1, verbose=0, engine='hash', return_inverse=False,
+                     morton_order=False):
     """
     CPP wrapper for a grid subsampling (method = barycenter for points and features)
     :param points: (N, 3) matrix of input points
@@ -49,33 +64,167 @@ def grid_subsampling(points, features=None, labels=None, sampleDl=0.1, verbose=0
     :param labels: optional (N,) matrix of integer labels
     :param sampleDl: parameter defining the size of grid voxels
     :param verbose: 1 to display
-    :return: subsampled points, with features and/or labels depending of the input
+    :param engine: 'hash' or 'sort' (radix sorted voxel keys, faster on large clouds, voxels returned in key order)
+    :param return_inverse: also return the index of the subsampled point of each input point (N,) and the number of
+                           input points of each subsampled point
+    :param morton_order: sort the subsampled points along a Morton curve (see points_morton_order)
+    :return: subsampled points, with features and/or labels depending of the input, then the inverse indices and counts
     """
 
     if (features is None) and (labels is None):
-        return cpp_subsampling.subsample(points,
-                                         sampleDl=sampleDl,
-                                         verbose=verbose)
+        results = cpp_subsampling.subsample(points,
+                                            sampleDl=sampleDl,
+                                            verbose=verbose,
+                                            engine=engine,
+                                            return_inverse=return_inverse)
     elif (labels is None):
-        return cpp_subsampling.subsample(points,
-                                         features=features,
-                                         sampleDl=sampleDl,
-                                         verbose=verbose)
+        results = cpp_subsampling.subsample(points,
+                                            features=features,
+                                            sampleDl=sampleDl,
+                                            verbose=verbose,
+                                            engine=engine,
+                                            return_inverse=return_inverse)
     elif (features is None):
-        return cpp_subsampling.subsample(points,
-                                         classes=labels,
-                                         sampleDl=sampleDl,
-                                         verbose=verbose)
+        results = cpp_subsampling.subsample(points,
+                                            classes=labels,
+                                            sampleDl=sampleDl,
+                                            verbose=verbose,
+                                            engine=engine,
+                                            return_inverse=return_inverse)
     else:
-        return cpp_subsampling.subsample(points,
-                                         features=features,
-                                         classes=labels,
-                                         sampleDl=sampleDl,
-                                         verbose=verbose)
+        results = cpp_subsampling.subsample(points,
+                                            features=features,
+                                            classes=labels,
+                                            sampleDl=sampleDl,
+                                            verbose=verbose,
+                                            engine=engine,
+                                            return_inverse=return_inverse)
+
+    if morton_order:
+        results = reorder_subsampling(results, sampleDl, return_inverse)
+    return results
+
+
+def chunked_grid_subsampling(read_chunk, n_points, sampleDl=0.1, chunk_size=10000000, verbose=0,
+                             return_inverse=False, morton_order=False):
+    """
+    CPP wrapper for a grid subsampling of a cloud read chunk by chunk (for example from a memory-mapped file), so that
+    only the voxels and one chunk are in memory. Same result as grid_subsampling on the whole cloud (hash engine).
+    :param read_chunk: function(i0, i1) returning the points, features (or None) and labels (or None) of the points
+                       i0 to i1, called twice for each chunk (for the limits of the cloud, then for the voxels)
+    :param n_points: number of points in the cloud
+    :param sampleDl: parameter defining the size of grid voxels
+    :param chunk_size: number of points read at once
+    :param verbose: 1 to display
+    :param return_inverse: also return the index of the subsampled point of each input point (N,) and the number of
+                           input points of each subsampled point (the chunks are read a third time)
+    :param morton_order: sort the subsampled points along a Morton curve (see points_morton_order)
+    :return: subsampled points, with features and/or labels depending of the input, then the inverse indices and counts
+    """
+
+    chunks = [(i0, min(i0 + chunk_size, n_points)) for i0 in range(0, n_points, chunk_size)]
+
+    # Limits of the cloud, which define the grid
+    min_corner = np.full(3, np.inf, dtype=np.float32)
+    max_corner = np.full(3, -np.inf, dtype=np.float32)
+    fdim, ldim = 0, 0
+    for i0, i1 in chunks:
+        points, features, labels = read_chunk(i0, i1)
+        min_corner = np.minimum(min_corner, np.min(points, axis=0))
+        max_corner = np.maximum(max_corner, np.max(points, axis=0))
+        if features is not None:
+            fdim = features.shape[1]
+        if labels is not None:
+            ldim = 1 if labels.ndim == 1 else labels.shape[1]
+
+    # Accumulate the voxels chunk by chunk
+    grid = cpp_subsampling.GridSubsampler(min_corner, max_corner, sampleDl=sampleDl, fdim=fdim, ldim=ldim)
+    for c, (i0, i1) in enumerate(chunks):
+        points, features, labels = read_chunk(i0, i1)
+        grid.add(points, features=features, classes=labels)
+        if verbose:
+            print('\rSubsampled chunks : {:d}/{:d}'.format(c + 1, len(chunks)), end='', flush=True)
+    if verbose:
+        print()
+
+    results = grid.result()
+    if return_inverse:
+
+        # Voxel of each point
+        inverse = np.zeros((n_points,), dtype=np.int32)
+        for i0, i1 in chunks:
+            points, _, _ = read_chunk(i0, i1)
+            inverse[i0:i1] = grid.voxel_indices(points)
+
+        if not isinstance(results, tuple):
+            results = (results,)
+        results += (inverse, grid.voxel_counts())
+
+    if morton_order:
+        results = reorder_subsampling(results, sampleDl, return_inverse)
+    return results
+
+
+def points_morton_order(points, sampleDl=0.1):
+    """
+    CPP wrapper for the order of points along a Morton (Z-order) curve. Clouds stored in this order have nearby points
+    close in memory, which makes the gathers of their neighbors (in the neighbor searches and the convolutions) cache
+    friendly.
+    :param points: (N, 3) matrix of points
+    :param sampleDl: size of the cells of the curve (points of the same cell keep their order)
+    :return: (N,) int32 permutation sorting the points along the curve
+    """
+
+    return cpp_subsampling.morton_order(points, sampleDl=sampleDl)
+
+
+def reorder_subsampling(results, sampleDl=0.1, return_inverse=False):
+    """
+    Sorts the outputs of grid_subsampling along a Morton curve of the subsampled points
+    :param results: subsampled points, or tuple of subsampled points, features and/or labels, inverse indices and counts
+    :param sampleDl: size of the cells of the curve
+    :param return_inverse: the results end with inverse indices, which are renumbered, and counts
+    :return: the results in the same format
+    """
+
+    if not isinstance(results, tuple):
+        return results[points_morton_order(results, sampleDl)]
+
+    order = points_morton_order(results[0], sampleDl)
+    if not return_inverse:
+        return tuple(r[order] for r in results)
+
+    # New index of each subsampled point, for the inverse indices
+    new_inds = np.empty_like(order)
+    new_inds[order] = np.arange(order.shape[0], dtype=order.dtype)
+    return tuple(r[order] for r in results[:-2]) + (new_inds[results[-2]], results[-1][order])
+
+
+def batch_random_rotations(B):
+    """
+    Random 3D rotation matrices, used to randomly orient the subsampling grid of each batch element
+    :param B: number of batch elements
+    :return: (B, 3, 3) float32 rotation matrices
+    """
+
+    # Choose two random angles for the first vector in polar coordinates
+    theta = np.random.rand(B) * 2 * np.pi
+    phi = (np.random.rand(B) - 0.5) * np.pi
+
+    # Create the first vector in carthesian coordinates
+    u = np.vstack([np.cos(theta) * np.cos(phi), np.sin(theta) * np.cos(phi), np.sin(phi)])
+
+    # Choose a random rotation angle
+    alpha = np.random.rand(B) * 2 * np.pi
+
+    # Create the rotation matrix with this vector and angle
+    R = create_3D_rotations(u.T, alpha).astype(np.float32)
+
+    return R
 
 
 def batch_grid_subsampling(points, batches_len, features=None, labels=None,
-                           sampleDl=0.1, max_p=0, verbose=0, random_grid_orient=True):
+                           sampleDl=0.1, max_p=0, verbose=0, random_grid_orient=True, n_threads=1):
     """
     CPP wrapper for a grid subsampling (method = barycenter for points and features)
     :param points: (N, 3) matrix of input points
@@ -83,117 +232,767 @@ def batch_grid_subsampling(points, batches_len, features=None, labels=None,
     :param labels: optional (N,) matrix of integer labels
     :param sampleDl: parameter defining the size of grid voxels
     :param verbose: 1 to display
+    :param random_grid_orient: orient the grid of each batch element randomly (the rotations are applied in C++)
+    :param n_threads: number of threads subsampling the batch elements concurrently (< 1 means all cores)
     :return: subsampled points, with features and/or labels depending of the input
     """
 
-    R = None
-    B = len(batches_len)
-    if random_grid_orient:
+    # Random rotation matrix for each batch element
+    R = batch_random_rotations(len(batches_len)) if random_grid_orient else None
+
+    return cpp_subsampling.subsample_batch(points,
+                                           batches_len,
+                                           features=features,
+                                           classes=labels,
+                                           sampleDl=sampleDl,
+                                           max_p=max_p,
+                                           verbose=verbose,
+                                           rotations=R,
+                                           n_threads=n_threads)
 
-        ########################################################
-        # Create a random rotation matrix for each batch element
-        ########################################################
 
-        # Choose two random angles for the first vector in polar coordinates
-        theta = np.random.rand(B) * 2 * np.pi
-        phi = (np.random.rand(B) - 0.5) * np.pi
+def batch_pyramid_subsampling(points, batches_len, sampleDl=0.1, n_levels=1, random_grid_orient=True, n_threads=1):
+    """
+    CPP wrapper for a nested grid subsampling at several resolutions, computed in a single pass over the points
+    :param points: (N, 3) matrix of input points
+    :param batches_len: (B) the list of lengths of batch elements
+    :param sampleDl: size of the grid voxels of the first level (doubled at each level)
+    :param n_levels: number of levels
+    :param random_grid_orient: orient the grids of each batch element randomly (the same orientation for all levels)
+    :param n_threads: number of threads subsampling the batch elements concurrently (< 1 means all cores)
+    :return: lists of subsampled points and batch lengths of each level (barycenters of the input points of its voxels)
+    """
 
-        # Create the first vector in carthesian coordinates
-        u = np.vstack([np.cos(theta) * np.cos(phi), np.sin(theta) * np.cos(phi), np.sin(phi)])
+    # Random rotation matrix for each batch element
+    R = batch_random_rotations(len(batches_len)) if random_grid_orient else None
 
-        # Choose a random rotation angle
-        alpha = np.random.rand(B) * 2 * np.pi
+    return cpp_subsampling.subsample_pyramid(points,
+                                             batches_len,
+                                             dl0=sampleDl,
+                                             n_levels=n_levels,
+                                             rotations=R,
+                                             n_threads=n_threads)
 
-        # Create the rotation matrix with this vector and angle
-        R = create_3D_rotations(u.T, alpha).astype(np.float32)
 
-        #################
-        # Apply rotations
-        #################
+def batch_neighbors(queries, supports, q_batches, s_batches, radius, max_neighbors=0, n_threads=1, csr=False,
+                    dtype=np.int32):
+    """
+    Computes neighbors for a batch of queries and supports
+    :param queries: (N1, 3) the query points
+    :param supports: (N2, 3) the support points
+    :param q_batches: (B) the list of lengths of batch elements in queries
+    :param s_batches: (B)the list of lengths of batch elements in supports
+    :param radius: float32
+    :param max_neighbors: only keep the closest neighbors up to this number (0 means no limit)
+    :param n_threads: number of threads searching the batch elements concurrently (< 1 means all cores)
+    :param csr: return the ragged neighbors (offsets, indices) instead of a matrix padded with the shadow index N2
+    :param dtype: np.int32 or np.int64, type of the returned indices
+    :return: neighbors indices
+    """
 
-        i0 = 0
-        points = points.copy()
-        for bi, length in enumerate(batches_len):
-            # Apply the rotation
-            points[i0:i0 + length, :] = np.sum(np.expand_dims(points[i0:i0 + length, :], 2) * R[bi], axis=1)
-            i0 += length
+    return cpp_neighbors.batch_query(queries, supports, q_batches, s_batches,
+                                     radius=radius,
+                                     max_neighbors=max_neighbors,
+                                     n_threads=n_threads,
+                                     csr=csr,
+                                     dtype=dtype)
 
-    #######################
-    # Sunsample and realign
-    #######################
 
-    if (features is None) and (labels is None):
-        s_points, s_len = cpp_subsampling.subsample_batch(points,
-                                                          batches_len,
-                                                          sampleDl=sampleDl,
-                                                          max_p=max_p,
-                                                          verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                s_points[i0:i0 + length, :] = np.sum(np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T, axis=1)
-                i0 += length
-        return s_points, s_len
+def batch_nearest_neighbors(queries, supports, q_batches, s_batches, n_threads=1, dtype=np.int32):
+    """
+    Computes the nearest support point of each query, for a batch of queries and supports
+    :param queries: (N1, 3) the query points
+    :param supports: (N2, 3) the support points
+    :param q_batches: (B) the list of lengths of batch elements in queries
+    :param s_batches: (B)the list of lengths of batch elements in supports
+    :param n_threads: number of threads searching the batch elements concurrently (< 1 means all cores)
+    :param dtype: np.int32 or np.int64, type of the returned indices
+    :return: (N1, 1) nearest neighbor indices
+    """
 
-    elif (labels is None):
-        s_points, s_len, s_features = cpp_subsampling.subsample_batch(points,
-                                                                      batches_len,
-                                                                      features=features,
-                                                                      sampleDl=sampleDl,
-                                                                      max_p=max_p,
-                                                                      verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T, axis=1)
-                i0 += length
-        return s_points, s_len, s_features
+    return cpp_neighbors.batch_nearest(queries, supports, q_batches, s_batches, n_threads=n_threads, dtype=dtype)
 
-    elif (features is None):
-        s_points, s_len, s_labels = cpp_subsampling.subsample_batch(points,
-                                                                    batches_len,
-                                                                    classes=labels,
-                                                                    sampleDl=sampleDl,
-                                                                    max_p=max_p,
-                                                                    verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T, axis=1)
-                i0 += length
-        return s_points, s_len, s_labels
 
-    else:
-        s_points, s_len, s_features, s_labels = cpp_subsampling.subsample_batch(points,
-                                                                              batches_len,
-                                                                              features=features,
-                                                                              classes=labels,
-                                                                              sampleDl=sampleDl,
-                                                                              max_p=max_p,
-                                                                              verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T, axis=1)
-                i0 += length
-        return s_points, s_len, s_features, s_labels
-
-
-def batch_neighbors(queries, supports, q_batches, s_batches, radius):
+def batch_knn_neighbors(queries, supports, q_batches, s_batches, k, n_threads=1, dtype=np.int32):
     """
-    Computes neighbors for a batch of queries and supports
+    Computes the k nearest support points of each query, for a batch of queries and supports
     :param queries: (N1, 3) the query points
     :param supports: (N2, 3) the support points
     :param q_batches: (B) the list of lengths of batch elements in queries
     :param s_batches: (B)the list of lengths of batch elements in supports
-    :param radius: float32
-    :return: neighbors indices
+    :param k: number of neighbors of each query
+    :param n_threads: number of threads searching the batch elements concurrently (< 1 means all cores)
+    :param dtype: np.int32 or np.int64, type of the returned indices
+    :return: (N1, k) neighbors indices, completed with the shadow index N2 when a batch element has less than k points
     """
 
-    return cpp_neighbors.batch_query(queries, supports, q_batches, s_batches, radius=radius)
+    return cpp_neighbors.batch_knn(queries, supports, q_batches, s_batches, k=k, n_threads=n_threads, dtype=dtype)
+
+
+def batch_tree(supports, s_batches, n_threads=1):
+    """
+    Builds the KDTrees of a batch of supports once, so that they can be queried several times. The returned object has
+    the methods radius_query(queries, q_batches, radius, max_neighbors, n_threads, csr, dtype), knn_query(queries,
+    q_batches, k, n_threads, dtype) and nearest(queries, q_batches, n_threads, dtype), equivalent to batch_neighbors
+    and batch_nearest_neighbors.
+    The trees read the supports in place and keep a reference to them, so they must not be modified while in use.
+    :param supports: (N2, 3) the support points
+    :param s_batches: (B)the list of lengths of batch elements in supports
+    :param n_threads: number of threads building the trees concurrently (< 1 means all cores)
+    :return: cpp BatchTree object
+    """
+
+    return cpp_neighbors.BatchTree(supports, s_batches, n_threads=n_threads)
+
+
+def batch_input_pyramid(points, lengths, layers, first_subsampling_dl, conv_radius, deform_radius,
+                        neighbor_limits=None, neighbor_k=None, upsamples=True, random_grid_orient=True, csr=False,
+                        nested_subsampling=False, morton_order=False, n_threads=1, dtype=np.int32, backend='cpp',
+                        device='cpu'):
+    """
+    Builds the inputs of every layer of the network in a single CPP call: the points of each layer are subsampled from
+    the previous one, then the convolution, pooling and upsampling neighbors are computed.
+    :param points: (N, 3) the stacked points of the first layer
+    :param lengths: (B) the list of lengths of batch elements
+    :param layers: (L, 4) flags [conv, deformable conv, pool, deformable pool] of each layer
+    :param first_subsampling_dl: subsampling size of the first layer (doubled at each layer)
+    :param conv_radius: radius of convolutions, in number of grid cells
+    :param deform_radius: radius of deformable convolutions, in number of grid cells
+    :param neighbor_limits: optional (L) max number of neighbors of each layer (0 means no limit)
+    :param neighbor_k: optional (L) number of nearest neighbors of each layer, replacing its radius neighbors when
+                       positive (these layers always have padded matrices, even with csr)
+    :param upsamples: False to skip the upsampling indices
+    :param random_grid_orient: randomly orient the subsampling grid of each batch element
+    :param csr: return the neighbors and pools as ragged (offsets, indices) tuples instead of padded matrices
+    :param nested_subsampling: subsample the points of every layer from the input points in a single pass, on
+                               nested grids (see batch_pyramid_subsampling), instead of from the previous layer
+    :param morton_order: sort the pooled points of each batch element along a Morton curve (see points_morton_order)
+    :param n_threads: number of threads searching the batch elements concurrently (< 1 means all cores)
+    :param dtype: np.int32 or np.int64, type of the neighbors, pools and upsamples indices
+    :param backend: 'cpp' (pointops extension) or 'torch' (torch tensor ops, see torch_pointops)
+    :param device: device of the computations and outputs of the 'torch' backend
+    :return: lists of points, neighbors, pools, upsamples and lengths of each layer (the points of the first layer are
+             the input array itself when it is already float32 and contiguous), as numpy arrays, or as tensors on
+             device with the 'torch' backend
+    """
+
+    rotations = None
+    if random_grid_orient:
+
+        # Same random rotations as successive calls to batch_grid_subsampling, for the layers ending with a pooling
+        rotations = np.tile(np.eye(3, dtype=np.float32), (len(layers), len(lengths), 1, 1))
+        for l in np.where(layers[:, 2])[0]:
+            rotations[l] = batch_random_rotations(len(lengths))
+
+    if backend == 'torch':
+        build_pyramid = partial(torch_pointops.build_pyramid, device=device)
+    elif backend == 'cpp':
+        build_pyramid = cpp_pyramid.build_pyramid
+    else:
+        raise ValueError('Unknown pyramid backend: ' + backend)
+
+    return build_pyramid(points, lengths, layers,
+                         first_subsampling_dl=first_subsampling_dl,
+                         conv_radius=conv_radius,
+                         deform_radius=deform_radius,
+                         neighbor_limits=neighbor_limits,
+                         neighbor_k=neighbor_k,
+                         rotations=rotations,
+                         upsamples=upsamples,
+                         csr=csr,
+                         nested=nested_subsampling,
+                         morton=morton_order,
+                         n_threads=n_threads,
+                         dtype=dtype)
+
+
+def apply_to_neighbors(neighbors, fn):
+    """
+    Applies a function to a padded neighbors matrix, or to both arrays of ragged (offsets, indices) neighbors
+    :param neighbors: padded matrix or (offsets, indices) tuple, as numpy arrays or torch tensors
+    :param fn: function applied to each array
+    :return: the neighbors in the same format
+    """
+
+    if isinstance(neighbors, tuple):
+        return tuple(fn(a) for a in neighbors)
+    return fn(neighbors)
+
+
+def neighbors_counts(neighbors, n_supports=None):
+    """
+    Number of real neighbors in each row of padded or ragged neighbors
+    :param neighbors: [n, max_num] padded tensor or ([n + 1], [n_neighbors]) (offsets, indices) tensors
+    :param n_supports: shadow index of the padded neighbors (by default the number of rows, as for conv neighbors)
+    :return: (n) numpy array of counts
+    """
+
+    if isinstance(neighbors, tuple):
+        offsets = neighbors[0].cpu().numpy()
+        return offsets[1:] - offsets[:-1]
+    if n_supports is None:
+        n_supports = neighbors.shape[0]
+    return np.sum(neighbors.cpu().numpy() < n_supports, axis=1)
+
+
+def pin_tensor(tensor):
+    """
+    Pinned copy of a CPU tensor, used by the pin_memory of the batches. Tensors already on a device (inputs built by
+    the 'torch' pyramid backend on this device) are returned as is.
+    """
+
+    return tensor if tensor.is_cuda else tensor.pin_memory()
+
+
+def padding_waste(counts):
+    """
+    Fraction of a padded neighbors matrix taken by shadow neighbors, which ragged neighbors do not store
+    :param counts: (n) number of real neighbors of each row
+    :return: float
+    """
+
+    if len(counts) == 0 or np.max(counts) == 0:
+        return 0.0
+    return 1 - np.sum(counts) / (len(counts) * np.max(counts))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Spatial index
+#       \*******************/
+#
+
+
+class CellIndex:
+    """
+    Spatial index of a cloud for the radius and nearest neighbors queries of the datasets (same query_radius, query
+    and data as a sklearn KDTree). The points are bucketed in the cells of a regular grid: the indices of the points
+    sorted by cell, the keys of the non-empty cells and the start of each cell in the sorted indices are flat arrays,
+    saved with the points in a single binary file. A saved index is opened with np.memmap, without reading it.
+    """
+
+    # Header of the index files, followed by the points (N, 3) float32, the sorted indices (N,) int32, the cell keys
+    # (M,) int64 and the cell starts (M + 1,) int64
+    header_dtype = np.dtype([('magic', 'S8'), ('n_points', '<i8'), ('n_cells', '<i8'), ('origin', '<f8', (3,)),
+                             ('cell_size', '<f8'), ('dims', '<i8', (3,))])
+    magic = b'KPCIDX01'
+
+    # Arrays of the index, in the order of the index files
+    array_names = ['data', 'order', 'cell_keys', 'cell_starts']
+
+    # Max number of (query, point) candidate pairs, and of rows of cells, gathered at once (bound the memory of the
+    # queries)
+    max_candidates = 1 << 22
+    max_rows = 1 << 20
+
+    # Max number of cells along the largest side of the cloud (bounds the rows of a single query to about max_dims^2,
+    # even when the mean spacing of the points collapses, for duplicated points)
+    max_dims = 1 << 10
+
+    def __init__(self, points, leaf_size=4):
+        """
+        Builds the index of a cloud, with cells holding about leaf_size points on average
+        :param points: (N, 3) points
+        :param leaf_size: mean number of points in the non-empty cells
+        """
+
+        self.data = np.ascontiguousarray(points, dtype=np.float32).reshape((-1, 3))
+        self.filename = None
+        n = self.data.shape[0]
+        mins = np.min(self.data, axis=0).astype(np.float64) if n > 0 else np.zeros(3)
+        extent = np.maximum(np.max(self.data, axis=0) - mins, 1e-6) if n > 0 else np.ones(3)
+        self.origin = mins
+
+        # Size of the cells, first for points filling their bounding box, then corrected for the actual number of
+        # non-empty cells (clouds are mostly surfaces, whose number of cells grows as the square of the resolution)
+        cell_size = float(np.cbrt(np.prod(extent) * leaf_size / max(n, 1)))
+        for _ in range(2):
+            self.set_cell_size(max(cell_size, float(np.max(extent)) / self.max_dims), extent)
+            n_cells = np.unique(self.keys(self.cells(self.data))).shape[0] if n > 0 else 1
+            cell_size *= np.sqrt(leaf_size * n_cells / max(n, 1))
+        self.set_cell_size(max(cell_size, float(np.max(extent)) / self.max_dims), extent)
+
+        # Points sorted by cell
+        keys = self.keys(self.cells(self.data))
+        self.order = np.argsort(keys, kind='stable').astype(np.int32)
+        self.cell_keys, counts = np.unique(keys[self.order], return_counts=True)
+        self.cell_starts = np.zeros((self.cell_keys.shape[0] + 1,), dtype=np.int64)
+        self.cell_starts[1:] = np.cumsum(counts)
+
+    def set_cell_size(self, cell_size, extent):
+        self.cell_size = cell_size
+        self.dims = np.floor(extent / cell_size).astype(np.int64) + 1
+
+    def cells(self, points):
+        return np.floor((np.asarray(points, dtype=np.float64) - self.origin) / self.cell_size).astype(np.int64)
+
+    def keys(self, cells):
+        cells = np.clip(cells, 0, self.dims - 1)
+        return (cells[:, 2] * self.dims[1] + cells[:, 1]) * self.dims[0] + cells[:, 0]
+
+    def save(self, filename):
+        """
+        Saves the index in a single binary file, which can then be opened with CellIndex.load
+        """
+
+        header = np.zeros((1,), dtype=self.header_dtype)
+        header['magic'] = self.magic
+        header['n_points'] = self.data.shape[0]
+        header['n_cells'] = self.cell_keys.shape[0]
+        header['origin'] = self.origin
+        header['cell_size'] = self.cell_size
+        header['dims'] = self.dims
+        with open(filename, 'wb') as f:
+            for array in [header] + [getattr(self, name) for name in self.array_names]:
+                f.write(np.ascontiguousarray(array).tobytes())
+        self.filename = filename
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Opens a saved index, with its arrays memory-mapped (read only)
+        """
+
+        header = np.fromfile(filename, dtype=cls.header_dtype, count=1)[0]
+        if header['magic'] != cls.magic:
+            raise ValueError('{:s} is not a cell index file'.format(filename))
+
+        index = cls.__new__(cls)
+        index.filename = filename
+        index.origin = header['origin'].astype(np.float64)
+        index.cell_size = float(header['cell_size'])
+        index.dims = header['dims'].astype(np.int64)
+        n, m = int(header['n_points']), int(header['n_cells'])
+        offset = cls.header_dtype.itemsize
+        arrays = []
+        for dtype, shape in [(np.float32, (n, 3)), (np.int32, (n,)), (np.int64, (m,)), (np.int64, (m + 1,))]:
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            arrays.append(np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape) if size > 0
+                          else np.zeros(shape, dtype=dtype))
+            offset += size
+        for name, array in zip(cls.array_names, arrays):
+            setattr(index, name, array)
+        return index
+
+    def __getstate__(self):
+        # Saved indices are sent to other processes by file name, and opened again there
+        if self.filename is not None:
+            return {'filename': self.filename}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'data' not in state:
+            state = CellIndex.load(state['filename']).__dict__
+        self.__dict__.update(state)
+
+    def candidates(self, X, r, distances=True):
+        """
+        Points closer than r to each query, in blocks of queries. The cells around each query are gathered by rows along
+        x (cells of consecutive keys), cut to the chord of the sphere in the row. The cells of a row entirely inside the
+        sphere are accepted without distance test, only the cells crossed by the sphere are tested.
+        :param distances: compute the squared distances of all the accepted points (else only of the tested ones)
+        :return: generator of the first and last queries of each block, and their (query indices, point indices,
+                 squared distances or None if not asked) arrays, grouped by query (not sorted by distance)
+        """
+
+        # Query and radius in cell units, with a margin for the rounding of the cells of the points
+        q = (np.asarray(X, dtype=np.float64) - self.origin) / self.cell_size
+        rc = r / self.cell_size
+        eps = 1e-6
+
+        # Box of each query, clipped to the grid, and its number of rows (y, z)
+        lo = np.floor(q - rc - eps).astype(np.int64)
+        hi = np.floor(q + rc + eps).astype(np.int64)
+        valid = np.all((hi >= 0) & (lo < self.dims), axis=1)
+        lo = np.clip(lo, 0, self.dims - 1)
+        hi = np.clip(hi, 0, self.dims - 1)
+        n_y = hi[:, 1] - lo[:, 1] + 1
+        n_rows = n_y * (hi[:, 2] - lo[:, 2] + 1) * valid
+
+        # Blocks of queries with a bounded number of rows
+        blocks = np.cumsum(n_rows) // self.max_rows
+        block_bounds = np.r_[0, np.where(np.diff(blocks) > 0)[0] + 1, X.shape[0]]
+        for j0, j1 in zip(block_bounds[:-1], block_bounds[1:]):
+
+            # Rows of the box of each query (ragged), without the rows missing the sphere
+            row_q = np.repeat(np.arange(j0, j1), n_rows[j0:j1])
+            t = np.arange(row_q.shape[0]) - np.repeat(np.cumsum(n_rows[j0:j1]) - n_rows[j0:j1], n_rows[j0:j1])
+            y = lo[row_q, 1] + t % n_y[row_q]
+            z = lo[row_q, 2] + t // n_y[row_q]
+            ay = np.abs(y + 0.5 - q[row_q, 1])
+            az = np.abs(z + 0.5 - q[row_q, 2])
+            near2 = np.maximum(ay - 0.5 - eps, 0) ** 2 + np.maximum(az - 0.5 - eps, 0) ** 2
+            far2 = (ay + 0.5 + eps) ** 2 + (az + 0.5 + eps) ** 2
+            kept = near2 <= (rc + eps) ** 2
+            row_q, y, z, near2, far2 = row_q[kept], y[kept], z[kept], near2[kept], far2[kept]
+
+            # Cells of each row crossing the sphere (chord), and cells entirely inside it
+            qx = q[row_q, 0]
+            h_out = np.sqrt(np.maximum((rc + eps) ** 2 - near2, 0))
+            h_in = np.sqrt(np.maximum((rc - eps) ** 2 - far2, 0))
+            x0 = np.clip(np.floor(qx - h_out - eps), 0, self.dims[0] - 1).astype(np.int64)
+            x3 = np.clip(np.floor(qx + h_out + eps), -1, self.dims[0] - 1).astype(np.int64) + 1
+            x1 = np.clip(np.ceil(qx - h_in + eps), x0, x3).astype(np.int64)
+            x2 = np.clip(np.floor(qx + h_in - eps), x1, x3).astype(np.int64)
+            x1[far2 >= (rc - eps) ** 2] = x3[far2 >= (rc - eps) ** 2]
+            x2 = np.maximum(x2, x1)
+
+            # Ranges of the sorted points in the three segments of each row (tested, inside, tested)
+            row_keys = (z * self.dims[1] + y) * self.dims[0]
+            bounds = [self.cell_starts[np.searchsorted(self.cell_keys, row_keys + x)] for x in [x0, x1, x2, x3]]
+            starts = np.stack(bounds[:3], axis=1)
+            counts = np.stack([b1 - b0 for b0, b1 in zip(bounds[:3], bounds[1:])], axis=1)
+            inside = np.array([False, True, False])
+            q_counts = np.bincount(row_q - j0, weights=np.sum(counts, axis=1), minlength=j1 - j0).astype(np.int64)
+            row_starts = np.r_[0, np.cumsum(np.bincount(row_q - j0, minlength=j1 - j0))]
+
+            # Sub-blocks of queries with a bounded number of candidates
+            sub_blocks = np.cumsum(q_counts) // self.max_candidates
+            sub_bounds = np.r_[0, np.where(np.diff(sub_blocks) > 0)[0] + 1, j1 - j0]
+            for b0, b1 in zip(sub_bounds[:-1], sub_bounds[1:]):
+                r0, r1 = row_starts[b0], row_starts[b1]
+                b_counts = counts[r0:r1].ravel()
+                offsets = starts[r0:r1].ravel() - np.cumsum(b_counts) + b_counts
+                pos = np.arange(np.sum(b_counts)) + np.repeat(offsets, b_counts)
+                q_inds = np.repeat(np.arange(j0 + b0, j0 + b1), q_counts[b0:b1])
+                inds = self.order[pos]
+                tested = ~np.repeat(np.tile(inside, r1 - r0), b_counts)
+
+                # Squared distances of the tested points (or of all the points)
+                mask = ~tested
+                computed = np.ones_like(tested) if distances else tested
+                diff = self.data[inds[computed]] - X[q_inds[computed]]
+                c_d2 = np.einsum('ij,ij->i', diff, diff)
+                mask[computed] |= c_d2 <= r ** 2
+                d2 = c_d2[mask] if distances else None
+                yield j0 + b0, j0 + b1, q_inds[mask], inds[mask].astype(np.int64), d2
+
+    @staticmethod
+    def distance_order(i0, q_inds, d2, r):
+        """
+        Order sorting candidates grouped by query by distance in each query, with a single sort of the query index plus
+        the squared distance scaled below one
+        """
+
+        return np.argsort((q_inds - i0) + d2 * ((1 - 1e-7) / max(r ** 2, 1e-30)), kind='stable')
+
+    def query_radius(self, X, r, return_distance=False, sort_results=False):
+        """
+        Indices (and distances) of the points within r of each query, as object arrays like KDTree.query_radius
+        """
+
+        X = np.asarray(X, dtype=np.float64).reshape((-1, 3))
+        inds = np.empty((X.shape[0],), dtype=object)
+        dists = np.empty((X.shape[0],), dtype=object)
+        for i0, i1, q_inds, b_inds, d2 in self.candidates(X, r, distances=return_distance or sort_results):
+            if sort_results:
+                order = self.distance_order(i0, q_inds, d2, r)
+                q_inds, b_inds, d2 = q_inds[order], b_inds[order], d2[order]
+            splits = np.searchsorted(q_inds, np.arange(i0, i1 + 1))
+            for q, j0, j1 in zip(range(i0, i1), splits[:-1], splits[1:]):
+                inds[q] = b_inds[j0:j1]
+                if d2 is not None:
+                    dists[q] = np.sqrt(d2[j0:j1])
+        if return_distance:
+            return inds, dists
+        return inds
+
+    def query(self, X, k=1, return_distance=True):
+        """
+        k nearest points of each query, as (N, k) matrices like KDTree.query. The search starts with the radius holding
+        about k points on a surface of the mean density of the cells, and is doubled for the queries with less than k
+        points in it.
+        """
+
+        X = np.asarray(X, dtype=np.float64).reshape((-1, 3))
+        k = min(k, self.data.shape[0])
+        inds = np.zeros((X.shape[0], k), dtype=np.int64)
+        dists = np.zeros((X.shape[0], k), dtype=np.float64)
+        todo = np.arange(X.shape[0])
+        density = max(self.data.shape[0], 1) / max(self.cell_keys.shape[0], 1)
+        r = self.cell_size * np.sqrt(k / (np.pi * density))
+        while todo.shape[0] > 0 and k > 0:
+            done = np.zeros(todo.shape, dtype=bool)
+            for i0, i1, q_inds, b_inds, d2 in self.candidates(X[todo], r):
+                order = self.distance_order(i0, q_inds, d2, r)
+                q_inds, b_inds, d2 = q_inds[order], b_inds[order], d2[order]
+                counts = np.bincount(q_inds - i0, minlength=i1 - i0)
+                ranks = np.arange(q_inds.shape[0]) - (np.cumsum(counts) - counts)[q_inds - i0]
+                mask = (ranks < k) & (counts[q_inds - i0] >= k)
+                inds[todo[q_inds[mask]], ranks[mask]] = b_inds[mask]
+                dists[todo[q_inds[mask]], ranks[mask]] = np.sqrt(d2[mask])
+                done[i0:i1] = counts >= k
+            todo = todo[~done]
+            r *= 2
+        if return_distance:
+            return dists, inds
+        return inds
+
+
+class SharedArena:
+    """
+    Arrays copied in a single block of shared memory (a torch tensor moved to shared memory, like the potentials of the
+    datasets). The input pipeline workers, forked after it is created, read the same physical pages: the arrays are
+    never written, so their pages are never copied, whatever the number of workers.
+
+    The block can also be a file (in /dev/shm for a node-local cache), shared by all the jobs opening it: the first job
+    writes it under a temporary name and renames it (atomic, other jobs never see a partial file), the next ones map it
+    read only and do not copy the arrays. Each job removes the file when it exits (close): the jobs still running keep
+    their mapping, and the memory is freed when the last one exits.
+    """
+
+    # Alignment of the arrays in the block, in bytes (cache lines)
+    alignment = 64
+
+    def __init__(self, arrays, filename=None):
+        """
+        Copies the arrays in a new block of shared memory, or maps them from the file of a previous job
+        :param arrays: list of numpy arrays
+        :param filename: optional file of the block, written if it does not exist yet
+        :return: the copies of the arrays are in self.arrays
+        """
+
+        arrays = [np.ascontiguousarray(a) for a in arrays]
+        sizes = [a.nbytes for a in arrays]
+        offsets = np.cumsum([0] + [-(-size // self.alignment) * self.alignment for size in sizes])
+        n_bytes = max(int(offsets[-1]), 1)
+
+        self.filename = filename
+        self.cached = filename is not None and os.path.exists(filename) and os.path.getsize(filename) == n_bytes
+        if filename is None:
+            self.buffer = torch.empty((n_bytes,), dtype=torch.uint8)
+            self.buffer.share_memory_()
+            block = self.buffer.numpy()
+        elif self.cached:
+            block = None
+        else:
+            tmp_file = '{:s}.{:d}.tmp'.format(filename, os.getpid())
+            block = np.memmap(tmp_file, dtype=np.uint8, mode='w+', shape=(n_bytes,))
+
+        # Copy the arrays
+        if block is not None:
+            for a, i0, size in zip(arrays, offsets[:-1], sizes):
+                block[i0:i0 + size] = a.reshape(-1).view(np.uint8)
+
+        # Publish the file, map it read only, and remove it at exit
+        if filename is not None:
+            if not self.cached:
+                block.flush()
+                del block
+                os.replace(tmp_file, filename)
+            with open(filename, 'rb') as f:
+                self.identity = self.file_identity(os.fstat(f.fileno()))
+                self.buffer = np.memmap(f, dtype=np.uint8, mode='r', shape=(n_bytes,))
+            block = self.buffer
+            self.pid = os.getpid()
+            atexit.register(self.close)
+
+        self.arrays = [block[i0:i0 + size].view(a.dtype).reshape(a.shape)
+                       for a, i0, size in zip(arrays, offsets[:-1], sizes)]
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.buffer.shape))
+
+    @staticmethod
+    def file_identity(stat):
+        return stat.st_dev, stat.st_ino, stat.st_ctime_ns
+
+    def close(self):
+        """
+        Removes the file of the block (only from the process which opened it, not from its workers), unless its name now
+        holds another file (written by a newer job after the removal of this one by a previous job)
+        """
+
+        if self.filename is not None and os.getpid() == self.pid:
+            try:
+                if self.file_identity(os.stat(self.filename)) == self.identity:
+                    os.remove(self.filename)
+            except FileNotFoundError:
+                pass
+            self.filename = None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Sphere centers
+#       \********************/
+#
+
+
+class PotentialField:
+    """
+    Potentials of the coarse points of all the clouds of a dataset, with their minimum kept up to date in a segment
+    tree: each node holds the minimum of its two children and the index of the point reaching it. Adding to the
+    potentials of a few points only updates their ancestors (O(k log N)), and the lowest potential is read at the root
+    (O(1)) instead of an argmin over each cloud. The tree is in shared memory, like the potentials were.
+    """
+
+    def __init__(self, potentials):
+        """
+        :param potentials: list of the initial (N_i,) potentials of each cloud
+        """
+
+        self.offsets = np.cumsum([0] + [p.shape[0] for p in potentials])
+        self.size = 1 << int(np.ceil(np.log2(max(self.offsets[-1], 1))))
+
+        # Nodes 1 to size - 1, then the leaves (padded with inf)
+        self.tree_mins = torch.full((2 * self.size,), float('inf'), dtype=torch.float64)
+        self.tree_args = torch.zeros((2 * self.size,), dtype=torch.int64)
+        self.tree_mins.share_memory_()
+        self.tree_args.share_memory_()
+        self.mins = self.tree_mins.numpy()
+        self.args = self.tree_args.numpy()
+        self.mins[self.size:self.size + self.offsets[-1]] = np.hstack([np.zeros((0,))] + list(potentials))
+        self.args[self.size:] = np.arange(self.size)
+        level = self.size // 2
+        while level > 0:
+            self.update_nodes(np.arange(level, 2 * level))
+            level //= 2
+
+        # Potentials of each cloud (views on the leaves)
+        self.potentials = [self.tree_mins[self.size + i0:self.size + i1]
+                           for i0, i1 in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def __getstate__(self):
+        # The numpy views are made again on the shared tensors of the tree (datasets pickled for spawned workers)
+        state = self.__dict__.copy()
+        for name in ['mins', 'args', 'potentials']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mins = self.tree_mins.numpy()
+        self.args = self.tree_args.numpy()
+        self.potentials = [self.tree_mins[self.size + i0:self.size + i1]
+                           for i0, i1 in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def update_nodes(self, nodes):
+        right = self.mins[2 * nodes + 1] < self.mins[2 * nodes]
+        children = 2 * nodes + right
+        self.mins[nodes] = self.mins[children]
+        self.args[nodes] = self.args[children]
+
+    def add(self, cloud_ind, inds, values):
+        """
+        Adds values to the potentials of some points of a cloud
+        :param cloud_ind: index of the cloud
+        :param inds: (k,) unique indices of the points in the cloud
+        :param values: (k,) values added to their potentials
+        """
+
+        if len(inds) == 0:
+            return
+        leaves = self.size + self.offsets[cloud_ind] + np.asarray(inds, dtype=np.int64)
+        self.mins[leaves] += values
+
+        # Ancestors of the leaves, level by level (sorted, so that duplicates are consecutive)
+        nodes = np.sort(leaves)
+        while nodes[0] > 1:
+            nodes = nodes // 2
+            nodes = nodes[np.r_[True, nodes[1:] != nodes[:-1]]]
+            self.update_nodes(nodes)
+
+    def argmin(self):
+        """
+        Cloud index and point index of the lowest potential
+        """
+
+        i = int(self.args[1])
+        cloud_ind = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return cloud_ind, i - int(self.offsets[cloud_ind])
+
+    def min(self):
+        """
+        Lowest potential of all the clouds
+        """
+
+        return float(self.mins[1])
+
+
+class PotentialScheduler:
+    """
+    Chooses the centers of the input spheres of a dataset with potentials: the coarse point of lowest potential, moved
+    by a small noise, after which the potentials around it are increased with Tukey weights. With input pipeline
+    workers, a thread of the main process chooses them ahead of the workers and hands them over through a small
+    bounded queue (about one center per worker, so that the potentials are hardly ahead of the predicted spheres), and
+    the workers never wait for each other. Without workers, the centers are chosen on demand under the worker lock.
+    """
+
+    def __init__(self, dataset, queue_size=1, threaded=True):
+        """
+        :param dataset: dataset with pot_trees and pot_field
+        :param queue_size: number of centers chosen ahead of the workers
+        :param threaded: choose the centers in a thread of the main process (with workers)
+        """
+
+        self.dataset = dataset
+        self.threaded = threaded
+        self.queue = multiprocessing.Queue(maxsize=queue_size) if threaded else None
+        if threaded:
+            self.queue.cancel_join_thread()
+        self.thread = None
+
+        # Own random state, whose lock is never held by the thread when workers are forked
+        self.rng = np.random.RandomState(np.random.randint(2 ** 31))
+
+    def __getstate__(self):
+        # The thread stays in the main process (datasets are pickled for spawned workers, which read the queue)
+        state = self.__dict__.copy()
+        state['thread'] = None
+        return state
+
+    def next_center(self):
+        """
+        Chooses the next center and updates the potentials
+        :return: cloud index, index of the coarse point, and (1, 3) center
+        """
+
+        dataset = self.dataset
+        radius = dataset.config.in_radius
+
+        # Get potential minimum
+        cloud_ind, point_ind = dataset.pot_field.argmin()
+
+        # Center point of input region, with a small noise
+        center_point = dataset.pot_trees[cloud_ind].data[point_ind, :].astype(np.float64).reshape(1, -1)
+        if dataset.set != 'ERF':
+            center_point += self.rng.normal(scale=radius / 10, size=center_point.shape)
+
+            # Update potentials (Tukey weights)
+            pot_inds, dists = dataset.pot_trees[cloud_ind].query_radius(center_point, r=radius, return_distance=True)
+            d2s = np.square(dists[0])
+            tukeys = np.square(1 - d2s / np.square(radius))
+            tukeys[d2s > np.square(radius)] = 0
+            dataset.pot_field.add(cloud_ind, pot_inds[0], tukeys)
+
+        return cloud_ind, point_ind, center_point
+
+    def run(self):
+        while True:
+            self.queue.put(self.next_center())
+
+    def start(self):
+        """
+        Starts the thread choosing the centers, in the main process. Called by the samplers when they start yielding
+        batches, that is after the DataLoader workers are created.
+        """
+
+        if self.threaded and self.thread is None and get_worker_info() is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def get(self):
+        """
+        Next center, from the queue of the thread, or chosen now without thread
+        """
+
+        if self.threaded:
+            self.start()
+            return self.queue.get()
+        with self.dataset.worker_lock:
+            return self.next_center()
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -236,6 +1035,54 @@ class PointCloudDataset(Dataset):
 
         return 0
 
+    def share_clouds(self, *names):
+        """
+        Moves the subsampled clouds in a single block of shared memory: the arrays of the spatial indices (input and
+        potential trees) and of the given lists of per cloud arrays (features and labels)
+        :param names: names of the attributes holding the lists of per cloud arrays (None elements are kept)
+        """
+
+        trees = self.input_trees + self.pot_trees
+        arrays = [getattr(tree, name) for tree in trees for name in CellIndex.array_names]
+        arrays += [a for name in names for a in getattr(self, name) if a is not None]
+
+        # Keep the clouds in the memory of the process when shared memory is not available
+        try:
+            self.arena = SharedArena(arrays, filename=self.shared_cache_file(trees, names))
+        except (RuntimeError, OSError) as e:
+            print('Warning: the clouds could not be moved to shared memory ({:s}), keeping them as they are\n'.format(
+                str(e)))
+            self.arena = None
+            return
+
+        # Replace the arrays by their shared copies
+        shared = iter(self.arena.arrays)
+        for tree in trees:
+            for name in CellIndex.array_names:
+                setattr(tree, name, next(shared))
+        for name in names:
+            setattr(self, name, [None if a is None else next(shared) for a in getattr(self, name)])
+
+        if self.arena.cached:
+            print('{:.1f} MB of clouds mapped from {:s}\n'.format(self.arena.nbytes * 1e-6, self.arena.filename))
+        else:
+            print('{:.1f} MB of clouds in shared memory\n'.format(self.arena.nbytes * 1e-6))
+
+    def shared_cache_file(self, trees, names):
+        """
+        File of the shared clouds in the node cache (config.shared_cache_dir), or None without cache. Its name is a hash
+        of the dataset path, set, subsampling size and arrays, and of the size and modification time of the index files
+        (a new file when the clouds are prepared again).
+        """
+
+        cache_dir = self.config.shared_cache_dir
+        if not cache_dir or not os.path.isdir(cache_dir) or any(tree.filename is None for tree in trees):
+            return None
+        files = [(tree.filename, os.path.getsize(tree.filename), os.path.getmtime(tree.filename)) for tree in trees]
+        key = repr((os.path.abspath(self.path), self.set, self.config.first_subsampling_dl, names, files))
+        return os.path.join(cache_dir, 'kpconv_{:s}_{:s}_{:s}.arena'.format(
+            self.name, self.set, hashlib.sha1(key.encode()).hexdigest()[:16]))
+
     def init_labels(self):
 
         # Initialize all label parameters given the label_to_names dict
@@ -341,112 +1188,96 @@ class PointCloudDataset(Dataset):
         else:
             return neighbors
 
-    def classification_inputs(self,
-                              stacked_points,
-                              stacked_features,
-                              labels,
-                              stack_lengths):
-
-        # Starting radius of convolutions
-        r_normal = self.config.first_subsampling_dl * self.config.conv_radius
+    def neighborhood_limit(self, layer):
+        """
+        Max number of neighbors of a layer, to be applied directly in the neighbors search (0 means no limit). Same
+        limit as the one used by big_neighborhood_filter
+        """
 
-        # Starting layer
-        layer_blocks = []
+        if len(self.neighborhood_limits) > 0:
+            return int(self.neighborhood_limits[layer])
+        else:
+            return 0
 
-        # Lists of inputs
-        input_points = []
-        input_neighbors = []
-        input_pools = []
-        input_stack_lengths = []
-        deform_layers = []
+    def neighborhood_k(self, layer):
+        """
+        Number of nearest neighbors of a layer in the knn neighborhood mode (the last value of config.neighborhood_k is
+        used for the deeper layers), 0 in the radius mode
+        """
 
-        ######################
-        # Loop over the blocks
-        ######################
+        if self.config.neighborhood_mode == 'knn':
+            return int(self.config.neighborhood_k[min(layer, len(self.config.neighborhood_k) - 1)])
+        else:
+            return 0
 
-        arch = self.config.architecture
+    def architecture_layers(self):
+        """
+        Reads the architecture of the network, layer by layer. A layer gathers the blocks until a pooling, a global
+        pooling or an upsampling block.
+        :return: (L, 4) int32 flags [conv, deformable conv, pool, deformable pool] of each layer
+        """
 
-        for block_i, block in enumerate(arch):
+        layers = []
+        layer_blocks = []
+        for block in self.config.architecture:
 
             # Get all blocks of the layer
             if not ('pool' in block or 'strided' in block or 'global' in block or 'upsample' in block):
                 layer_blocks += [block]
                 continue
 
-            # Convolution neighbors indices
-            # *****************************
-
-            deform_layer = False
-            if layer_blocks:
-                # Convolutions are done in this layer, compute the neighbors with the good radius
-                if np.any(['deformable' in blck for blck in layer_blocks]):
-                    r = r_normal * self.config.deform_radius / self.config.conv_radius
-                    deform_layer = True
-                else:
-                    r = r_normal
-                conv_i = batch_neighbors(stacked_points, stacked_points, stack_lengths, stack_lengths, r)
-
-            else:
-                # This layer only perform pooling, no neighbors required
-                conv_i = np.zeros((0, 1), dtype=np.int32)
-
-            # Pooling neighbors indices
-            # *************************
-
-            # If end of layer is a pooling operation
-            if 'pool' in block or 'strided' in block:
-
-                # New subsampling length
-                dl = 2 * r_normal / self.config.conv_radius
-
-                # Subsampled points
-                pool_p, pool_b = batch_grid_subsampling(stacked_points, stack_lengths, sampleDl=dl)
-
-                # Radius of pooled neighbors
-                if 'deformable' in block:
-                    r = r_normal * self.config.deform_radius / self.config.conv_radius
-                    deform_layer = True
-                else:
-                    r = r_normal
-
-                # Subsample indices
-                pool_i = batch_neighbors(pool_p, stacked_points, pool_b, stack_lengths, r)
-
-            else:
-                # No pooling in the end of this layer, no pooling indices required
-                pool_i = np.zeros((0, 1), dtype=np.int32)
-                pool_p = np.zeros((0, 1), dtype=np.float32)
-                pool_b = np.zeros((0,), dtype=np.int32)
-
-            # Reduce size of neighbors matrices by eliminating furthest point
-            conv_i = self.big_neighborhood_filter(conv_i, len(input_points))
-            pool_i = self.big_neighborhood_filter(pool_i, len(input_points))
-
-            # Updating input lists
-            input_points += [stacked_points]
-            input_neighbors += [conv_i.astype(np.int64)]
-            input_pools += [pool_i.astype(np.int64)]
-            input_stack_lengths += [stack_lengths]
-            deform_layers += [deform_layer]
-
-            # New points for next layer
-            stacked_points = pool_p
-            stack_lengths = pool_b
-
-            # Update radius and reset blocks
-            r_normal *= 2
+            # Convolutions are done in this layer if it has blocks, and the layer ends with a pooling or not
+            conv_deform = np.any(['deformable' in blck for blck in layer_blocks])
+            pool = 'pool' in block or 'strided' in block
+            layers += [[len(layer_blocks) > 0, conv_deform, pool, pool and 'deformable' in block]]
             layer_blocks = []
 
             # Stop when meeting a global pooling or upsampling
             if 'global' in block or 'upsample' in block:
                 break
 
+        return np.array(layers, dtype=np.int32).reshape((-1, 4))
+
+    def input_pyramid(self, stacked_points, stack_lengths, upsamples=True):
+        """
+        Points, neighbors, pools, upsamples and lengths of every layer, computed in a single CPP call (or with torch
+        ops, see config.pyramid_backend)
+        """
+
+        layers = self.architecture_layers()
+        neighbor_limits = np.array([self.neighborhood_limit(l) for l in range(len(layers))], dtype=np.int32)
+        neighbor_k = np.array([self.neighborhood_k(l) for l in range(len(layers))], dtype=np.int32)
+
+        return batch_input_pyramid(stacked_points, stack_lengths, layers,
+                                   first_subsampling_dl=self.config.first_subsampling_dl,
+                                   conv_radius=self.config.conv_radius,
+                                   deform_radius=self.config.deform_radius,
+                                   neighbor_limits=neighbor_limits,
+                                   neighbor_k=neighbor_k,
+                                   upsamples=upsamples,
+                                   csr=self.config.csr_neighbors,
+                                   nested_subsampling=self.config.nested_subsampling,
+                                   morton_order=self.config.morton_order,
+                                   n_threads=self.config.neighbors_threads,
+                                   dtype=np.int32 if self.config.compact_neighbors else np.int64,
+                                   backend=self.config.pyramid_backend,
+                                   device=self.config.pyramid_device)
+
+    def classification_inputs(self,
+                              stacked_points,
+                              stacked_features,
+                              labels,
+                              stack_lengths):
+
+        # Inputs of every layer
+        input_points, input_neighbors, input_pools, _, input_stack_lengths = self.input_pyramid(stacked_points,
+                                                                                              stack_lengths,
+                                                                                              upsamples=False)
+
         ###############
         # Return inputs
         ###############
 
-        # Save deform layers
-
         # list of network inputs
         li = input_points + input_neighbors + input_pools + input_stack_lengths
         li += [stacked_features, labels]
@@ -460,107 +1291,9 @@ class PointCloudDataset(Dataset):
                             labels,
                             stack_lengths):
 
-        # Starting radius of convolutions
-        r_normal = self.config.first_subsampling_dl * self.config.conv_radius
-
-        # Starting layer
-        layer_blocks = []
-
-        # Lists of inputs
-        input_points = []
-        input_neighbors = []
-        input_pools = []
-        input_upsamples = []
-        input_stack_lengths = []
-        deform_layers = []
-
-        ######################
-        # Loop over the blocks
-        ######################
-
-        arch = self.config.architecture
-
-        for block_i, block in enumerate(arch):
-
-            # Get all blocks of the layer
-            if not ('pool' in block or 'strided' in block or 'global' in block or 'upsample' in block):
-                layer_blocks += [block]
-                continue
-
-            # Convolution neighbors indices
-            # *****************************
-
-            deform_layer = False
-            if layer_blocks:
-                # Convolutions are done in this layer, compute the neighbors with the good radius
-                if np.any(['deformable' in blck for blck in layer_blocks]):
-                    r = r_normal * self.config.deform_radius / self.config.conv_radius
-                    deform_layer = True
-                else:
-                    r = r_normal
-                conv_i = batch_neighbors(stacked_points, stacked_points, stack_lengths, stack_lengths, r)
-
-            else:
-                # This layer only perform pooling, no neighbors required
-                conv_i = np.zeros((0, 1), dtype=np.int32)
-
-            # Pooling neighbors indices
-            # *************************
-
-            # If end of layer is a pooling operation
-            if 'pool' in block or 'strided' in block:
-
-                # New subsampling length
-                dl = 2 * r_normal / self.config.conv_radius
-
-                # Subsampled points
-                pool_p, pool_b = batch_grid_subsampling(stacked_points, stack_lengths, sampleDl=dl)
-
-                # Radius of pooled neighbors
-                if 'deformable' in block:
-                    r = r_normal * self.config.deform_radius / self.config.conv_radius
-                    deform_layer = True
-                else:
-                    r = r_normal
-
-                # Subsample indices
-                pool_i = batch_neighbors(pool_p, stacked_points, pool_b, stack_lengths, r)
-
-                # Upsample indices (with the radius of the next layer to keep wanted density)
-                up_i = batch_neighbors(stacked_points, pool_p, stack_lengths, pool_b, 2 * r)
-
-            else:
-                # No pooling in the end of this layer, no pooling indices required
-                pool_i = np.zeros((0, 1), dtype=np.int32)
-                pool_p = np.zeros((0, 3), dtype=np.float32)
-                pool_b = np.zeros((0,), dtype=np.int32)
-                up_i = np.zeros((0, 1), dtype=np.int32)
-
-            # Reduce size of neighbors matrices by eliminating furthest point
-            conv_i = self.big_neighborhood_filter(conv_i, len(input_points))
-            pool_i = self.big_neighborhood_filter(pool_i, len(input_points))
-            if up_i.shape[0] > 0:
-                up_i = self.big_neighborhood_filter(up_i, len(input_points)+1)
-
-            # Updating input lists
-            input_points += [stacked_points]
-            input_neighbors += [conv_i.astype(np.int64)]
-            input_pools += [pool_i.astype(np.int64)]
-            input_upsamples += [up_i.astype(np.int64)]
-            input_stack_lengths += [stack_lengths]
-            deform_layers += [deform_layer]
-
-            # New points for next layer
-            stacked_points = pool_p
-            stack_lengths = pool_b
-
-            # Update radius and reset blocks
-            r_normal *= 2
-            layer_blocks = []
-
-            # Stop when meeting a global pooling or upsampling
-            if 'global' in block or 'upsample' in block:
-                break
+        # Inputs of every layer
+        input_points, input_neighbors, input_pools, input_upsamples, input_stack_lengths = \
+            self.input_pyramid(stacked_points, stack_lengths)
 
         ###############
         # Return inputs
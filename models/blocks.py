@@ -36,11 +36,15 @@ def gather(x, idx, method=2):
     """
     implementation of a custom gather operation for faster backwards.
     :param x: input with shape [N, D_1, ... D_d]
-    :param idx: indexing with shape [n_1, ..., n_m]
+    :param idx: indexing with shape [n_1, ..., n_m], int64 or int32
     :param method: Choice of the method
     :return: x[idx] with shape [n_1, ..., n_m, D_1, ... D_d]
     """
 
+    # torch.gather only takes int64 indices, index_select reads int32 ones as they are
+    if idx.dtype != torch.int64:
+        return x.index_select(0, idx.reshape(-1)).reshape(idx.shape + x.shape[1:])
+
     if method == 0:
         return x[idx]
     elif method == 1:
@@ -66,6 +70,16 @@ def gather(x, idx, method=2):
         raise ValueError('Unkown method')
 
 
+def csr_rows(offsets):
+    """
+    Row of each entry of ragged neighbors
+    :param offsets: [n_rows + 1] offsets of the rows in the flat indices
+    :return: [n_entries] row indices
+    """
+    counts = (offsets[1:] - offsets[:-1]).long()
+    return torch.repeat_interleave(torch.arange(counts.shape[0], device=offsets.device), counts)
+
+
 def radius_gaussian(sq_r, sig, eps=1e-9):
     """
     Compute a radius gaussian (gaussian of distance)
@@ -80,10 +94,18 @@ def closest_pool(x, inds):
     """
     Pools features from the closest neighbors. WARNING: this function assumes the neighbors are ordered.
     :param x: [n1, d] features matrix
-    :param inds: [n2, max_num] Only the first column is used for pooling
+    :param inds: [n2, max_num] Only the first column is used for pooling. Or ragged ([n2 + 1], [n_neighbors])
+                 (offsets, indices) neighbors, where only the first neighbor of each row is used
     :return: [n2, d] pooled features matrix
     """
 
+    # First neighbor of each row of ragged neighbors, empty rows take the shadow pool
+    if isinstance(inds, tuple):
+        offsets, indices = inds
+        indices = torch.cat((indices, torch.full_like(indices[:1], x.shape[0])), 0)
+        first = torch.where(offsets[1:] > offsets[:-1], offsets[:-1], torch.full_like(offsets[:-1], indices.shape[0] - 1))
+        inds = indices[first.long()].unsqueeze(1)
+
     # Add a last row with minimum features for shadow pools
     x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
 
@@ -95,10 +117,17 @@ def max_pool(x, inds):
     """
     Pools features with the maximum values.
     :param x: [n1, d] features matrix
-    :param inds: [n2, max_num] pooling indices
+    :param inds: [n2, max_num] pooling indices, or ragged ([n2 + 1], [n_neighbors]) (offsets, indices) pooling indices
     :return: [n2, d] pooled features matrix
     """
 
+    # Maximum over the real neighbors of each row only, empty rows get zero features like shadow pools
+    if isinstance(inds, tuple):
+        offsets, indices = inds
+        rows = csr_rows(offsets).unsqueeze(1).expand(-1, x.shape[1])
+        max_features = torch.zeros((offsets.shape[0] - 1, x.shape[1]), dtype=x.dtype, device=x.device)
+        return max_features.scatter_reduce(0, rows, gather(x, indices), reduce='amax', include_self=False)
+
     # Add a last row with minimum features for shadow pools
     x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
 
@@ -273,11 +302,16 @@ class KPConv(nn.Module):
         # Deformed convolution
         ######################
 
+        # Ragged neighbors only convolve the real neighbors
+        if isinstance(neighb_inds, tuple):
+            weighted_features = self.ragged_weighted_features(q_pts, s_pts, neighb_inds, x, offsets)
+            return self.kernel_outputs(weighted_features, modulations)
+
         # Add a fake point in the last row for shadow neighbors
         s_pts = torch.cat((s_pts, torch.zeros_like(s_pts[:1, :]) + 1e6), 0)
 
         # Get neighbor points [n_points, n_neighbors, dim]
-        neighbors = s_pts[neighb_inds, :]
+        neighbors = gather(s_pts, neighb_inds)
 
         # Center every neighborhood
         neighbors = neighbors - q_pts.unsqueeze(1)
@@ -292,8 +326,9 @@ class KPConv(nn.Module):
         # Get all difference matrices [n_points, n_neighbors, n_kpoints, dim]
         neighbors.unsqueeze_(2)
         differences = neighbors - deformed_K_points
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
+        if differences.is_cuda:
+            torch.cuda.empty_cache()
+            torch.cuda.synchronize()
         # Get the square distances [n_points, n_neighbors, n_kpoints]
         sq_distances = torch.sum(differences ** 2, dim=3)
 
@@ -322,48 +357,118 @@ class KPConv(nn.Module):
 
             # New shadow neighbors have to point to the last shadow point
             new_neighb_inds *= neighb_row_bool
-            new_neighb_inds -= (neighb_row_bool.type(torch.int64) - 1) * int(s_pts.shape[0] - 1)
+            new_neighb_inds -= (neighb_row_bool.type(new_neighb_inds.dtype) - 1) * int(s_pts.shape[0] - 1)
         else:
             new_neighb_inds = neighb_inds
 
         # Get Kernel point influences [n_points, n_kpoints, n_neighbors]
+        all_weights = torch.transpose(self.kernel_influences(sq_distances), 1, 2)
+
+        # Add a zero feature for shadow neighbors
+        x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
+
+        # Get the features of each neighborhood [n_points, n_neighbors, in_fdim]
+        neighb_x = gather(x, new_neighb_inds)
+
+        # Apply distance weights [n_points, n_kpoints, in_fdim]
+        weighted_features = torch.matmul(all_weights, neighb_x)
+
+        return self.kernel_outputs(weighted_features, modulations)
+
+    def kernel_influences(self, sq_distances):
+        """
+        Influence of each kernel point on each neighbor
+        :param sq_distances: [..., n_kpoints] square distances between neighbors and kernel points
+        :return: [..., n_kpoints] influences
+        """
+
         if self.KP_influence == 'constant':
             # Every point get an influence of 1.
             all_weights = torch.ones_like(sq_distances)
-            all_weights = torch.transpose(all_weights, 1, 2)
 
         elif self.KP_influence == 'linear':
             # Influence decrease linearly with the distance, and get to zero when d = KP_extent.
             all_weights = torch.clamp(1 - torch.sqrt(sq_distances) / self.KP_extent, min=0.0)
-            all_weights = torch.transpose(all_weights, 1, 2)
 
         elif self.KP_influence == 'gaussian':
             # Influence in gaussian of the distance.
             sigma = self.KP_extent * 0.3
             all_weights = radius_gaussian(sq_distances, sigma)
-            all_weights = torch.transpose(all_weights, 1, 2)
         else:
             raise ValueError('Unknown influence function type (config.KP_influence)')
 
         # In case of closest mode, only the closest KP can influence each point
         if self.aggregation_mode == 'closest':
-            neighbors_1nn = torch.argmin(sq_distances, dim=2)
-            all_weights *= torch.transpose(nn.functional.one_hot(neighbors_1nn, self.K), 1, 2)
+            neighbors_1nn = torch.argmin(sq_distances, dim=-1)
+            all_weights = all_weights * nn.functional.one_hot(neighbors_1nn, self.K)
 
         elif self.aggregation_mode != 'sum':
             raise ValueError("Unknown convolution mode. Should be 'closest' or 'sum'")
 
-        # Add a zero feature for shadow neighbors
-        x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
+        return all_weights
 
-        # Get the features of each neighborhood [n_points, n_neighbors, in_fdim]
-        neighb_x = gather(x, new_neighb_inds)
+    def ragged_weighted_features(self, q_pts, s_pts, neighb_inds, x, offsets):
+        """
+        Features of the neighbors weighted by the kernel point influences, computed on ragged neighbors. Same result
+        as the padded computation of forward, without any shadow neighbor.
+        :param neighb_inds: ([n_points + 1], [n_neighbors]) (offsets, indices) neighbors
+        :return: [n_points, n_kpoints, in_fdim] weighted features
+        """
 
-        # Apply distance weights [n_points, n_kpoints, in_fdim]
-        weighted_features = torch.matmul(all_weights, neighb_x)
+        neighb_offsets, neighb_inds = neighb_inds
+
+        # Query point of each neighbor [n_neighbors]
+        neighb_rows = csr_rows(neighb_offsets)
+
+        # Center every neighbor [n_neighbors, dim]
+        neighbors = gather(s_pts, neighb_inds) - q_pts[neighb_rows, :]
+
+        # Apply offsets to kernel points [n_neighbors, n_kpoints, dim]
+        if self.deformable:
+            self.deformed_KP = offsets + self.kernel_points
+            deformed_K_points = self.deformed_KP[neighb_rows]
+        else:
+            deformed_K_points = self.kernel_points
+
+        # Get the square distances [n_neighbors, n_kpoints]
+        differences = neighbors.unsqueeze(1) - deformed_K_points
+        sq_distances = torch.sum(differences ** 2, dim=2)
+
+        # Optimization by ignoring points outside a deformed KP range
+        if self.deformable:
+
+            # Save distances for loss (zero for points without neighbors)
+            self.min_d2 = torch.zeros((q_pts.shape[0], self.K), dtype=sq_distances.dtype, device=sq_distances.device)
+            self.min_d2 = self.min_d2.scatter_reduce(0, neighb_rows.unsqueeze(1).expand(-1, self.K), sq_distances,
+                                                     reduce='amin', include_self=False)
+
+            # Only keep the neighbors in range of a kernel point
+            in_range = torch.any(sq_distances < self.KP_extent ** 2, dim=1)
+            neighb_inds = neighb_inds[in_range]
+            neighb_rows = neighb_rows[in_range]
+            sq_distances = sq_distances[in_range]
+
+        # Get Kernel point influences [n_neighbors, n_kpoints]
+        all_weights = self.kernel_influences(sq_distances)
+
+        # Get the features of each neighbor [n_neighbors, in_fdim]
+        neighb_x = gather(x, neighb_inds)
+
+        # Apply distance weights and sum over the neighbors of each point [n_points, n_kpoints, in_fdim]
+        zeros = torch.zeros((q_pts.shape[0], x.shape[1]), dtype=x.dtype, device=x.device)
+        return torch.stack([zeros.index_add(0, neighb_rows, all_weights[:, k:k + 1] * neighb_x)
+                            for k in range(self.K)], dim=1)
+
+    def kernel_outputs(self, weighted_features, modulations):
+        """
+        Applies the network weights to the weighted features of each kernel point
+        :param weighted_features: [n_points, n_kpoints, in_fdim]
+        :param modulations: [n_points, n_kpoints] or None
+        :return: [n_points, out_fdim] convolution output
+        """
 
         # Apply modulations
-        if self.deformable and self.modulated:
+        if modulations is not None:
             weighted_features *= modulations.unsqueeze(2)
 
         # Apply network weights [n_kpoints, n_points, out_fdim]
@@ -0,0 +1,95 @@
+#
+#
+#      0=================================0
+#      |    Kernel Point Convolutions    |
+#      0=================================0
+#
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Callable script checking the queries of the grid spatial index (CellIndex) against sklearn's KDTree, on the
+#      degenerate cases: queries far from the cloud, single point and duplicated points clouds
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Also collected by pytest (python -m pytest -q test_cell_index.py)
+#
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import numpy as np
+from sklearn.neighbors import KDTree
+
+# My libs
+from datasets.common import CellIndex
+
+# Queries inside the unit cube, and far outside of it
+rng = np.random.RandomState(42)
+queries = np.vstack((rng.rand(5, 3), [[1e3, 1e3, 1e3], [-5.0, 0.5, 0.5]]))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def check_queries(points, radiuses=(0.01, 0.3, 50.0)):
+    """
+    Compares the radius queries (sorted, with distances) and the nearest neighbors with a KDTree
+    """
+
+    index = CellIndex(points)
+    tree = KDTree(points)
+    for r in radiuses:
+        inds, dists = index.query_radius(queries, r, return_distance=True, sort_results=True)
+        tree_inds, tree_dists = tree.query_radius(queries, r, return_distance=True, sort_results=True)
+        for i, d, tree_i, tree_d in zip(inds, dists, tree_inds, tree_dists):
+            assert isinstance(d, np.ndarray) and d.shape == i.shape
+            assert np.array_equal(np.sort(i), np.sort(tree_i))
+            assert np.allclose(d, tree_d, atol=1e-5)
+
+    dists, inds = index.query(queries, k=1)
+    tree_dists, tree_inds = tree.query(queries, k=1)
+    assert np.allclose(dists, tree_dists, atol=1e-5)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Tests
+#       \***********/
+#
+
+def test_random_cloud():
+    check_queries(rng.rand(5000, 3).astype(np.float32))
+
+
+def test_single_point():
+    check_queries(np.array([[0.5, 0.5, 0.5]], dtype=np.float32))
+
+
+def test_duplicated_points():
+
+    # The mean spacing of the points collapses, the grid stays bounded
+    points = np.repeat(rng.rand(3, 3).astype(np.float32), 20000, axis=0)
+    check_queries(points)
+    assert np.max(CellIndex(points).dims) <= CellIndex.max_dims + 1
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+if __name__ == '__main__':
+
+    for test in [test_random_cloud, test_single_point, test_duplicated_points]:
+        test()
+        print('{:s} OK'.format(test.__name__))
@@ -0,0 +1,111 @@
+#
+#
+#      0=================================0
+#      |    Kernel Point Convolutions    |
+#      0=================================0
+#
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Callable script checking the potentials of the input spheres (PotentialField and PotentialScheduler), including
+#      the spheres holding no coarse point
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Also collected by pytest (python -m pytest -q test_potentials.py)
+#
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import numpy as np
+
+# My libs
+from datasets.common import CellIndex, PotentialField, PotentialScheduler
+from utils.config import Config
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility classes
+#       \*********************/
+#
+
+class PotentialsDataset:
+    """
+    The attributes of a dataset read by the scheduler: coarse points and potentials of two clouds
+    """
+
+    def __init__(self, seed=42):
+        rng = np.random.RandomState(seed)
+        self.config = Config()
+        self.config.in_radius = 0.5
+        self.set = 'training'
+        self.pot_trees = [CellIndex(rng.rand(n, 3).astype(np.float32) * 4) for n in [300, 200]]
+        self.pot_field = PotentialField([rng.rand(n) * 1e-3 for n in [300, 200]])
+
+
+class FarNoise:
+    """
+    Noise of the centers moving them far away from the clouds (spheres without any coarse point)
+    """
+
+    def normal(self, scale=1.0, size=None):
+        return np.full(size, 1e3 * scale)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Tests
+#       \***********/
+#
+
+def test_next_center():
+
+    dataset = PotentialsDataset()
+    scheduler = PotentialScheduler(dataset, threaded=False)
+    for i in range(20):
+        cloud_ind, point_ind, center = scheduler.next_center()
+
+        # The tree of the field keeps the minimum of the potentials
+        mins = [p.numpy().min() for p in dataset.pot_field.potentials]
+        assert dataset.pot_field.min() == min(mins)
+        assert dataset.pot_field.potentials[cloud_ind][point_ind] > 0
+    assert dataset.pot_field.min() > 0
+
+
+def test_empty_sphere():
+
+    dataset = PotentialsDataset()
+    scheduler = PotentialScheduler(dataset, threaded=False)
+    before = [p.numpy().copy() for p in dataset.pot_field.potentials]
+
+    # A sphere without coarse point leaves the potentials untouched, and chooses the same center again
+    scheduler.rng = FarNoise()
+    cloud_ind, point_ind, _ = scheduler.next_center()
+    for p0, p1 in zip(before, dataset.pot_field.potentials):
+        assert np.array_equal(p0, p1.numpy())
+    assert scheduler.next_center()[:2] == (cloud_ind, point_ind)
+
+    # The next sphere around the center increases the potentials again
+    scheduler.rng = np.random.RandomState(0)
+    scheduler.next_center()
+    assert dataset.pot_field.potentials[cloud_ind][point_ind] > before[cloud_ind][point_ind]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+if __name__ == '__main__':
+
+    for test in [test_next_center, test_empty_sphere]:
+        test()
+        print('{:s} OK'.format(test.__name__))
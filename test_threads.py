@@ -0,0 +1,177 @@
+#
+#
+#      0=================================0
+#      |    Kernel Point Convolutions    |
+#      0=================================0
+#
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Callable script checking that the point operations release the GIL (a python thread keeps running during a
+#      long call), and that calls from several python threads at once give the same results as serial calls
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Also collected by pytest (python -m pytest -q test_threads.py)
+#
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import time
+import threading
+import pytest
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# My libs
+from datasets.common import grid_subsampling, batch_neighbors, cpp_subsampling
+
+# Number of python threads and of calls
+n_threads = 8
+n_calls = 32
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def random_clouds(n_clouds, n_points=20000, seed=42):
+    """
+    Random clouds of different sizes and extents, with features and labels
+    """
+
+    rng = np.random.RandomState(seed)
+    clouds = []
+    for i in range(n_clouds):
+        n = n_points + rng.randint(n_points)
+        points = (rng.rand(n, 3) * (2 + 4 * rng.rand(3))).astype(np.float32)
+        features = rng.rand(n, 2).astype(np.float32)
+        labels = rng.randint(5, size=n).astype(np.int32)
+        clouds.append((points, features, labels))
+    return clouds
+
+
+def threaded(func, args):
+    """
+    Results of func on each args, computed serially and by concurrent python threads
+    """
+
+    serial = [func(*a) for a in args]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        concurrent = list(executor.map(lambda a: func(*a), args))
+    return serial, concurrent
+
+
+def longest_pause(func):
+    """
+    Duration of func, and longest time during which a pure python thread could not run meanwhile (the whole call if
+    func holds the GIL, a few switch intervals if it releases it)
+    """
+
+    ticks = []
+    stop = threading.Event()
+
+    def tick():
+        while not stop.is_set():
+            ticks.append(time.perf_counter())
+
+    thread = threading.Thread(target=tick)
+    thread.start()
+    time.sleep(0.05)
+    t0 = time.perf_counter()
+    func()
+    t1 = time.perf_counter()
+    stop.set()
+    thread.join()
+
+    ticks = np.array(ticks)
+    ticks = ticks[(ticks > t0) & (ticks < t1)]
+    return t1 - t0, np.max(np.diff(np.r_[t0, ticks, t1]))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Tests
+#       \***********/
+#
+
+def test_gil_released():
+
+    if cpp_subsampling.__name__.endswith('numpy_pointops'):
+        pytest.skip('the pointops extension is not built')
+
+    rng = np.random.RandomState(42)
+    points = rng.rand(300000, 3).astype(np.float32)
+    lengths = np.array([points.shape[0]], dtype=np.int32)
+    calls = [lambda: grid_subsampling(points, sampleDl=0.01),
+             lambda: batch_neighbors(points[:100000], points, lengths // 3, lengths, 0.03)]
+    for call in calls:
+        duration, pause = longest_pause(call)
+        assert pause < 0.25 * duration
+
+
+def test_subsample():
+
+    def subsample(points, features, labels):
+        return grid_subsampling(points, features=features, labels=labels, sampleDl=0.1)
+
+    serial, concurrent = threaded(subsample, random_clouds(n_calls))
+    for res0, res1 in zip(serial, concurrent):
+        for a0, a1 in zip(res0, res1):
+            assert np.array_equal(a0, a1)
+
+
+def test_batch_neighbors():
+
+    def neighbors(points, features, labels):
+        lengths = np.array([points.shape[0] // 3, points.shape[0] - points.shape[0] // 3], dtype=np.int32)
+        return batch_neighbors(points, points, lengths, lengths, 0.2, max_neighbors=40)
+
+    serial, concurrent = threaded(neighbors, random_clouds(n_calls))
+    for a0, a1 in zip(serial, concurrent):
+        assert np.array_equal(a0, a1)
+
+
+def test_shared_grid_subsampler():
+
+    # One GridSubsampler filled by chunks from several threads
+    points, features, labels = random_clouds(1, n_points=200000)[0]
+    chunks = np.array_split(np.arange(points.shape[0]), n_calls)
+
+    def accumulate(n_workers):
+        grid = cpp_subsampling.GridSubsampler(np.min(points, axis=0), np.max(points, axis=0),
+                                              sampleDl=0.1, fdim=2, ldim=1)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(lambda c: grid.add(points[c], features=features[c], classes=labels[c]), chunks))
+
+        # The voxels are numbered in the order of the chunks, compare them through the voxel of each point (the voxels
+        # are numbered by result)
+        sub_points, sub_features, _ = grid.result()
+        inds = grid.voxel_indices(points)
+        return sub_points[inds], sub_features[inds], grid.voxel_counts()[inds]
+
+    serial = accumulate(1)
+    concurrent = accumulate(n_threads)
+    for a0, a1 in zip(serial, concurrent):
+        assert np.allclose(a0, a1, atol=1e-5)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+if __name__ == '__main__':
+
+    for test in [test_gil_released, test_subsample, test_batch_neighbors, test_shared_grid_subsampler]:
+        test()
+        print('{:s} OK'.format(test.__name__))
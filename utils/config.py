@@ -61,6 +61,55 @@ class Config:
     # Number of CPU threads for the input pipeline
     input_threads = 8
 
+    # Engine of the grid subsampling of the clouds when preparing the datasets: 'hash' (voxels accumulated in a hash
+    # map) or 'sort' (radix sorted voxel keys, faster on large clouds)
+    subsampling_engine = 'hash'
+
+    # Number of points read at once when subsampling the clouds from memory-mapped files, for clouds larger than memory
+    # (0 reads the whole clouds). The chunked subsampling always accumulates the voxels in a hash map
+    subsampling_chunk_size = 0
+
+    # Subsample the points of all the layers of the network in a single pass on nested grids (barycenters of the input
+    # points of the voxels) instead of subsampling each layer from the points of the previous one
+    nested_subsampling = False
+
+    # Store the subsampled clouds, the input spheres and the pooled points of each layer along a Morton (Z-order) curve,
+    # so that nearby points are close in memory (cache friendly neighbor searches and convolution gathers)
+    morton_order = False
+
+    # Store the subsampled clouds, their features, labels and spatial indices in a single block of shared memory, read
+    # without copies by all the input pipeline workers (kept in the memory of the process if shared memory is missing)
+    shared_clouds = False
+
+    # Directory of a cache of the shared clouds (with shared_clouds) common to the jobs of a node (e.g. '/dev/shm'),
+    # keyed by the dataset path and first_subsampling_dl: the first job writes the clouds in a file, the next ones map
+    # it read only. Each job removes the file when it exits. Empty for a block of shared memory per job
+    shared_cache_dir = ''
+
+    # Number of threads used by each input pipeline worker to search the neighbors of the batch elements
+    neighbors_threads = 1
+
+    # Store neighbors and pools as ragged rows (CSR offsets and indices) instead of matrices padded with shadow neighbors
+    csr_neighbors = False
+
+    # Store neighbors, pools and upsamples indices as int32 instead of int64 (half the memory, read as is by the network)
+    compact_neighbors = False
+
+    # Neighborhoods of the convolutions: 'radius' (radius neighbors, limited by the calibrated neighborhood_limits) or
+    # 'knn' (fixed number of nearest neighbors, no calibration of the limits needed)
+    neighborhood_mode = 'radius'
+
+    # Number of nearest neighbors of each layer in the 'knn' mode (the last value is used for the deeper layers)
+    neighborhood_k = [30]
+
+    # Backend building the input pyramid: 'cpp' (pointops extension, numpy outputs) or 'torch' (voxel hashing and cell
+    # list neighbor searches with torch tensor ops, tensor outputs on pyramid_device)
+    pyramid_backend = 'cpp'
+
+    # Device of the 'torch' pyramid backend. A cuda device can only be used with input_threads = 0 (no CUDA in forked
+    # workers), and the loaders do not pin the tensors already on it
+    pyramid_device = 'cpu'
+
     ##################
     # Model parameters
     ##################
@@ -251,6 +300,9 @@ class Config:
                 elif line_info[0] == 'architecture':
                     self.architecture = [b for b in line_info[2:]]
 
+                elif line_info[0] == 'neighborhood_k':
+                    self.neighborhood_k = [int(k) for k in line_info[2:]]
+
                 elif line_info[0] == 'augment_symmetries':
                     self.augment_symmetries = [bool(int(b)) for b in line_info[2:]]
 
@@ -297,7 +349,23 @@ class Config:
             text_file.write('in_points_dim = {:d}\n'.format(self.in_points_dim))
             text_file.write('in_features_dim = {:d}\n'.format(self.in_features_dim))
             text_file.write('in_radius = {:.6f}\n'.format(self.in_radius))
-            text_file.write('input_threads = {:d}\n\n'.format(self.input_threads))
+            text_file.write('input_threads = {:d}\n'.format(self.input_threads))
+            text_file.write('subsampling_engine = {:s}\n'.format(self.subsampling_engine))
+            text_file.write('subsampling_chunk_size = {:d}\n'.format(self.subsampling_chunk_size))
+            text_file.write('nested_subsampling = {:d}\n'.format(int(self.nested_subsampling)))
+            text_file.write('morton_order = {:d}\n'.format(int(self.morton_order)))
+            text_file.write('shared_clouds = {:d}\n'.format(int(self.shared_clouds)))
+            text_file.write('shared_cache_dir = {:s}\n'.format(self.shared_cache_dir))
+            text_file.write('neighbors_threads = {:d}\n'.format(self.neighbors_threads))
+            text_file.write('csr_neighbors = {:d}\n'.format(int(self.csr_neighbors)))
+            text_file.write('compact_neighbors = {:d}\n'.format(int(self.compact_neighbors)))
+            text_file.write('neighborhood_mode = {:s}\n'.format(self.neighborhood_mode))
+            text_file.write('neighborhood_k =')
+            for k in self.neighborhood_k:
+                text_file.write(' {:d}'.format(k))
+            text_file.write('\n')
+            text_file.write('pyramid_backend = {:s}\n'.format(self.pyramid_backend))
+            text_file.write('pyramid_device = {:s}\n\n'.format(self.pyramid_device))
 
             # Model parameters
             text_file.write('# Model parameters\n')
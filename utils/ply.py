@@ -113,7 +113,7 @@ def parse_mesh_header(plyfile, ext):
     return num_points, num_faces, vertex_properties
 
 
-def read_ply(filename, triangular_mesh=False):
+def read_ply(filename, triangular_mesh=False, mmap=False):
     """
     Read ".ply" files
 
@@ -122,6 +122,9 @@ def read_ply(filename, triangular_mesh=False):
     filename : string
         the name of the file to read.
 
+    mmap : bool
+        memory-map the points instead of reading them (point clouds only), so that large files can be read by chunks.
+
     Returns
     -------
     result : array
@@ -191,7 +194,10 @@ def read_ply(filename, triangular_mesh=False):
             num_points, properties = parse_header(plyfile, ext)
 
             # Get data
-            data = np.fromfile(plyfile, dtype=properties, count=num_points)
+            if mmap:
+                data = np.memmap(filename, dtype=properties, mode='r', offset=plyfile.tell(), shape=(num_points,))
+            else:
+                data = np.fromfile(plyfile, dtype=properties, count=num_points)
 
     return data
 
@@ -303,7 +303,7 @@ class ModelTester:
                                              1000 * (mean_dt[2])))
 
             # Update minimum od potentials
-            new_min = torch.min(test_loader.dataset.min_potentials)
+            new_min = test_loader.dataset.pot_field.min()
             print('Test epoch {:d}, end. Min potential = {:.1f}'.format(test_epoch, new_min))
             #print([np.mean(pots) for pots in test_loader.dataset.potentials])
 